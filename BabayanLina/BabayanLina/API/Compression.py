@@ -0,0 +1,156 @@
+import time
+import zlib
+
+from DBaccess.StageMetrics import Stage_Metrics
+
+try:
+    import zstandard
+except ImportError:  # zstd is offered only when zstandard package is installed
+    zstandard = None
+
+Encoding_Gzip = "gzip"
+Encoding_Zstd = "zstd"
+
+# smaller bodies are sent as they are, compression would not pay for its headers and CPU time
+Compression_Min_Bytes = 1024
+# fast levels: big results are compressed while they are sent, CPU time must not exceed the time saved on the wire
+Gzip_Level = 4
+Zstd_Level = 3
+# media types which are compressed already
+Compressed_Mime_Types = {"application/vnd.apache.parquet", "application/gzip", "application/zstd"}
+# streamed pages of these types are flushed one by one, so the client gets every page as soon as it is ready
+Flushed_Mime_Types = {"application/x-ndjson"}
+
+
+# Choose response encoding from Accept-Encoding: zstd when the client accepts it and zstandard is installed, then gzip
+# Returns None when the response is sent without compression
+def NegotiateEncoding(accept_encodings):
+    candidates = [Encoding_Zstd, Encoding_Gzip] if zstandard is not None else [Encoding_Gzip]
+    best, best_quality = None, 0
+    for encoding in candidates:
+        quality = accept_encodings.quality(encoding) if accept_encodings else 0
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# Compress Flask response with the encoding if its body is big enough
+# Streamed bodies are compressed while they are produced: the first Compression_Min_Bytes are read ahead to decide,
+# so small streamed bodies are sent as they are too.
+def CompressResponse(response, encoding):
+    if response.direct_passthrough or "Content-Encoding" in response.headers or response.mimetype in Compressed_Mime_Types:
+        return response
+    # the body depends on Accept-Encoding even when it is sent uncompressed
+    response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+
+    if not response.is_streamed:
+        body, body_encoding = CompressBody(response.get_data(), encoding, response.mimetype)
+        if body_encoding is not None:
+            response.set_data(body)
+            response.headers["Content-Encoding"] = body_encoding
+        return response
+
+    chunks = iter(response.response)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        chunk = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= Compression_Min_Bytes:
+            break
+    else:
+        # the whole body is smaller than the threshold
+        if hasattr(response.response, "close"):
+            response.response.close()
+        response.set_data(b"".join(head))
+        return response
+
+    response.response = _compressChunks(head, chunks, encoding, response.mimetype in Flushed_Mime_Types, response.response)
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Content-Length", None)
+    return response
+
+
+# Compress whole body with the encoding if it is big enough and not compressed already
+# Returns the body and its encoding, None if the body is returned as it is
+def CompressBody(body, encoding, mimetype):
+    if encoding is None or len(body) < Compression_Min_Bytes or mimetype in Compressed_Mime_Types:
+        return body, None
+    compressor = _makeCompressor(encoding)
+    return compressor.compress(body) + compressor.flush(zlib.Z_FINISH), encoding
+
+
+# Compressor of a body sent in chunks, the compression time and size are recorded as a stage when it is finished
+#   compressor = StreamCompressor(encoding, flush_every_chunk)
+#   for chunk in body: send(compressor.Compress(chunk))
+#   send(compressor.Finish())
+class StreamCompressor:
+    def __init__(self, encoding, flush_every_chunk=False):
+        self.Encoding = encoding
+        self._compressor = _makeCompressor(encoding)
+        self._flush_every_chunk = flush_every_chunk
+        self._seconds = 0.0
+        self._size = 0
+
+    # compressed bytes of the chunk, it may be empty until the compressor collects enough data
+    def Compress(self, chunk):
+        start = time.perf_counter()
+        output = self._compressor.compress(chunk)
+        if self._flush_every_chunk:
+            output += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._seconds += time.perf_counter() - start
+        self._size += len(output)
+        return output
+
+    # the rest of compressed stream
+    def Finish(self):
+        start = time.perf_counter()
+        output = self._compressor.flush(zlib.Z_FINISH)
+        self._seconds += time.perf_counter() - start
+        self._size += len(output)
+        Stage_Metrics.Record(f"{self.Encoding}_compression", self._seconds, None, self._size)
+        return output
+
+
+# compressed stream of head chunks followed by the rest of the body
+def _compressChunks(head, chunks, encoding, flush_every_chunk, body):
+    compressor = StreamCompressor(encoding, flush_every_chunk)
+    try:
+        for chunk in _chain(head, chunks):
+            output = compressor.Compress(chunk)
+            if output:
+                yield output
+        yield compressor.Finish()
+    finally:
+        # closes the original body, so stream_with_context ends the request context
+        if hasattr(body, "close"):
+            body.close()
+
+
+def _chain(head, chunks):
+    yield from head
+    for chunk in chunks:
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+# gzip and zstd compressors with the same interface: compress(data) and flush(mode)
+def _makeCompressor(encoding):
+    if encoding == Encoding_Zstd:
+        return _ZstdCompressor()
+    return zlib.compressobj(Gzip_Level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=Zstd_Level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self, mode):
+        if mode == zlib.Z_FINISH:
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+Profile_Dir = os.path.join(tempfile.gettempdir(), "stellaris_profiles")
+# interval between stack samples of profiled threads
+Sample_Interval = 0.005
+# deepest stack frames kept in a sample
+Max_Stack_Depth = 128
+
+
+# Opt-in sampling profiler for slow requests
+# While enabled, stacks of the threads processing requests are sampled by one background thread every
+# Sample_Interval seconds. When a request takes longer than slow_seconds, its samples are written in folded stack
+# format ("module:function;module:function count" per line), which flame graph tools read.
+# Sampling doesn't slow down the profiled code, only the sampler thread takes time.
+class SamplingProfiler:
+    def __init__(self, slow_seconds=None, directory=Profile_Dir, interval=Sample_Interval):
+        self._slow_seconds = slow_seconds
+        self._directory = directory
+        self._interval = interval
+        self._samples = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    # enable profiling of requests slower than slow_seconds, None disables it
+    def Configure(self, slow_seconds=None, directory=None, interval=None):
+        self._slow_seconds = slow_seconds
+        if directory is not None:
+            self._directory = directory
+        if interval is not None:
+            self._interval = interval
+
+    @property
+    def Enabled(self):
+        return self._slow_seconds is not None
+
+    # start sampling the current thread
+    def Begin(self):
+        if not self.Enabled:
+            return
+        with self._lock:
+            self._samples[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    # stop sampling the current thread, write its profile if the request was slow, return the profile path or None
+    def End(self, seconds, name):
+        with self._lock:
+            samples = self._samples.pop(threading.get_ident(), None)
+        if not samples or not self.Enabled or seconds < self._slow_seconds:
+            return None
+
+        os.makedirs(self._directory, exist_ok=True)
+        safe_name = "".join(char if char.isalnum() else "_" for char in name).strip("_")
+        path = os.path.join(self._directory, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{safe_name}-{int(seconds * 1000)}ms.folded")
+        with open(path, "w") as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return path
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                while not self._samples:
+                    self._wakeup.wait()
+                thread_ids = list(self._samples)
+
+            frames = sys._current_frames()
+            stacks = {thread_id: _foldedStack(frames.get(thread_id)) for thread_id in thread_ids}
+            with self._lock:
+                for thread_id, stack in stacks.items():
+                    if stack and thread_id in self._samples:
+                        self._samples[thread_id][stack] += 1
+            time.sleep(self._interval)
+
+
+# stack of the frame from the outermost call: "module:function;module:function"
+def _foldedStack(frame):
+    names = []
+    while frame is not None and len(names) < Max_Stack_Depth:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Process-wide profiler, disabled until configured
+Sampling_Profiler = SamplingProfiler()
@@ -0,0 +1,164 @@
+import json
+from io import BytesIO
+
+from DBaccess.StageMetrics import Stage_Metrics
+from API.Compression import CompressBody
+
+# Supported response formats
+Format_Json = "json"            # row-wise JSON, the default
+Format_Columnar = "columnar"    # compact columnar JSON: {"columns": [...], "data": {col: [...]}}
+Format_VOTable = "votable"      # binary2 VOTable
+Format_Arrow = "arrow"          # Arrow IPC stream, requires pyarrow
+Format_Parquet = "parquet"      # Parquet file, requires pyarrow
+
+Mime_Types = {
+    Format_Json: "application/json",
+    Format_Columnar: "application/json",
+    Format_VOTable: "application/x-votable+xml",
+    Format_Arrow: "application/vnd.apache.arrow.stream",
+    Format_Parquet: "application/vnd.apache.parquet",
+}
+
+
+# Choose response format from the format parameter or, if it is absent, from the Accept header
+# JSON comes first in the negotiation, so clients accepting anything (*/*) get the usual JSON response
+def NegotiateFormat(format_param, accept_mimetypes):
+    if format_param:
+        response_format = format_param.lower()
+        if response_format not in Mime_Types:
+            raise ValueError(f"Not supported format: {format_param}, expected one of {', '.join(Mime_Types)}")
+        return response_format
+
+    mime_formats = {Mime_Types[Format_Json]: Format_Json,
+                    Mime_Types[Format_VOTable]: Format_VOTable,
+                    "application/x-votable": Format_VOTable,
+                    Mime_Types[Format_Arrow]: Format_Arrow,
+                    Mime_Types[Format_Parquet]: Format_Parquet,
+                    "application/x-parquet": Format_Parquet}
+    best_match = accept_mimetypes.best_match(list(mime_formats)) if accept_mimetypes else None
+    return mime_formats.get(best_match, Format_Json)
+
+
+# Row-wise JSON response {head..., "columns": [...], "data": [{row}, ...], tail...} produced piece by piece,
+# so the whole response text is never kept in memory. Rows are separated by new lines unless newline is False.
+def JsonResponse(head, result, tail, newline=True):
+    separator = ",\n" if newline else ","
+    columns = result.Columns
+    yield json.dumps(dict(head, columns=columns), cls=NumpyEncoder)[:-1] + ', "data": ['
+    for index, values in enumerate(result.RowValues()):
+        yield (separator if index else "") + json.dumps(dict(zip(columns, values)), cls=NumpyEncoder)
+    yield "], " + json.dumps(tail, cls=NumpyEncoder)[1:] if tail else "]}"
+
+
+# Response of several results side by side {head..., "results": [{summary..., "columns": [...], "data": [...]}, ...], tail...}
+# results is a list of (summary, QueryResult or None), every result is produced piece by piece as in JsonResponse
+def JsonResultsResponse(head, results, tail, newline=True):
+    separator = ",\n" if newline else ","
+    yield json.dumps(dict(head, results=[]), cls=NumpyEncoder)[:-3] + "["
+    for index, (summary, result) in enumerate(results):
+        if index:
+            yield separator
+        if result is None:
+            yield json.dumps(dict(summary, columns=[], data=[]), cls=NumpyEncoder)
+        else:
+            yield from JsonResponse(summary, result, {}, newline)
+    yield "], " + json.dumps(tail, cls=NumpyEncoder)[1:]
+
+
+# Serialize query result into the response format, return response body and its mime type
+# envelope holds the response fields other than columns and data (catalog, query, status ...)
+def SerializeTable(result, response_format, envelope):
+    with Stage_Metrics.Stage(f"{response_format}_serialization") as stage:
+        if response_format == Format_Columnar:
+            body = json.dumps(dict(envelope, columns=result.Columns, data=result.ColumnarData()), cls=NumpyEncoder, separators=(",", ":"))
+        elif response_format == Format_VOTable:
+            body = _toVOTable(result.Table, envelope)
+        elif response_format in (Format_Arrow, Format_Parquet):
+            body = _toArrow(result, envelope, response_format)
+        else:
+            raise ValueError(f"Table can't be serialized to {response_format} format")
+        stage.Rows = len(result)
+        stage.Bytes = len(body)
+    return body, Mime_Types[response_format]
+
+
+# Whole response body of the result in the response format, compressed with the encoding when it is worth it
+# head and tail are the response fields before and after columns and data. Returns the body and its encoding.
+# The asyncio serving mode runs it in worker processes, so big responses are serialized off the event loop.
+def SerializeBody(result, response_format, head, tail, encoding=None, newline=True):
+    if response_format == Format_Json:
+        body = "".join(JsonResponse(head, result, tail, newline)).encode("utf-8")
+    else:
+        body, _ = SerializeTable(result, response_format, dict(head, **tail))
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+    return CompressBody(body, encoding, Mime_Types[response_format])
+
+
+# Whole response body of several results side by side, in row-wise or columnar JSON, and its encoding
+# Other formats hold one table and can't put results side by side.
+def SerializeResultsBody(head, results, tail, response_format, encoding=None):
+    if response_format == Format_Json:
+        body = "".join(JsonResultsResponse(head, results, tail)).encode("utf-8")
+    elif response_format == Format_Columnar:
+        body = json.dumps(dict(head, results=[dict(summary, columns=result.Columns if result is not None else [],
+                                                   data=result.ColumnarData() if result is not None else {})
+                                              for summary, result in results], **tail),
+                          cls=NumpyEncoder, separators=(",", ":")).encode("utf-8")
+    else:
+        raise ValueError(f"Results side by side can't be serialized to {response_format} format, "
+                         f"expected {Format_Json} or {Format_Columnar}")
+    return CompressBody(body, encoding, Mime_Types[response_format])
+
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if hasattr(obj, 'item'):  # Convert numpy types
+            return obj.item()
+        return super().default(obj)
+
+
+# astropy is imported by the first VOTable response, other formats don't need it
+def _toVOTable(table, envelope):
+    from astropy.io.votable import from_table
+    from astropy.io.votable.tree import Info
+
+    votable = from_table(table)
+    votable.get_first_table().format = "binary2"
+    resource = votable.resources[0]
+    for name, value in envelope.items():
+        if value is not None:
+            resource.infos.append(Info(name=name, value=_envelopeText(value)))
+    output = BytesIO()
+    votable.to_xml(output)
+    return output.getvalue()
+
+
+def _toArrow(result, envelope, response_format):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(f"{response_format} format requires pyarrow, which is not installed on the server")
+
+    arrays = []
+    for name in result.Columns:
+        values, nulls = result.ColumnValues(name)
+        arrays.append(pyarrow.array(values, mask=nulls if nulls.any() else None))
+    metadata = {name: _envelopeText(value) for name, value in envelope.items() if value is not None}
+    arrow_table = pyarrow.Table.from_arrays(arrays, names=result.Columns, metadata=metadata)
+
+    sink = pyarrow.BufferOutputStream()
+    if response_format == Format_Parquet:
+        pyarrow.parquet.write_table(arrow_table, sink)
+    else:
+        with pyarrow.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+
+# envelope field as text of VOTable INFO or Arrow metadata, lists and dictionaries as JSON
+def _envelopeText(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, cls=NumpyEncoder)
+    return str(value)
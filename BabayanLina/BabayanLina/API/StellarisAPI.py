@@ -1,10 +1,14 @@
 import sys
 import os
-from flask import Flask, request
+import hmac
+import math
+import time
+Import_Started = time.perf_counter()
+from flask import Flask, request, Response, stream_with_context, g
 from flask_cors import CORS
-import numpy as np
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*", "allow_headers": ["Content-Type", "Authorization"]}})
+CORS(app, resources={r"/*": {"origins": "*", "allow_headers": ["Content-Type", "Authorization", "X-Client-Id"],
+                             "expose_headers": ["Server-Timing", "X-Estimated-Rows", "Retry-After", "Location"]}})
 
 # Add the root directory to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -12,20 +16,81 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from typing import Any
 import json
 
-from DBaccess.CrossMatching import CrossMatching
-from DBaccess.DBAccessGaia import DBAccessGaia
-from DBaccess.DBAccessSDSS import DBAccessSDSS
-from DBaccess.DBAccessSimbad import DBAccessSimbad
-from DBaccess.DBAccessStellaris import DBAccessStellaris
+# numpy, astropy and pyvo are not imported here: catalog backends are built by the registry on first use, modules of
+# cross matching, aggregation and federated queries are imported by the handlers needing them (API/Warmup.py imports
+# them in advance)
+from DBaccess.DBAccessBase import DBAccessBase
+from DBaccess.BackendRegistry import Backend_Registry
+from DBaccess.QueryCache import Query_Cache
+from DBaccess.CostEstimator import Cost_Estimator
+from DBaccess.AdmissionControl import Admission_Control
+from DBaccess.Resilience import Upstream_Resilience
+from DBaccess.SingleFlight import Single_Flight, Async_Single_Flight
+from DBaccess.CpuPool import Cpu_Pool
+from DBaccess.JobManager import Job_Manager, Phase_Completed
+from DBaccess.StageMetrics import Stage_Metrics, RenderGauges
+from API.ResponseFormats import NegotiateFormat, SerializeTable, JsonResponse, JsonResultsResponse, SerializeResultsBody, Mime_Types, Format_Json, Format_Columnar
+from API.Profiling import Sampling_Profiler
+from API.Warmup import Warm_Up
+from API.Compression import NegotiateEncoding, CompressResponse
 from DBaccess.RequestProcessingError import RequestProcessingError
 from DBaccess.RequestProcessingError import CrossMatchRequestProcessingError
-
-DB_CLASSES = {
-    "gaia": DBAccessGaia(),
-    "sdss": DBAccessSDSS(),
-    "stellaris": DBAccessStellaris(),
-    "simbad": DBAccessSimbad()
-}
+from DBaccess.RequestProcessingError import AdmissionRejectedError
+from DBaccess.RequestProcessingError import UpstreamUnavailableError
+
+# ways processQuery request is answered
+Route_Sync = "sync"
+Route_Chunked = "chunked"
+Route_Job = "job"
+
+# rows processQuery and crossMatching jobs may request: the whole result of a job is kept in memory until it expires,
+# bigger results are requested page by page with chunkSize
+Max_Job_Rows = int(os.environ.get("STELLARIS_MAX_JOB_ROWS") or 2000000)
+
+# opt-in profiling: STELLARIS_PROFILE_SLOW_SECONDS=2 writes sampled stacks of requests slower than 2 seconds
+# into STELLARIS_PROFILE_DIR (temporary directory by default)
+if os.environ.get("STELLARIS_PROFILE_SLOW_SECONDS"):
+    Sampling_Profiler.Configure(slow_seconds=float(os.environ["STELLARIS_PROFILE_SLOW_SECONDS"]),
+                                directory=os.environ.get("STELLARIS_PROFILE_DIR"))
+
+# token required by admin endpoints changing the state of the API (Authorization: Bearer <token>), the endpoints are
+# disabled if unset: CORS allows every origin, so any web page could call them otherwise
+Admin_Token = os.environ.get("STELLARIS_ADMIN_TOKEN")
+
+# addresses of reverse proxies whose X-Client-Id header names the client, STELLARIS_TRUSTED_PROXIES="10.0.0.1,10.0.0.2"
+# the header of other clients is ignored: a client could send a new value with every request to bypass its quotas
+Trusted_Proxies = {address.strip() for address in (os.environ.get("STELLARIS_TRUSTED_PROXIES") or "").split(",") if address.strip()}
+
+
+#every request collects timings of its stages
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    Stage_Metrics.StartRequest()
+    Sampling_Profiler.Begin()
+
+#stages finished before the response starts are reported in Server-Timing header, streamed bodies are serialized
+#after the headers are sent, their serialization time is available only in /metrics
+@app.after_request
+def add_server_timing(response):
+    seconds = time.perf_counter() - g.request_start
+    timings = Stage_Metrics.CurrentRequest
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.ServerTiming(seconds)
+        response.headers['Timing-Allow-Origin'] = '*'
+    Stage_Metrics.ObserveRequest(request.endpoint or "unknown", response.status_code, seconds)
+    return response
+
+#responses are compressed with gzip or zstd accepted by the client, streamed bodies are compressed while they are sent
+@app.after_request
+def compress_response(response):
+    return CompressResponse(response, NegotiateEncoding(request.accept_encodings))
+
+#teardown runs when the response body is sent, so profiles of streamed responses include serialization
+@app.teardown_request
+def finish_request_profile(error):
+    if 'request_start' in g:
+        Sampling_Profiler.End(time.perf_counter() - g.request_start, request.path)
 
 
 @app.route('/processQuery', methods=['POST', 'OPTIONS'])
@@ -33,44 +98,373 @@ def process_query():
     if request.method == 'OPTIONS':
         # Preflight request handler
         response = app.make_default_options_response()
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Client-Id'
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
         return response
     try:
         db_access, db_name, query_params_json, limit, chunk_size = __validateProcessQueryInput(request.data)
+        response_format = NegotiateFormat(request.args.get('format'), request.accept_mimetypes)
+        client = __clientId(request.headers.get('X-Client-Id'), request.remote_addr)
+        cost, route = __routeQuery(db_access, query_params_json, limit, chunk_size)
+        estimated_rows = cost.rows if cost is not None else 0
+
+        # too many rows for a synchronous response: the query runs as a background job, the client polls /jobs/<job_id>
+        if route == Route_Job:
+            __validateJobLimit('processQuery', limit)
+            Admission_Control.Charge(client, estimated_rows)
+            job = Job_Manager.Submit('processQuery', db_name, __processQueryJob(db_access, query_params_json, limit, chunk_size))
+            return __form_rerouted_response(job, cost), 202, __admissionHeaders(cost, job)
+
+        # chunked mode: stream every page to the client as a separate NDJSON line as soon as it is received
+        if route == Route_Chunked:
+            Admission_Control.Charge(client, estimated_rows)
+            return Response(stream_with_context(__stream_query_chunks(db_access, query_params_json, limit, chunk_size)),
+                            status=200, mimetype='application/x-ndjson', headers=__admissionHeaders(cost))
 
         # Call QueryCatalog
-        catalog, query, columns, data, table = db_access.QueryCatalog(query_params_json, limit, chunk_size)
-        processed_data = replace_nan_with_none(data)
-        return __form_success_response(catalog, query, columns, processed_data), 200
+        with Admission_Control.Client(client, estimated_rows):
+            catalog, query, result = db_access.QueryCatalog(query_params_json, limit, chunk_size)
+        if response_format != Format_Json:
+            response = __form_table_response(result, response_format, {"catalog": catalog, "query": query, "status": "success", "error": None})
+            response.headers.update(__admissionHeaders(cost))
+            return response
+
+        return Response(Stage_Metrics.TimedIterator("json_serialization", __form_success_response(catalog, query, result)),
+                        status=200, mimetype='application/json', headers=__admissionHeaders(cost))
     
     except ValueError as e:
         return __form_error_response("","", "Input error", str(e)), 400
+    except UpstreamUnavailableError as e:
+        return __form_error_response(e.catalog, e.query, e.status, str(e)), 503, __retryAfterHeaders(e)
     except RequestProcessingError as e:
         return __form_error_response(e.catalog, e.query, e.status, str(e)), 401
+    except AdmissionRejectedError as e:
+        return __form_error_response("","", e.status, str(e)), 429, __retryAfterHeaders(e)
     except Exception as e:
         return __form_error_response("","","System error", str(e)), 500
 
 @app.route('/crossMatching', methods=['POST'])
 def cross_matching():
     try:
-        db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size = __validateCrossMatchingInput(request.data)
-
-        catalog_source, query, catalog_to_match, crossmatch_query, columns, data = CrossMatching().CrossMatching(db_access_src, db_access_to_match, query_params_json, limit, chunk_size)
-        processed_data = replace_nan_with_none(data)
-
-        return __form_success_crossmatch_response(catalog_source, query, catalog_to_match, crossmatch_query, columns, processed_data), 200
+        from DBaccess.CrossMatching import CrossMatching
+        db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size, match_policy = __validateCrossMatchingInput(request.data)
+        response_format = NegotiateFormat(request.args.get('format'), request.accept_mimetypes)
+        client = __clientId(request.headers.get('X-Client-Id'), request.remote_addr)
+        cost = Cost_Estimator.Estimate(db_access_src, query_params_json, limit)
+
+        # every source row is uploaded to SIMBAD, so the source rows are taken from the quota of the client
+        with Admission_Control.Client(client, cost.rows if cost is not None else 0):
+            catalog_source, query, catalog_to_match, crossmatch_query, result = CrossMatching().CrossMatching(db_access_src, db_access_to_match, query_params_json, limit, chunk_size, match_policy=match_policy)
+        if response_format != Format_Json:
+            return __form_table_response(result, response_format, {"catalog_source": catalog_source, "query_source": query,
+                                                                  "catalog_to_match": catalog_to_match, "crossmatch_query": crossmatch_query,
+                                                                  "status": "success", "error": None})
+
+        return Response(Stage_Metrics.TimedIterator("json_serialization", __form_success_crossmatch_response(catalog_source, query, catalog_to_match, crossmatch_query, result)),
+                        status=200, mimetype='application/json')
 
     except ValueError as e:
         return __form_error_crossmatch_response("","", "","", "Input error", str(e)), 400
+    except UpstreamUnavailableError as e:
+        return __form_error_crossmatch_response(e.catalog, e.query, "", "", e.status, str(e)), 503, __retryAfterHeaders(e)
     except CrossMatchRequestProcessingError as e:
         return __form_error_crossmatch_response(e.catalog_source, e.query, e.catalog_to_match, e.crossmatch_query, e.status, str(e)), 401
+    except AdmissionRejectedError as e:
+        return __form_error_crossmatch_response("","", "","", e.status, str(e)), 429, __retryAfterHeaders(e)
     except Exception as e:
         return __form_error_crossmatch_response("","", "", "", "System error", str(e)), 500
 
+#query several catalogs with the same query parameters, the catalogs are requested concurrently
+#results of the catalogs which answered are returned even if other catalogs failed or timed out
+@app.route('/federatedQuery', methods=['POST'])
+def federated_query():
+    try:
+        from DBaccess.FederatedQuery import FederatedQuery, Merge_Side_By_Side, Merge_Position
+        catalogs, query_params_json, limit, merge, timeouts = __validateFederatedQueryInput(request.data)
+        response_format = NegotiateFormat(request.args.get('format'), request.accept_mimetypes)
+        if merge == Merge_Side_By_Side and response_format not in (Format_Json, Format_Columnar):
+            raise ValueError(f"Results side by side can't be returned in {response_format} format, use merge={Merge_Position}")
+        client = __clientId(request.headers.get('X-Client-Id'), request.remote_addr)
+
+        with Admission_Control.Client(client, __federatedRows(catalogs, query_params_json, limit)):
+            catalog_results, result = FederatedQuery().Query(catalogs, query_params_json, limit, merge, timeouts)
+        head, tail = __federated_envelope(catalog_results, merge)
+        if merge == Merge_Side_By_Side:
+            results = [(catalog_result.ToDict(), catalog_result.result) for catalog_result in catalog_results]
+            if response_format == Format_Columnar:
+                body, _ = SerializeResultsBody(head, results, tail, response_format)
+                return Response(body, status=200, mimetype=Mime_Types[response_format])
+            return Response(Stage_Metrics.TimedIterator("json_serialization", JsonResultsResponse(head, results, tail)),
+                            status=200, mimetype='application/json')
+
+        if response_format != Format_Json:
+            return __form_table_response(result, response_format, dict(head, **tail))
+        return Response(Stage_Metrics.TimedIterator("json_serialization", JsonResponse(head, result, tail)),
+                        status=200, mimetype='application/json')
+
+    except ValueError as e:
+        return __form_error_federated_response([], "Input error", str(e)), 400
+    except RequestProcessingError as e:
+        return __form_error_federated_response(e.catalog.split(", "), e.status, str(e)), 401
+    except AdmissionRejectedError as e:
+        return __form_error_federated_response([], e.status, str(e)), 429, __retryAfterHeaders(e)
+    except Exception as e:
+        return __form_error_federated_response([], "System error", str(e)), 500
+
+#aggregates of the rows selected by query_params computed by the catalog: counts, averages, minimums, maximums and sums of
+#categories, optionally in bins of categories (histograms, HR diagram density), only the aggregate rows are transferred
+@app.route('/aggregate', methods=['POST'])
+def aggregate():
+    try:
+        from DBaccess.Aggregation import Aggregation
+        db_access, db_name, query_params_json, aggregates, bins = __validateAggregateInput(request.data)
+        response_format = NegotiateFormat(request.args.get('format'), request.accept_mimetypes)
+        client = __clientId(request.headers.get('X-Client-Id'), request.remote_addr)
+
+        # only the aggregate rows are transferred, the request is counted among the requests of the client
+        with Admission_Control.Client(client):
+            catalog, query, result = Aggregation().Aggregate(db_access, query_params_json, aggregates, bins)
+        if response_format != Format_Json:
+            return __form_table_response(result, response_format, {"catalog": catalog, "query": query, "status": "success", "error": None})
+
+        return Response(Stage_Metrics.TimedIterator("json_serialization", __form_success_response(catalog, query, result)),
+                        status=200, mimetype='application/json')
+
+    except ValueError as e:
+        return __form_error_response("","", "Input error", str(e)), 400
+    except UpstreamUnavailableError as e:
+        return __form_error_response(e.catalog, e.query, e.status, str(e)), 503, __retryAfterHeaders(e)
+    except RequestProcessingError as e:
+        return __form_error_response(e.catalog, e.query, e.status, str(e)), 401
+    except AdmissionRejectedError as e:
+        return __form_error_response("","", e.status, str(e)), 429, __retryAfterHeaders(e)
+    except Exception as e:
+        return __form_error_response("","","System error", str(e)), 500
+
+#estimated rows of processQuery request and the way it would be answered, the catalog is not requested
+#the body is the same as for processQuery
+@app.route('/estimate', methods=['POST'])
+def estimate():
+    try:
+        db_access, db_name, query_params_json, limit, chunk_size = __validateProcessQueryInput(request.data)
+        cost, route = __routeQuery(db_access, query_params_json, limit, chunk_size)
+        return json.dumps(dict(__form_cost(db_name, cost), route=route, sync_rows_threshold=Admission_Control.sync_rows_threshold), indent=2), 200
+    except ValueError as e:
+        return json.dumps({"status": "Input error", "error": str(e)}, indent=2), 400
+    except Exception as e:
+        return json.dumps({"status": "System error", "error": str(e)}, indent=2), 500
+
+#submit processQuery, crossMatching or aggregate request as a background job, the body is the same as for these endpoints plus job_type
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        job_type, description, job_function, cost = __validateJobInput(request.data)
+        client = __clientId(request.headers.get('X-Client-Id'), request.remote_addr)
+        # the rows of the job are taken from the quota of the client, as for queries rerouted to jobs
+        Admission_Control.Charge(client, cost.rows if cost is not None else 0)
+        job = Job_Manager.Submit(job_type, description, job_function)
+        return json.dumps(job.ToDict(), indent=2), 202, __admissionHeaders(cost, job)
+    except ValueError as e:
+        return json.dumps({"status": "Input error", "error": str(e)}, indent=2), 400
+    except AdmissionRejectedError as e:
+        return json.dumps({"status": e.status, "error": str(e)}, indent=2), 429, __retryAfterHeaders(e)
+    except Exception as e:
+        return json.dumps({"status": "System error", "error": str(e)}, indent=2), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = Job_Manager.Get(job_id)
+    if job is None:
+        return __form_job_not_found_response(job_id), 404
+    return json.dumps(job.ToDict(), indent=2), 200
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = Job_Manager.Cancel(job_id)
+    if job is None:
+        return __form_job_not_found_response(job_id), 404
+    return json.dumps(job.ToDict(), indent=2), 200
+
+#result of the finished job is the same response as processQuery or crossMatching endpoint returns
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = Job_Manager.Get(job_id)
+    if job is None:
+        return __form_job_not_found_response(job_id), 404
+    if job.phase != Phase_Completed:
+        return json.dumps(job.ToDict(), indent=2), 409
+    return job.result, 200
+
+@app.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    return json.dumps(Query_Cache.Stats, indent=2), 200
+
+#number of coalesced requests: leaders request the catalog, followers wait for the leader's result
+@app.route('/singleFlightStats', methods=['GET'])
+def single_flight_stats():
+    return json.dumps(Single_Flight.Stats, indent=2), 200
+
+#stage timings as Prometheus histograms, cache, coalescing, job and store statistics as gauges
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body = (Stage_Metrics.Render() +
+            RenderGauges("stellaris_query_cache", Query_Cache.Stats, "Query cache statistics") +
+            RenderGauges("stellaris_single_flight", Single_Flight.Stats, "Coalesced catalog requests") +
+            RenderGauges("stellaris_async_single_flight", Async_Single_Flight.Stats, "Coalesced catalog requests of the asyncio serving mode") +
+            RenderGauges("stellaris_cpu_pool", Cpu_Pool.Stats, "Worker processes of the asyncio serving mode") +
+            RenderGauges("stellaris_job_manager", Job_Manager.Stats, "Background jobs") +
+            __storeGauges() +
+            RenderGauges("stellaris_admission", Admission_Control.Stats, "Admission control of requests to the catalogs") +
+            RenderGauges("stellaris_cost_estimator", Cost_Estimator.Stats, "Statistics of the catalogs for cost estimation") +
+            RenderGauges("stellaris_upstream", Upstream_Resilience.Stats, "Circuit breakers, latencies and hedged requests of the catalogs") +
+            RenderGauges("stellaris_backends", Backend_Registry.Stats, "Catalog backends registered and built") +
+            RenderGauges("stellaris_startup", dict(Warm_Up.Stats, import_seconds=Import_Seconds), "Import of the API and warm-up of this worker"))
+    return Response(body, status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+#circuit breaker state, error rate, latency percentiles and hedged requests of every catalog
+@app.route('/admin/upstreams', methods=['GET'])
+def upstreams_status():
+    return json.dumps(Upstream_Resilience.Status, indent=2), 200
+
+#force the circuit breaker of the catalog open (requests fail fast or are served stale from the cache) or closed
+#the body is {"state": "open"} or {"state": "closed"}, the new state of the catalog is returned
+@app.route('/admin/upstreams/<catalog>', methods=['POST'])
+def set_upstream_state(catalog):
+    if not Admin_Token:
+        return json.dumps({"status": "Forbidden", "error": "Admin endpoints are disabled, STELLARIS_ADMIN_TOKEN is not set"}, indent=2), 403
+    if not __isAdmin(request.headers.get('Authorization')):
+        return json.dumps({"status": "Forbidden", "error": "Admin token is required"}, indent=2), 403
+    try:
+        state = __validateUpstreamStateInput(request.data)
+        Upstream_Resilience.SetState(catalog.lower(), state)
+        return json.dumps(Upstream_Resilience.StatusOf(catalog.lower()), indent=2), 200
+    except ValueError as e:
+        return json.dumps({"status": "Input error", "error": str(e)}, indent=2), 400
+    except Exception as e:
+        return json.dumps({"status": "System error", "error": str(e)}, indent=2), 500
+
+#gauges of the local catalog and the match store once a request used them, metrics don't import their modules
+def __storeGauges():
+    gauges = ""
+    stellaris_store = sys.modules.get("DBaccess.StellarisStore")
+    if stellaris_store is not None:
+        gauges += RenderGauges("stellaris_local_store", stellaris_store.Stellaris_Store.Stats, "Local catalog")
+    match_store = sys.modules.get("DBaccess.MatchStore")
+    if match_store is not None:
+        gauges += RenderGauges("stellaris_match_store", match_store.Match_Store.Stats, "Stored cross matches of sources")
+    return gauges
+
+#request catalog page by page and yield every page as a line of NDJSON
+#errors raised after the first page is sent can't change the response status, so they are sent as an error line
+def __stream_query_chunks(db_access, query_params_json, limit, chunk_size):
+    try:
+        for catalog, query, result in db_access.QueryCatalogChunks(query_params_json, limit, chunk_size):
+            yield "".join(__form_success_response(catalog, query, result, newline=False)) + "\n"
+    except ValueError as e:
+        yield __form_error_response("","", "Input error", str(e), indent=None) + "\n"
+    except RequestProcessingError as e:
+        yield __form_error_response(e.catalog, e.query, e.status, str(e), indent=None) + "\n"
+    except Exception as e:
+        yield __form_error_response("","","System error", str(e), indent=None) + "\n"
+
+#validate input data for jobs, return function executing the job and estimated cost of the job (None for aggregates,
+#only the aggregate rows are transferred)
+def __validateJobInput(request_data):
+    try:
+        query_json = json.loads(request_data)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON for the request: {request_data}")
+
+    job_type = query_json.get('job_type')
+    if job_type == 'processQuery':
+        db_access, db_name, query_params_json, limit, chunk_size = __validateProcessQueryInput(request_data)
+        __validateJobLimit(job_type, limit)
+        cost = Cost_Estimator.Estimate(db_access, query_params_json, limit)
+        return job_type, db_name, __processQueryJob(db_access, query_params_json, limit, chunk_size), cost
+
+    if job_type == 'crossMatching':
+        db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size, match_policy = __validateCrossMatchingInput(request_data)
+        __validateJobLimit(job_type, limit)
+        def job_function(cancel_event):
+            from DBaccess.CrossMatching import CrossMatching
+            catalog_source, query, catalog_to_match, crossmatch_query, result = CrossMatching().CrossMatching(db_access_src, db_access_to_match, query_params_json, limit, chunk_size, cancel_event, match_policy)
+            return "".join(__form_success_crossmatch_response(catalog_source, query, catalog_to_match, crossmatch_query, result))
+        cost = Cost_Estimator.Estimate(db_access_src, query_params_json, limit)
+        return job_type, f"{db_name_src} x {db_name_to_match}", job_function, cost
+
+    if job_type == 'aggregate':
+        db_access, db_name, query_params_json, aggregates, bins = __validateAggregateInput(request_data)
+        def job_function(cancel_event):
+            from DBaccess.Aggregation import Aggregation
+            catalog, query, result = Aggregation().Aggregate(db_access, query_params_json, aggregates, bins, cancel_event)
+            return "".join(__form_success_response(catalog, query, result))
+        return job_type, db_name, job_function, None
+
+    raise ValueError(f"Not supported job_type: {job_type}, expected processQuery, crossMatching or aggregate")
+
+#jobs return the whole result at once, so they need a limit: chunkSize alone would request all matching rows
+def __validateJobLimit(job_type, limit):
+    if not limit:
+        raise ValueError(f"limit must be specified in query_params of {job_type} job, chunkSize is not used by jobs")
+    if limit > Max_Job_Rows:
+        raise ValueError(f"limit of {job_type} job can't be greater than {Max_Job_Rows}, request bigger results with chunkSize")
+
+def __processQueryJob(db_access, query_params_json, limit, chunk_size):
+    def job_function(cancel_event):
+        catalog, query, result = db_access.QueryCatalogAsyncJob(query_params_json, limit, chunk_size, cancel_event)
+        return "".join(__form_success_response(catalog, query, result))
+    return job_function
+
+#estimated cost of processQuery request (None for catalogs answering any query quickly) and its route:
+#sync response, chunked response or background job when the query is estimated to return more rows than a sync response may have
+def __routeQuery(db_access, query_params_json, limit, chunk_size):
+    cost = Cost_Estimator.Estimate(db_access, query_params_json, limit)
+    if chunk_size:
+        return cost, Route_Chunked
+    if cost is not None and cost.rows > Admission_Control.sync_rows_threshold:
+        return cost, Route_Job
+    return cost, Route_Sync
+
+#estimated rows of federated query taken from the quota of the client: the sum of estimated rows of its catalogs
+def __federatedRows(catalogs, query_params_json, limit):
+    costs = [Cost_Estimator.Estimate(db_access, query_params_json, limit) for db_access in catalogs]
+    return sum(cost.rows for cost in costs if cost is not None)
+
+#client of the request for quotas: the address of the client, or X-Client-Id header set by a trusted proxy
+def __clientId(client_header, remote_addr):
+    if client_header and remote_addr in Trusted_Proxies:
+        return client_header
+    return remote_addr or "unknown"
+
+def __admissionHeaders(cost, job=None):
+    headers = {}
+    if cost is not None:
+        headers['X-Estimated-Rows'] = str(cost.rows)
+    if job is not None:
+        headers['Location'] = f"/jobs/{job.job_id}"
+    return headers
+
+def __retryAfterHeaders(error):
+    return {'Retry-After': str(max(1, math.ceil(error.retry_after)))}
+
+def __isAdmin(authorization):
+    if not Admin_Token:
+        return False
+    return hmac.compare_digest((authorization or "").encode("utf-8"), f"Bearer {Admin_Token}".encode("utf-8"))
+
+#validate input data for set_upstream_state
+def __validateUpstreamStateInput(request_data):
+    try:
+        state_json = json.loads(request_data)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON for the request: {request_data}")
+    if not isinstance(state_json, dict) or not state_json.get("state"):
+        raise ValueError("Missing field: state")
+    return str(state_json["state"]).lower()
+
 #validate input data for process_query
-def __validateProcessQueryInput(request_data) -> tuple[DB_CLASSES, Any, Any, int, int]: #protected(_)
+def __validateProcessQueryInput(request_data) -> tuple[DBAccessBase, Any, Any, int, int]: #protected(_)
     # convert JSON input string to a dictionary
     try:
         query_json = json.loads(request_data)
@@ -85,7 +479,8 @@ def __validateProcessQueryInput(request_data) -> tuple[DB_CLASSES, Any, Any, int
     return db_access, db_name, query_params_json, limit, chunk_size
 
 #validate input data for cross_matching, extract
-def __validateCrossMatchingInput(request_data) -> tuple[DB_CLASSES, Any, DB_CLASSES, Any, Any, int, int]: #protected(_)
+def __validateCrossMatchingInput(request_data) -> tuple[DBAccessBase, Any, DBAccessBase, Any, Any, int, int, str]: #protected(_)
+    from DBaccess.CrossMatching import Match_Best, Match_Policies
     # convert JSON input string to a dictionary
     try:
         query_json = json.loads(request_data)
@@ -95,25 +490,104 @@ def __validateCrossMatchingInput(request_data) -> tuple[DB_CLASSES, Any, DB_CLAS
     # Extract database name
     db_access_src, db_name_src = __validateDBName(query_json, 'db_name_src')
 
-    #db_access_to_match, db_name_to_match = query_json.get('db_name_to_match')
-    #hardcode matching DB name, in future it will be passed from client side
-    db_name_to_match = 'simbad'
-    db_access_to_match = DB_CLASSES.get(db_name_to_match)
+    #catalog to match is SIMBAD (remote cross match) or a catalog with local rows, cross matched in process
+    db_name_to_match = str(query_json.get('db_name_to_match') or 'simbad').lower()
+    db_access_to_match = __getBackend(db_name_to_match)
+    if db_name_to_match != 'simbad' and not db_access_to_match.HasLocalRows:
+        raise ValueError(f"Cross matching with {db_name_to_match} is not supported, expected simbad or a local catalog")
 
     query_params_json, limit, chunk_size = __validateQueryParams(query_json)
 
-    return db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size
+    # best: the nearest SIMBAD object of every source, all: every object within the match radius,
+    # identifiers: every object with the list of its identifiers
+    match_policy = query_json.get('match_policy') or Match_Best
+    if match_policy not in Match_Policies:
+        raise ValueError(f"Not supported match_policy: {match_policy}, expected one of {', '.join(Match_Policies)}")
+
+    return db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size, match_policy
+
+#validate input data for aggregate: db_name, query_params filters (limit is not needed), aggregates and bins
+def __validateAggregateInput(request_data):
+    from DBaccess.Aggregation import ParseAggregates, ParseBins
+    try:
+        query_json = json.loads(request_data)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON for the request: {request_data}")
+
+    db_access, db_name = __validateDBName(query_json, 'db_name')
+
+    query_params = query_json.get('query_params') or "{}"
+    try:
+        query_params_json = json.loads(query_params) if isinstance(query_params, str) else query_params
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON for query parameters: {query_params}")
+    if not isinstance(query_params_json, dict):
+        raise ValueError(f"Invalid query parameters: {query_params}")
+
+    aggregates = ParseAggregates(query_json.get('aggregates'))
+    bins = ParseBins(query_json.get('bins'))
+    return db_access, db_name, query_params_json, aggregates, bins
+
+#validate input data for federated_query, extract DBAccess of every catalog, merge mode and timeouts of the catalogs
+def __validateFederatedQueryInput(request_data):
+    from DBaccess.FederatedQuery import Merge_Side_By_Side, Merge_Modes
+    try:
+        query_json = json.loads(request_data)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON for the request: {request_data}")
+
+    db_names = query_json.get('db_names')
+    if not db_names or not isinstance(db_names, list):
+        raise ValueError("Absent 'db_names' list in the request")
+    catalogs = []
+    for db_name in db_names:
+        db_access = __getBackend(db_name)
+        if db_access not in catalogs:
+            catalogs.append(db_access)
+
+    merge = str(query_json.get('merge') or Merge_Side_By_Side).lower()
+    if merge not in Merge_Modes:
+        raise ValueError(f"Not supported merge: {merge}, expected one of {', '.join(Merge_Modes)}")
+
+    # timeout is seconds for every catalog or {db_name: seconds}, catalogs without it wait for the default timeout
+    timeout = query_json.get('timeout')
+    if timeout is None:
+        timeouts = {}
+    elif isinstance(timeout, dict):
+        timeouts = {str(db_name).lower(): seconds for db_name, seconds in timeout.items()}
+    else:
+        timeouts = {db_access.Catalog: timeout for db_access in catalogs}
+    for db_name, seconds in timeouts.items():
+        try:
+            timeouts[db_name] = float(seconds)
+        except Exception:
+            raise ValueError(f"Cannot convert to number timeout value of {db_name}: {seconds}")
+        if timeouts[db_name] <= 0:
+            raise ValueError(f"Timeout of {db_name} must be positive: {seconds}")
+
+    query_params_json, limit, chunk_size = __validateQueryParams(query_json)
+    if not limit:
+        raise ValueError("limit must be specified in query_params of federated query")
+
+    return catalogs, query_params_json, limit, merge, timeouts
 
 #validate input string to make sure that it contains db name, extract it and get corresponding DBAccess
-def __validateDBName(query_json, db_name_key) -> tuple [DB_CLASSES, Any]:
+def __validateDBName(query_json, db_name_key) -> tuple [DBAccessBase, Any]:
     db_name_value = query_json.get(db_name_key)
     if not db_name_value:
         raise ValueError(f"Absent {db_name_key} in the request")
 
-    db_access = DB_CLASSES.get(db_name_value.lower())
-    if not db_name_value:
-        raise ValueError("Not supported DB name: {db_name_value}")
-    return db_access, db_name_value
+    return __getBackend(db_name_value), db_name_value
+
+#backend of the catalog, an unknown catalog or one whose backend fails to build is an error of the request
+def __getBackend(db_name) -> DBAccessBase:
+    try:
+        db_access = Backend_Registry.Get(str(db_name))
+    except Exception as e:
+        raise ValueError(f"DB {db_name} is not available: {e}")
+    if db_access is None:
+        raise ValueError(f"Not supported DB name: {db_name}")
+    return db_access
 
 #validate query_params json from input data, load query_params string to json, extract limit, chunk_size
 def __validateQueryParams(query_json) -> tuple[Any, int, int]:
@@ -146,17 +620,17 @@ def __validateQueryParams(query_json) -> tuple[Any, int, int]:
 
     return query_params_json, limit, chunk_size
 
-def __form_success_response (catalog, query, columns, data):
-    return json.dumps({
+#success response is produced piece by piece from the query result, NaN and masked values become null
+def __form_success_response (catalog, query, result, newline=True):
+    return JsonResponse({
         "catalog": catalog,
-        "query": query,
-        "columns": columns,
-        "data": data,
+        "query": query
+    }, result, {
         "status": "success",
         "error": None
-    }, cls=NumpyEncoder, indent=2)
+    }, newline)
 
-def __form_error_response(catalog, query, status, error_message):
+def __form_error_response(catalog, query, status, error_message, indent=2):
     return json.dumps({
         "catalog": catalog,
         "query": query,
@@ -164,19 +638,18 @@ def __form_error_response(catalog, query, status, error_message):
         "data": [],
         "status": status,
         "error": error_message
-    }, indent=2)
+    }, indent=indent)
 
-def __form_success_crossmatch_response (catalog_source, query, catalog_to_match, crossmatch_query, columns, data):
-    return json.dumps({
+def __form_success_crossmatch_response (catalog_source, query, catalog_to_match, crossmatch_query, result):
+    return JsonResponse({
         "catalog_source": catalog_source,
         "query_source": query,
         "catalog_to_match": catalog_to_match,
-        "crossmatch_query": crossmatch_query,
-        "columns": columns,
-        "data": data,
+        "crossmatch_query": crossmatch_query
+    }, result, {
         "status": "success",
         "error": None
-    }, cls=NumpyEncoder, indent=2)
+    })
 
 def __form_error_crossmatch_response(catalog_source, query, catalog_to_match, crossmatch_query, status, error_message):
     return json.dumps({
@@ -190,23 +663,51 @@ def __form_error_crossmatch_response(catalog_source, query, catalog_to_match, cr
         "error": error_message
     }, indent=2)
 
-#Replace NaN values in the data with None since JSON does not recognize NaN
-def replace_nan_with_none(data):
-    if isinstance(data, list):
-        return [replace_nan_with_none(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: replace_nan_with_none(value) for key, value in data.items()}
-    elif isinstance(data, float) and np.isnan(data):
-        return None
-    else:
-        return data
+#response fields before and after the results: every catalog's status, error and filters it ignored
+#status is success when all catalogs answered and partial when some of them failed
+def __federated_envelope(catalog_results, merge):
+    from DBaccess.FederatedQuery import Merge_Position, Status_Success
+    head = {"merge": merge}
+    if merge == Merge_Position:
+        head["catalogs"] = [catalog_result.ToDict() for catalog_result in catalog_results]
+    status = "success" if all(catalog_result.status == Status_Success for catalog_result in catalog_results) else "partial"
+    return head, {"status": status, "error": None}
+
+def __form_error_federated_response(catalogs, status, error_message):
+    return json.dumps({
+        "catalogs": catalogs,
+        "columns": [],
+        "data": [],
+        "status": status,
+        "error": error_message
+    }, indent=2)
+
+#response with the result table serialized into columnar JSON, VOTable, Arrow or Parquet
+def __form_table_response(result, response_format, envelope):
+    body, mimetype = SerializeTable(result, response_format, envelope)
+    return Response(body, status=200, mimetype=mimetype)
+
+def __form_cost(db_name, cost):
+    if cost is None:
+        return {"catalog": db_name, "estimated_rows": None, "matching_rows": None, "basis": None}
+    return cost.ToDict()
+
+#processQuery rerouted to a background job: the job and the estimate of the rows which made it too big for a sync response
+def __form_rerouted_response(job, cost):
+    return json.dumps(dict(job.ToDict(), **__form_cost(job.description, cost),
+                           reason=f"Estimated {cost.rows} rows is more than {Admission_Control.sync_rows_threshold}, the query runs as a background job"), indent=2)
+
+def __form_job_not_found_response(job_id):
+    return json.dumps({
+        "job_id": job_id,
+        "status": "Not found",
+        "error": f"Job {job_id} does not exist or is expired"
+    }, indent=2)
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, 'item'):  # Convert numpy types
-            return obj.item()
-        return super().default(obj)
+# seconds the import of this module took, the heavy modules are not included
+Import_Seconds = time.perf_counter() - Import_Started
 
-# Run the Flask app
+# Run the Flask app, the development server; API/StellarisASGI.py is the production serving mode
 if __name__ == '__main__':
+    Warm_Up.Start()
     app.run(debug=True)
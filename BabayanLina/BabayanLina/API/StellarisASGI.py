@@ -0,0 +1,353 @@
+import asyncio
+import os
+import sys
+import time
+from urllib.parse import parse_qs
+
+# Add the root directory to sys.path
+Root_Dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(Root_Dir)
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import API.StellarisAPI as StellarisAPI
+from API.StellarisAPI import app as flask_app
+from API.ResponseFormats import NegotiateFormat, SerializeBody, SerializeResultsBody, Mime_Types, Format_Json, Format_Columnar
+from API.Compression import NegotiateEncoding, StreamCompressor
+from DBaccess.AsyncHttpTransport import Async_Http_Transport
+from DBaccess.CpuPool import Cpu_Pool
+from DBaccess.StageMetrics import Stage_Metrics
+from DBaccess.CostEstimator import Cost_Estimator
+from DBaccess.AdmissionControl import Admission_Control
+from DBaccess.JobManager import Job_Manager
+from API.Warmup import Warm_Up, Warmup_Mode, Warmup_Startup, Warmup_Background
+from DBaccess.RequestProcessingError import RequestProcessingError
+from DBaccess.RequestProcessingError import CrossMatchRequestProcessingError
+from DBaccess.RequestProcessingError import AdmissionRejectedError
+from DBaccess.RequestProcessingError import UpstreamUnavailableError
+
+# Asyncio serving mode of StellarisAPI
+# /processQuery, /crossMatching, /federatedQuery and /aggregate are served by asyncio handlers: requests to the catalogs are awaited on one event
+# loop, no thread waits for them, and CPU-heavy steps (VOTable decoding, epoch propagation, cross match join,
+# serialization and compression of big responses) run in worker processes of Cpu_Pool. All other routes (jobs,
+# statistics, metrics, CORS preflight) are served by the Flask application in a thread.
+# Run it with the launcher at the end of this file or with any ASGI server:
+#   python API/StellarisASGI.py
+#   uvicorn API.StellarisASGI:app --workers 4 --port 5000     (from the directory containing API)
+# Every server worker is a separate process with its own caches, metrics and background jobs, so /jobs/<job_id>
+# works only when requests of the client reach the worker which created the job (one worker or sticky sessions).
+# Workers import only the light API modules, so they start quickly; STELLARIS_WARMUP (API/Warmup.py) decides whether
+# the heavy modules are loaded in the background after the start (default), before the worker serves, or on demand.
+
+# launcher settings, overridden by environment variables
+Serve_Host = os.environ.get("STELLARIS_HOST", "127.0.0.1")
+Serve_Port = int(os.environ.get("STELLARIS_PORT", "5000"))
+# server worker processes, every one runs an event loop; the number of CPUs by default
+Serve_Workers = int(os.environ.get("STELLARIS_WORKERS") or os.cpu_count() or 1)
+# connections kept waiting for accept while all workers are busy
+Serve_Backlog = 2048
+# requests served at the same time by a worker, the server answers 503 above it; unlimited by default
+Serve_Max_Concurrency = int(os.environ["STELLARIS_MAX_CONCURRENCY"]) if os.environ.get("STELLARIS_MAX_CONCURRENCY") else None
+
+Flask_Routes = WsgiToAsgi(flask_app)
+
+
+# Request parsed from ASGI scope, the body is read completely
+class AsgiRequest:
+    def __init__(self, scope, body):
+        self.Method = scope["method"]
+        self.Path = scope["path"]
+        self.Args = {name: values[-1] for name, values in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        self.Headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+        self.RemoteAddr = (scope.get("client") or (None,))[0]
+        self.Body = body
+
+    @property
+    def AcceptMimetypes(self):
+        return parse_accept_header(self.Headers.get("accept"), MIMEAccept)
+
+    @property
+    def AcceptEncodings(self):
+        return parse_accept_header(self.Headers.get("accept-encoding"))
+
+    @classmethod
+    async def Read(cls, scope, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return cls(scope, bytes(body))
+
+
+# ASGI application: asyncio handlers of query endpoints, everything else goes to Flask
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    handler = Async_Routes.get((scope.get("method"), scope.get("path")))
+    if scope["type"] != "http" or handler is None:
+        await Flask_Routes(scope, receive, send)
+        return
+    await _serve(scope, receive, send, handler)
+
+
+# Handlers return (status, mimetype, body, encoding) or (status, mimetype, body, encoding, headers): body is bytes or
+# an async iterator of bytes, encoding is Content-Encoding of the body or None, headers are additional response headers
+async def process_query(request):
+    try:
+        db_access, db_name, query_params_json, limit, chunk_size = StellarisAPI.__validateProcessQueryInput(request.Body)
+        response_format = NegotiateFormat(request.Args.get('format'), request.AcceptMimetypes)
+        encoding = NegotiateEncoding(request.AcceptEncodings)
+        client = StellarisAPI.__clientId(request.Headers.get("x-client-id"), request.RemoteAddr)
+        cost, route = StellarisAPI.__routeQuery(db_access, query_params_json, limit, chunk_size)
+        estimated_rows = cost.rows if cost is not None else 0
+
+        # too many rows for a synchronous response: the query runs as a background job in a thread, the client polls /jobs/<job_id>
+        if route == StellarisAPI.Route_Job:
+            StellarisAPI.__validateJobLimit('processQuery', limit)
+            Admission_Control.Charge(client, estimated_rows)
+            job = Job_Manager.Submit('processQuery', db_name, StellarisAPI.__processQueryJob(db_access, query_params_json, limit, chunk_size))
+            return 202, 'application/json', StellarisAPI.__form_rerouted_response(job, cost).encode("utf-8"), None, StellarisAPI.__admissionHeaders(cost, job)
+
+        # chunked mode: every page is sent as a separate NDJSON line as soon as it is received
+        if route == StellarisAPI.Route_Chunked:
+            Admission_Control.Charge(client, estimated_rows)
+            return 200, 'application/x-ndjson', _streamQueryChunks(db_access, query_params_json, limit, chunk_size, encoding), encoding, StellarisAPI.__admissionHeaders(cost)
+
+        with Admission_Control.Client(client, estimated_rows):
+            catalog, query, result = await db_access.QueryCatalogAsync(query_params_json, limit, chunk_size)
+        return await _tableResponse(result, response_format, {"catalog": catalog, "query": query}, encoding) + (StellarisAPI.__admissionHeaders(cost),)
+
+    except ValueError as e:
+        return _errorResponse(400, StellarisAPI.__form_error_response("","", "Input error", str(e)))
+    except UpstreamUnavailableError as e:
+        return _errorResponse(503, StellarisAPI.__form_error_response(e.catalog, e.query, e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except RequestProcessingError as e:
+        return _errorResponse(401, StellarisAPI.__form_error_response(e.catalog, e.query, e.status, str(e)))
+    except AdmissionRejectedError as e:
+        return _errorResponse(429, StellarisAPI.__form_error_response("","", e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except Exception as e:
+        return _errorResponse(500, StellarisAPI.__form_error_response("","","System error", str(e)))
+
+
+async def cross_matching(request):
+    try:
+        from DBaccess.CrossMatching import CrossMatching
+        db_access_src, db_name_src, db_access_to_match, db_name_to_match, query_params_json, limit, chunk_size, match_policy = StellarisAPI.__validateCrossMatchingInput(request.Body)
+        response_format = NegotiateFormat(request.Args.get('format'), request.AcceptMimetypes)
+        encoding = NegotiateEncoding(request.AcceptEncodings)
+        client = StellarisAPI.__clientId(request.Headers.get("x-client-id"), request.RemoteAddr)
+        cost = Cost_Estimator.Estimate(db_access_src, query_params_json, limit)
+
+        with Admission_Control.Client(client, cost.rows if cost is not None else 0):
+            catalog_source, query, catalog_to_match, crossmatch_query, result = await CrossMatching().CrossMatchingAsync(db_access_src, db_access_to_match, query_params_json, limit, chunk_size, match_policy)
+        return await _tableResponse(result, response_format, {"catalog_source": catalog_source, "query_source": query,
+                                                              "catalog_to_match": catalog_to_match, "crossmatch_query": crossmatch_query}, encoding)
+
+    except ValueError as e:
+        return _errorResponse(400, StellarisAPI.__form_error_crossmatch_response("","", "","", "Input error", str(e)))
+    except UpstreamUnavailableError as e:
+        return _errorResponse(503, StellarisAPI.__form_error_crossmatch_response(e.catalog, e.query, "", "", e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except CrossMatchRequestProcessingError as e:
+        return _errorResponse(401, StellarisAPI.__form_error_crossmatch_response(e.catalog_source, e.query, e.catalog_to_match, e.crossmatch_query, e.status, str(e)))
+    except AdmissionRejectedError as e:
+        return _errorResponse(429, StellarisAPI.__form_error_crossmatch_response("","", "","", e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except Exception as e:
+        return _errorResponse(500, StellarisAPI.__form_error_crossmatch_response("","", "", "", "System error", str(e)))
+
+
+# catalogs are awaited together, every one with its own timeout
+async def federated_query(request):
+    try:
+        from DBaccess.FederatedQuery import FederatedQuery, Merge_Side_By_Side, Merge_Position
+        catalogs, query_params_json, limit, merge, timeouts = StellarisAPI.__validateFederatedQueryInput(request.Body)
+        response_format = NegotiateFormat(request.Args.get('format'), request.AcceptMimetypes)
+        encoding = NegotiateEncoding(request.AcceptEncodings)
+        if merge == Merge_Side_By_Side and response_format not in (Format_Json, Format_Columnar):
+            raise ValueError(f"Results side by side can't be returned in {response_format} format, use merge={Merge_Position}")
+        client = StellarisAPI.__clientId(request.Headers.get("x-client-id"), request.RemoteAddr)
+
+        with Admission_Control.Client(client, StellarisAPI.__federatedRows(catalogs, query_params_json, limit)):
+            catalog_results, result = await FederatedQuery().QueryAsync(catalogs, query_params_json, limit, merge, timeouts)
+        head, tail = StellarisAPI.__federated_envelope(catalog_results, merge)
+        if merge == Merge_Position:
+            return await _tableResponse(result, response_format, head, encoding, tail)
+
+        results = [(catalog_result.ToDict(), catalog_result.result) for catalog_result in catalog_results]
+        rows = sum(len(catalog_result.result) for catalog_result in catalog_results if catalog_result.result is not None)
+        with Stage_Metrics.Stage(f"{response_format}_serialization") as stage:
+            body, body_encoding = await Cpu_Pool.Run(SerializeResultsBody, head, results, tail, response_format, encoding, rows=rows)
+            stage.Rows = rows
+            stage.Bytes = len(body)
+        return 200, Mime_Types[response_format], body, body_encoding
+
+    except ValueError as e:
+        return _errorResponse(400, StellarisAPI.__form_error_federated_response([], "Input error", str(e)))
+    except RequestProcessingError as e:
+        return _errorResponse(401, StellarisAPI.__form_error_federated_response(e.catalog.split(", "), e.status, str(e)))
+    except AdmissionRejectedError as e:
+        return _errorResponse(429, StellarisAPI.__form_error_federated_response([], e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except Exception as e:
+        return _errorResponse(500, StellarisAPI.__form_error_federated_response([], "System error", str(e)))
+
+
+# aggregate queries of several object types are awaited together
+async def aggregate(request):
+    try:
+        from DBaccess.Aggregation import Aggregation
+        db_access, db_name, query_params_json, aggregates, bins = StellarisAPI.__validateAggregateInput(request.Body)
+        response_format = NegotiateFormat(request.Args.get('format'), request.AcceptMimetypes)
+        encoding = NegotiateEncoding(request.AcceptEncodings)
+        client = StellarisAPI.__clientId(request.Headers.get("x-client-id"), request.RemoteAddr)
+
+        with Admission_Control.Client(client):
+            catalog, query, result = await Aggregation().AggregateAsync(db_access, query_params_json, aggregates, bins)
+        return await _tableResponse(result, response_format, {"catalog": catalog, "query": query}, encoding)
+
+    except ValueError as e:
+        return _errorResponse(400, StellarisAPI.__form_error_response("","", "Input error", str(e)))
+    except UpstreamUnavailableError as e:
+        return _errorResponse(503, StellarisAPI.__form_error_response(e.catalog, e.query, e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except RequestProcessingError as e:
+        return _errorResponse(401, StellarisAPI.__form_error_response(e.catalog, e.query, e.status, str(e)))
+    except AdmissionRejectedError as e:
+        return _errorResponse(429, StellarisAPI.__form_error_response("","", e.status, str(e)), StellarisAPI.__retryAfterHeaders(e))
+    except Exception as e:
+        return _errorResponse(500, StellarisAPI.__form_error_response("","","System error", str(e)))
+
+
+# (method, path) -> asyncio handler and its endpoint name in metrics, the same names as Flask endpoints
+Async_Routes = {
+    ("POST", "/processQuery"): (process_query, "process_query"),
+    ("POST", "/crossMatching"): (cross_matching, "cross_matching"),
+    ("POST", "/federatedQuery"): (federated_query, "federated_query"),
+    ("POST", "/aggregate"): (aggregate, "aggregate"),
+}
+
+
+# run the handler of the request and send its response, the handler is cancelled when the client disconnects
+# (waiting for catalogs stops and SIMBAD jobs are aborted)
+async def _serve(scope, receive, send, route):
+    handler, endpoint = route
+    request = await AsgiRequest.Read(scope, receive)
+    if request is None:
+        return
+    request_start = time.perf_counter()
+    timings = Stage_Metrics.StartRequest()
+
+    disconnected = asyncio.ensure_future(_waitForDisconnect(receive))
+    handling = asyncio.ensure_future(handler(request))
+    try:
+        await asyncio.wait({handling, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        if not handling.done():
+            handling.cancel()
+            return
+        status, mimetype, body, encoding, *extra_headers = handling.result()
+
+        seconds = time.perf_counter() - request_start
+        headers = [(b"content-type", mimetype.encode("latin-1")),
+                   (b"vary", b"Accept-Encoding"),
+                   (b"server-timing", timings.ServerTiming(seconds).encode("latin-1")),
+                   (b"timing-allow-origin", b"*"),
+                   (b"access-control-allow-origin", b"*"),
+                   (b"access-control-expose-headers", b"Server-Timing, X-Estimated-Rows, Retry-After, Location")]
+        if encoding is not None:
+            headers.append((b"content-encoding", encoding.encode("latin-1")))
+        for name, value in (extra_headers[0] if extra_headers else {}).items():
+            headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+        Stage_Metrics.ObserveRequest(endpoint, status, seconds)
+
+        if isinstance(body, bytes):
+            headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        async for chunk in body:
+            # the client is gone, the rest of the pages is not requested
+            if disconnected.done():
+                await body.aclose()
+                return
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+
+
+async def _waitForDisconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+# whole result serialized in a worker process, compression is done there too
+async def _tableResponse(result, response_format, head, encoding, tail=None):
+    with Stage_Metrics.Stage(f"{response_format}_serialization") as stage:
+        body, body_encoding = await Cpu_Pool.Run(SerializeBody, result, response_format, head, tail or {"status": "success", "error": None}, encoding, rows=len(result))
+        stage.Rows = len(result)
+        stage.Bytes = len(body)
+    return 200, Mime_Types[response_format], body, body_encoding
+
+
+def _errorResponse(status, body, headers=None):
+    return status, 'application/json', body.encode("utf-8"), None, headers or {}
+
+
+# request catalog page by page and yield every page as a line of NDJSON, compressed and flushed page by page
+# errors raised after the first page is sent can't change the response status, so they are sent as an error line
+async def _streamQueryChunks(db_access, query_params_json, limit, chunk_size, encoding):
+    compressor = StreamCompressor(encoding, flush_every_chunk=True) if encoding is not None else None
+    async for line in _queryChunkLines(db_access, query_params_json, limit, chunk_size):
+        yield compressor.Compress(line) if compressor is not None else line
+    if compressor is not None:
+        yield compressor.Finish()
+
+
+async def _queryChunkLines(db_access, query_params_json, limit, chunk_size):
+    tail = {"status": "success", "error": None}
+    try:
+        async for catalog, query, result in db_access.QueryCatalogChunksAsync(query_params_json, limit, chunk_size):
+            with Stage_Metrics.Stage("json_serialization") as stage:
+                line, _ = await Cpu_Pool.Run(SerializeBody, result, Format_Json, {"catalog": catalog, "query": query}, tail, None, False, rows=len(result))
+                stage.Bytes = len(line)
+            yield line + b"\n"
+    except ValueError as e:
+        yield (StellarisAPI.__form_error_response("","", "Input error", str(e), indent=None) + "\n").encode("utf-8")
+    except RequestProcessingError as e:
+        yield (StellarisAPI.__form_error_response(e.catalog, e.query, e.status, str(e), indent=None) + "\n").encode("utf-8")
+    except Exception as e:
+        yield (StellarisAPI.__form_error_response("","","System error", str(e), indent=None) + "\n").encode("utf-8")
+
+
+# shared clients and worker processes are closed when the server stops
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # heavy modules and catalog backends are loaded by the warm-up, Cpu_Pool workers import theirs when started
+            if Warmup_Mode == Warmup_Startup:
+                await asyncio.to_thread(Warm_Up.Run)
+            elif Warmup_Mode == Warmup_Background:
+                Warm_Up.Start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await Async_Http_Transport.Close()
+            Cpu_Pool.Shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# Multi-worker launcher: uvicorn with Serve_Workers processes, every one runs an event loop (uvloop and httptools are
+# used when they are installed). CPUs are shared by server workers and their Cpu_Pool processes, so every server worker
+# gets its part of them unless STELLARIS_CPU_WORKERS is set.
+if __name__ == '__main__':
+    import uvicorn
+
+    os.environ.setdefault("STELLARIS_CPU_WORKERS", str(max(1, (os.cpu_count() or 1) // Serve_Workers)))
+    uvicorn.run("API.StellarisASGI:app", app_dir=Root_Dir, host=Serve_Host, port=Serve_Port, workers=Serve_Workers,
+                backlog=Serve_Backlog, limit_concurrency=Serve_Max_Concurrency, timeout_keep_alive=5, lifespan="on")
@@ -0,0 +1,82 @@
+import importlib
+import os
+import threading
+import time
+
+from DBaccess.BackendRegistry import Backend_Registry
+
+# modules of the code paths which need numpy, astropy and pyvo; the API imports them on the first request needing them,
+# the warm-up imports them before
+Heavy_Modules = [
+    "numpy", "astropy.table", "astropy.units", "astropy.io.votable", "pyvo",
+    "DBaccess.VOTableStream", "DBaccess.QueryResult", "DBaccess.CrossMatching", "DBaccess.Aggregation",
+    "DBaccess.FederatedQuery", "DBaccess.MatchStore", "DBaccess.StellarisStore",
+]
+
+# STELLARIS_WARMUP: background - the worker serves at once and the warm-up runs in a thread, startup - the worker
+# serves when the warm-up is finished, off - the first requests import what they need
+Warmup_Background = "background"
+Warmup_Startup = "startup"
+Warmup_Off = "off"
+Warmup_Modes = [Warmup_Background, Warmup_Startup, Warmup_Off]
+Warmup_Mode = (os.environ.get("STELLARIS_WARMUP") or Warmup_Background).lower()
+
+
+# Warm-up of a server worker: heavy modules are imported, catalog backends are built and the SIMBAD TAP service is
+# created, so the first requests of the worker don't wait for them. Server workers are started by forking or spawning
+# a process which imported only the light API modules; every worker runs its warm-up once after it is started
+# (StellarisASGI runs it from the lifespan startup, other servers call Warm_Up.Run or Warm_Up.Start in their worker
+# start hook, for example gunicorn post_fork). Failures are kept in Stats, the requests needing the module fail later.
+class Warmup:
+    def __init__(self, modules=None):
+        self.modules = list(modules or Heavy_Modules)
+        self._lock = threading.Lock()
+        self._started = False
+        self._finished = threading.Event()
+        self._seconds = None
+        self._errors = {}
+
+    # run the warm-up in the calling thread, it runs once per process, later calls wait until it is finished
+    def Run(self):
+        with self._lock:
+            started, self._started = self._started, True
+        if started:
+            self._finished.wait()
+            return
+
+        start = time.perf_counter()
+        errors = {}
+        for module in self.modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                errors[module] = str(e)
+        errors.update(Backend_Registry.Warm())
+        try:
+            from DBaccess.CrossMatching import SimbadTap
+            SimbadTap()
+        except Exception as e:
+            errors["simbad_tap"] = str(e)
+
+        with self._lock:
+            self._errors = errors
+            self._seconds = time.perf_counter() - start
+        self._finished.set()
+
+    # run the warm-up in a daemon thread, the worker serves requests meanwhile
+    def Start(self):
+        threading.Thread(target=self.Run, name="stellaris-warmup", daemon=True).start()
+
+    @property
+    def Stats(self):
+        with self._lock:
+            return {"finished": int(self._finished.is_set()), "seconds": self._seconds or 0.0, "errors": len(self._errors)}
+
+    @property
+    def Errors(self):
+        with self._lock:
+            return dict(self._errors)
+
+
+# Warm-up of this process
+Warm_Up = Warmup()
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# relative slowdown of median time reported as a regression
+Default_Regression_Threshold = 0.10
+Default_Results_Dir = "benchmark_results"
+
+
+# run function repeat times and return its timings, the result of the last run is returned too
+def measure(function, repeat=3, warmup=0):
+    for _ in range(warmup):
+        function()
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return result, {"seconds_min": min(seconds), "seconds_median": statistics.median(seconds),
+                    "seconds_mean": statistics.fmean(seconds), "repeat": repeat}
+
+
+# one benchmark result: name of the stage, number of rows and timings, extra fields are stored as they are
+def makeRecord(name, rows, timings, **extra):
+    record = {"name": name, "rows": rows}
+    record.update(timings)
+    record.update(extra)
+    return record
+
+
+# write results as JSON together with the environment they were measured in, return the file path
+def saveResults(suite, records, output=None):
+    if output is None:
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(Default_Results_Dir, f"{suite}-{timestamp}.json")
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    document = {
+        "suite": suite,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _gitCommit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": records,
+    }
+    with open(output, "w") as file:
+        json.dump(document, file, indent=2)
+    return output
+
+
+def loadResults(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+# compare median times of the same (name, rows) benchmarks, return rows of the comparison and the regressions
+def compareResults(baseline, current, threshold=Default_Regression_Threshold):
+    baseline_records = {(record["name"], record["rows"]): record for record in baseline["results"]}
+    comparison = []
+    regressions = []
+    for record in current["results"]:
+        key = (record["name"], record["rows"])
+        if key not in baseline_records:
+            continue
+        before = baseline_records[key]["seconds_median"]
+        after = record["seconds_median"]
+        change = (after - before) / before if before > 0 else 0.0
+        row = {"name": record["name"], "rows": record["rows"], "baseline": before, "current": after, "change": change}
+        comparison.append(row)
+        if change > threshold:
+            regressions.append(row)
+    return comparison, regressions
+
+
+def printRecords(records):
+    for record in records:
+        print(f"{record['name']:<28} {record['rows']:>8} rows: median {record['seconds_median']:.4f} s, "
+              f"min {record['seconds_min']:.4f} s")
+
+
+def _gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files, exit with 1 on regressions")
+    parser.add_argument("baseline", help="results file to compare with")
+    parser.add_argument("current", help="new results file")
+    parser.add_argument("--threshold", type=float, default=Default_Regression_Threshold,
+                        help="relative slowdown of median time reported as a regression")
+    args = parser.parse_args()
+
+    comparison, regressions = compareResults(loadResults(args.baseline), loadResults(args.current), args.threshold)
+    for row in comparison:
+        marker = "  REGRESSION" if row in regressions else ""
+        print(f"{row['name']:<28} {row['rows']:>8} rows: {row['baseline']:.4f} s -> {row['current']:.4f} s "
+              f"({row['change']:+.1%}){marker}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmarks.BenchmarkResults import measure, makeRecord, saveResults, printRecords
+from Benchmarks.EndToEndBenchmark import redirectCatalogs
+from DBaccess.QueryCache import Query_Cache
+from DBaccess.AdmissionControl import Admission_Control
+from API.StellarisAPI import app as flask_app
+from API.StellarisASGI import app as asgi_app
+
+Default_Concurrency = [50, 200, 500]
+Stand_In_Port = 8766
+Api_Port = 5050
+
+# every request gets its own TOP, so no request is answered from the cache or coalesced with another one
+_query_numbers = itertools.count()
+
+
+# stand-in server running in its own process, so threads and CPU time of the API process are measured alone
+class StandInProcess:
+    def __init__(self, rows, latency, port=Stand_In_Port):
+        self._port = port
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TapStandIn.py")
+        self._process = subprocess.Popen([sys.executable, script, "--port", str(port), "--rows", str(rows), "--latency", str(latency)],
+                                         stdout=subprocess.DEVNULL)
+        waitForPort(port)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._process.terminate()
+        self._process.wait()
+
+    def ServiceUrl(self, service):
+        return f"http://127.0.0.1:{self._port}/{service}"
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+# the Flask application on the threaded development server, one thread per request
+def startFlask(port):
+    server = make_server("127.0.0.1", port, flask_app, threaded=True, request_handler=_QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name="flask-server", daemon=True).start()
+    return server.shutdown
+
+
+# the asyncio serving mode on uvicorn with one worker, its event loop runs in a thread of this process
+def startAsgi(port):
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, log_level="warning", backlog=2048))
+    threading.Thread(target=server.run, name="uvicorn-server", daemon=True).start()
+    waitForPort(port)
+
+    def stop():
+        server.should_exit = True
+    return stop
+
+
+def waitForPort(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} didn't start in {timeout} seconds")
+
+
+# send concurrent /processQuery requests with distinct queries, every request comes from its own client
+# returns latencies of the requests and the peak number of threads in this process
+async def sendConcurrent(port, concurrency, rows):
+    peak_threads = threading.active_count()
+    finished = asyncio.Event()
+
+    async def watchThreads():
+        nonlocal peak_threads
+        while not finished.is_set():
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.02)
+
+    async def send(client, index):
+        query_params = json.dumps({"object_types": "Star", "limit": rows + next(_query_numbers)})
+        start = time.perf_counter()
+        response = await client.post("/processQuery", content=json.dumps({"db_name": "gaia", "query_params": query_params}),
+                                     headers={"X-Client-Id": f"client-{index}"})
+        if response.status_code != 200:
+            raise RuntimeError(f"/processQuery failed with HTTP {response.status_code}: {response.text[:500]}")
+        return time.perf_counter() - start
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=600, limits=limits) as client:
+        watcher = asyncio.ensure_future(watchThreads())
+        try:
+            latencies = await asyncio.gather(*[send(client, index) for index in range(concurrency)])
+        finally:
+            finished.set()
+            await watcher
+    return latencies, peak_threads
+
+
+def benchmarkServer(mode, port, concurrency, rows, repeat, latency):
+    result, timings = measure(lambda: asyncio.run(sendConcurrent(port, concurrency, rows)), repeat)
+    latencies, peak_threads = result
+    latencies = sorted(latencies)
+    return makeRecord(f"{mode}_concurrent_{concurrency}", rows, timings, concurrency=concurrency, upstream_latency=latency,
+                      latency_median=statistics.median(latencies),
+                      latency_p95=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                      peak_threads=peak_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent slow upstream queries through the Flask and asyncio serving modes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=Default_Concurrency, help="numbers of concurrent requests")
+    parser.add_argument("--rows", type=int, default=100, help="rows requested by every query")
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds the stand-in adds to every response")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every concurrency level")
+    parser.add_argument("--modes", nargs="+", default=["flask", "asgi"], choices=["flask", "asgi"])
+    parser.add_argument("--output", help="results file, by default benchmark_results/concurrency-<time>.json")
+    args = parser.parse_args()
+
+    # results cached by earlier runs would answer the queries without the upstream latency
+    Query_Cache.Clear()
+    # the servers run in this process; all requests are sent to the stand-in at the same time, so the serving modes
+    # are measured holding every request instead of queueing them behind the Gaia request limit
+    Admission_Control.upstream_limits["gaia"] = max(args.concurrency)
+    records = []
+    with StandInProcess(args.rows, args.latency) as stand_in:
+        redirectCatalogs(stand_in)
+        for index, mode in enumerate(args.modes):
+            port = Api_Port + index
+            stop = startFlask(port) if mode == "flask" else startAsgi(port)
+            try:
+                for concurrency in args.concurrency:
+                    record = benchmarkServer(mode, port, concurrency, args.rows, args.repeat, args.latency)
+                    printRecords([record])
+                    print(f"    latency median {record['latency_median']:.2f} s, p95 {record['latency_p95']:.2f} s, "
+                          f"peak threads {record['peak_threads']}")
+                    records.append(record)
+            finally:
+                stop()
+    print(f"results: {saveResults('concurrency', records, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
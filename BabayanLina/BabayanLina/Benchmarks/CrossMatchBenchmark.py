@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from astropy.table import Table
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DBaccess.CrossMatching import match_radius, SimbadTap, column_adjusted_ra, column_adjusted_dec
+from DBaccess.SpatialMatching import SpatialIndex
+
+Default_Sizes = [10000, 100000, 1000000]
+
+
+# random sources uniformly distributed over the sphere and targets close to them
+def makeTables(size, seed=0):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, size)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, size)))
+    source = Table({"gaia_id": np.arange(size, dtype=np.int64), column_adjusted_ra: ra, column_adjusted_dec: dec})
+    target = Table({"simbad_id": np.arange(size, dtype=np.int64),
+                    "RA": (ra + rng.normal(0.0, match_radius / 5, size)) % 360.0,
+                    "Dec": np.clip(dec + rng.normal(0.0, match_radius / 5, size), -90.0, 90.0)})
+    return source, target
+
+
+def benchmarkLocal(source, target):
+    start = time.perf_counter()
+    index = SpatialIndex(target["RA"], target["Dec"], match_radius)
+    build_seconds = time.perf_counter() - start
+    target_index, separation = index.MatchNearest(source[column_adjusted_ra], source[column_adjusted_dec])
+    total_seconds = time.perf_counter() - start
+    return {"build_seconds": build_seconds, "total_seconds": total_seconds, "matched": int((target_index >= 0).sum())}
+
+
+# the same upload and remote join as CrossMatching does, SIMBAD objects are matched instead of the synthetic targets
+def benchmarkTap(source):
+    query = ("SELECT basic.main_id AS simbad_id, tmp_table.gaia_id FROM basic "
+             f"INNER JOIN TAP_UPLOAD.tmp_table ON 1=CONTAINS(POINT('ICRS', basic.ra, basic.dec), "
+             f"CIRCLE('ICRS', tmp_table.{column_adjusted_ra}, tmp_table.{column_adjusted_dec}, {match_radius}))")
+    start = time.perf_counter()
+    job = SimbadTap().submit_job(query, uploads={"tmp_table": source})
+    job.run()
+    job.wait()
+    matched = len(job.fetch_result().to_table()) if job.phase == "COMPLETED" else 0
+    return {"total_seconds": time.perf_counter() - start, "phase": job.phase, "matched": matched}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare local spatial cross match with SIMBAD TAP upload")
+    parser.add_argument("--sizes", type=int, nargs="+", default=Default_Sizes, help="numbers of source rows")
+    parser.add_argument("--tap", action="store_true", help="also run the remote SIMBAD TAP cross match (needs network)")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        source, target = makeTables(size)
+        local = benchmarkLocal(source, target)
+        print(f"local {size:>8} rows: {local['total_seconds']:.3f} s (index {local['build_seconds']:.3f} s), matched {local['matched']}")
+        if args.tap:
+            tap = benchmarkTap(source)
+            print(f"tap   {size:>8} rows: {tap['total_seconds']:.3f} s, phase {tap['phase']}, matched {tap['matched']}")
+
+
+if __name__ == '__main__':
+    main()
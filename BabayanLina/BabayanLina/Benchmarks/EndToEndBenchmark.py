@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import sys
+
+import pyvo
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmarks.BenchmarkResults import measure, makeRecord, saveResults, printRecords
+from Benchmarks.TapStandIn import TapStandIn, LoadFixture
+import DBaccess.CrossMatching as CrossMatching
+import DBaccess.DBAccessGaia as DBAccessGaia
+import DBaccess.DBAccessSimbad as DBAccessSimbad
+from DBaccess.HttpTransport import Http_Transport
+from DBaccess.QueryCache import Query_Cache
+from DBaccess.MatchStore import Match_Store
+from DBaccess.AdmissionControl import Admission_Control
+from API.StellarisAPI import app
+
+Default_Sizes = [1000, 100000, 1000000]
+
+
+# point Gaia and SIMBAD endpoints to the stand-in server
+def redirectCatalogs(stand_in):
+    gaia_url = stand_in.ServiceUrl("gaia")
+    DBAccessGaia.Gaia_Url = gaia_url + "/sync"
+    DBAccessGaia.Gaia_Async_Url = gaia_url + "/async"
+    DBAccessSimbad.Simbad_Url = stand_in.ServiceUrl("simbad") + "/sync"
+    CrossMatching.simbad_tap = pyvo.dal.tap.TAPService(stand_in.ServiceUrl("simbad"), session=Http_Transport.Session)
+
+
+def postRequest(client, path, body, accept_encoding):
+    response = client.post(path, data=json.dumps(body), headers={"Accept-Encoding": accept_encoding})
+    content = response.get_data()
+    if response.status_code != 200:
+        raise RuntimeError(f"{path} failed with HTTP {response.status_code}: {content[:500]}")
+    return content
+
+
+def postColdRequest(client, path, body, accept_encoding):
+    Query_Cache.Clear()
+    Match_Store.Clear()
+    return postRequest(client, path, body, accept_encoding)
+
+
+# the query result is not cached, but its sources were cross matched before and are taken from the match store
+def postSeenSourcesRequest(client, path, body, accept_encoding):
+    Query_Cache.Clear()
+    return postRequest(client, path, body, accept_encoding)
+
+
+# /processQuery and /crossMatching through the Flask application, every request reaches the stand-in server
+# cold runs start with empty query caches and match store, warm runs repeat the same request, seen sources runs
+# repeat the cross match with empty query cache
+# bytes are the size of the response body as sent, compressed if the API compressed it
+def benchmarkEndpoints(client, size, repeat, accept_encoding):
+    query_params = json.dumps({"object_types": "Star", "limit": size})
+    records = []
+    for path, body in (("/processQuery", {"db_name": "gaia", "query_params": query_params}),
+                       ("/crossMatching", {"db_name_src": "gaia", "query_params": query_params})):
+        name = path.strip("/")
+        content, timings = measure(lambda: postColdRequest(client, path, body, accept_encoding), repeat)
+        records.append(makeRecord(f"{name}_cold", size, timings, bytes=len(content)))
+        content, timings = measure(lambda: postRequest(client, path, body, accept_encoding), repeat, warmup=1)
+        records.append(makeRecord(f"{name}_warm", size, timings, bytes=len(content)))
+    body = {"db_name_src": "gaia", "query_params": query_params}
+    content, timings = measure(lambda: postSeenSourcesRequest(client, "/crossMatching", body, accept_encoding), repeat, warmup=1)
+    records.append(makeRecord("crossMatching_seen_sources", size, timings, bytes=len(content)))
+    return records
+
+
+# distributions over the whole fixture: the G magnitude histogram and the HR diagram density grid computed by the
+# catalog through /aggregate, compared with /processQuery pulling the same rows
+def benchmarkAggregates(client, rows, repeat, accept_encoding):
+    query_params = json.dumps({"object_types": "Star"})
+    records = []
+    for name, bins in (("histogram", [{"category": "GMagnitude", "width": 0.5}]),
+                       ("hr_diagram", [{"category": "BPMagnitude", "minus": "RPMagnitude", "width": 0.05},
+                                       {"category": "GMagnitude", "width": 0.25}])):
+        body = {"db_name": "gaia", "query_params": query_params, "bins": bins}
+        content, timings = measure(lambda: postColdRequest(client, "/aggregate", body, accept_encoding), repeat)
+        records.append(makeRecord(f"aggregate_{name}_cold", rows, timings, bytes=len(content)))
+        content, timings = measure(lambda: postRequest(client, "/aggregate", body, accept_encoding), repeat, warmup=1)
+        records.append(makeRecord(f"aggregate_{name}_warm", rows, timings, bytes=len(content)))
+    body = {"db_name": "gaia", "query_params": json.dumps({"object_types": "Star", "limit": rows})}
+    content, timings = measure(lambda: postColdRequest(client, "/processQuery", body, accept_encoding), repeat)
+    records.append(makeRecord("aggregate_raw_rows_cold", rows, timings, bytes=len(content)))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks of the API against a local TAP stand-in")
+    parser.add_argument("--sizes", type=int, nargs="+", default=Default_Sizes, help="numbers of requested rows")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every request, the median is compared")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in adds to every response")
+    parser.add_argument("--job-seconds", type=float, default=0.0, help="execution time of stand-in asynchronous jobs")
+    parser.add_argument("--fixture", help="recorded VOTable used instead of synthetic rows")
+    parser.add_argument("--no-compression", action="store_true", help="the stand-in sends uncompressed VOTables")
+    parser.add_argument("--accept-encoding", default="gzip", help="Accept-Encoding of API requests, identity disables compression")
+    parser.add_argument("--output", help="results file, by default benchmark_results/endtoend-<time>.json")
+    args = parser.parse_args()
+
+    fixture = LoadFixture(args.fixture) if args.fixture else None
+    records = []
+    with TapStandIn(fixture, rows=max(args.sizes), latency=args.latency, job_seconds=args.job_seconds,
+                    compress=not args.no_compression) as stand_in:
+        redirectCatalogs(stand_in)
+        # synchronous responses of every size are measured, so they are neither rerouted to jobs nor limited by the quota
+        Admission_Control.sync_rows_threshold = max(args.sizes)
+        Admission_Control.rows_per_minute = float("inf")
+        client = app.test_client()
+        for size in args.sizes:
+            size_records = benchmarkEndpoints(client, size, args.repeat, args.accept_encoding)
+            printRecords(size_records)
+            records.extend(size_records)
+        aggregate_records = benchmarkAggregates(client, len(stand_in.Fixture), args.repeat, args.accept_encoding)
+        printRecords(aggregate_records)
+        records.extend(aggregate_records)
+    print(f"results: {saveResults('endtoend', records, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
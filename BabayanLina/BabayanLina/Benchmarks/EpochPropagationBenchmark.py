@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord, Distance
+from astropy.time import Time
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DBaccess.EpochPropagation import PropagatePositions
+
+Default_Sizes = [10000, 100000, 1000000]
+Source_Epoch = "J2015.5"
+Target_Epoch = "J2000.0"
+
+
+# random Gaia-like sources: positions over the whole sphere, proper motions, parallaxes and radial velocities
+def makeSources(size, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "ra": rng.uniform(0.0, 360.0, size),
+        "dec": np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, size))),
+        "pmra": rng.normal(0.0, 50.0, size),
+        "pmdec": rng.normal(0.0, 50.0, size),
+        "parallax": rng.uniform(0.5, 100.0, size),
+        "radial_velocity": rng.normal(0.0, 50.0, size),
+    }
+
+
+def propagateAstropy(sources, with_radial_motion):
+    radial_motion = {}
+    if with_radial_motion:
+        radial_motion = {"distance": Distance(parallax=sources["parallax"] * u.mas),
+                         "radial_velocity": sources["radial_velocity"] * u.km / u.s}
+    coords = SkyCoord(ra=sources["ra"] * u.deg, dec=sources["dec"] * u.deg,
+                      pm_ra_cosdec=sources["pmra"] * u.mas / u.yr, pm_dec=sources["pmdec"] * u.mas / u.yr,
+                      frame="icrs", obstime=Time(Source_Epoch), **radial_motion)
+    with warnings.catch_warnings():
+        # astropy warns that distance is assumed when it is not given
+        warnings.simplefilter("ignore")
+        adjusted = coords.apply_space_motion(new_obstime=Time(Target_Epoch))
+    return adjusted.ra.deg, adjusted.dec.deg
+
+
+def propagateNumpy(sources, with_radial_motion):
+    if with_radial_motion:
+        return PropagatePositions(sources["ra"], sources["dec"], sources["pmra"], sources["pmdec"],
+                                  Source_Epoch, Target_Epoch, sources["parallax"], sources["radial_velocity"])
+    return PropagatePositions(sources["ra"], sources["dec"], sources["pmra"], sources["pmdec"], Source_Epoch, Target_Epoch)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+# the largest difference between two sets of positions in micro-arcseconds
+def maxDifference(ra1, dec1, ra2, dec2):
+    return SkyCoord(ra1 * u.deg, dec1 * u.deg).separation(SkyCoord(ra2 * u.deg, dec2 * u.deg)).to_value(u.uas).max()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare numpy epoch propagation with SkyCoord.apply_space_motion")
+    parser.add_argument("--sizes", type=int, nargs="+", default=Default_Sizes, help="numbers of sources")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        sources = makeSources(size)
+        for with_radial_motion in (False, True):
+            (astropy_ra, astropy_dec), astropy_seconds = timed(propagateAstropy, sources, with_radial_motion)
+            (numpy_ra, numpy_dec), numpy_seconds = timed(propagateNumpy, sources, with_radial_motion)
+            difference = maxDifference(astropy_ra, astropy_dec, numpy_ra, numpy_dec)
+            print(f"{size:>8} rows, radial motion {str(with_radial_motion):<5}: astropy {astropy_seconds:.3f} s, "
+                  f"numpy {numpy_seconds:.3f} s, speedup {astropy_seconds / numpy_seconds:.1f}x, "
+                  f"max difference {difference:.3g} uas")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+import tempfile
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmarks.BenchmarkResults import measure, makeRecord, saveResults, printRecords
+from Benchmarks.TapStandIn import MakeGaiaFixture
+from DBaccess.DBAccessStellaris import DBAccessStellaris
+import DBaccess.DBAccessStellaris as DBAccessStellarisModule
+from DBaccess.StellarisStore import StellarisStore
+
+Default_Sizes = [100000, 1000000]
+
+# typical science queries: a cone, a magnitude slice, nearby bright stars and a cone with filters
+Queries = {
+    "cone_0.5deg": {"objectsincircle": {"ra": 120.0, "dec": -30.0, "radius": 0.5}},
+    "cone_5deg_filtered": {"objectsincircle": {"ra": 200.0, "dec": 10.0, "radius": 5.0}, "max_gmagnitude": 12},
+    "magnitude_slice": {"min_gmagnitude": 10.0, "max_gmagnitude": 10.05},
+    "nearby_bright_stars": {"object_types": "Star", "min_parallax": 49.9, "max_gmagnitude": 15},
+    "temperature_range": {"min_temperature": 5770, "max_temperature": 5780, "min_gravity": 4.4},
+}
+
+
+# ingestion of a synthetic Gaia-like extract into a temporary store and local queries through DBAccessStellaris
+def benchmarkLocalCatalog(size, repeat, limit, seed=0):
+    fixture = MakeGaiaFixture(size, seed)
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = StellarisStore(directory)
+        _, timings = measure(lambda: (store.Clear(), store.Ingest(fixture, "gaia", "Star", "J2015.5")), 1)
+        records.append(makeRecord("local_ingest", size, timings, bytes=store.Stats["bytes"]))
+
+        DBAccessStellarisModule.Stellaris_Store = store
+        stellaris = DBAccessStellaris()
+        for name, query_params in Queries.items():
+            result, timings = measure(lambda: stellaris.QueryCatalog(query_params, limit, None), repeat, warmup=1)
+            records.append(makeRecord(f"local_query_{name}", size, timings, result_rows=len(result[2])))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion and hot queries of the local Stellaris catalog")
+    parser.add_argument("--sizes", type=int, nargs="+", default=Default_Sizes, help="rows of the ingested extracts")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every query")
+    parser.add_argument("--limit", type=int, default=10000, help="limit of every query")
+    parser.add_argument("--output", help="results file, by default benchmark_results/local_catalog-<time>.json")
+    args = parser.parse_args()
+
+    records = []
+    for size in args.sizes:
+        size_records = benchmarkLocalCatalog(size, args.repeat, args.limit)
+        printRecords(size_records)
+        records += size_records
+    print(f"results: {saveResults('local_catalog', records, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+from astropy.io.votable import from_table, parse
+from astropy.table import Table, join
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmarks.BenchmarkResults import measure, makeRecord, saveResults, printRecords
+from Benchmarks.TapStandIn import MakeGaiaFixture
+from DBaccess.DBAccessGaia import DBAccessGaia
+from DBaccess.EpochPropagation import PropagatePositions
+from DBaccess.QueryResult import QueryResult
+from API.ResponseFormats import JsonResponse
+
+Default_Sizes = [1000, 100000, 1000000]
+# ADQL build doesn't depend on the number of rows, it is repeated to get measurable time
+Adql_Builds = 1000
+
+Query_Params = {"object_types": "Star", "min_parallax": 1, "max_gmagnitude": 18,
+                "objectsincircle": {"ra": 10.0, "dec": 20.0, "radius": 0.5}}
+
+
+# Microbenchmarks of the stages every request goes through: ADQL build, VOTable parse, row conversion,
+# epoch propagation, join with cross match result and JSON serialization
+def benchmarkStages(size, repeat, seed=0):
+    fixture = MakeGaiaFixture(size, seed)
+    gaia = DBAccessGaia()
+    records = []
+
+    _, timings = measure(lambda: [gaia._constructADQLQuery(Query_Params, size, None) for _ in range(Adql_Builds)], repeat)
+    records.append(makeRecord("adql_build", size, {name: value / Adql_Builds if name.startswith("seconds") else value
+                                                   for name, value in timings.items()}))
+
+    for votable_format in ("tabledata", "binary", "binary2"):
+        votable = from_table(fixture)
+        votable.get_first_table().format = votable_format
+        output = BytesIO()
+        votable.to_xml(output)
+        content = output.getvalue()
+        _, timings = measure(lambda: parse(BytesIO(content)).get_first_table().to_table(), repeat)
+        records.append(makeRecord(f"votable_parse_{votable_format}", size, timings, bytes=len(content)))
+
+    result = QueryResult(fixture)
+    _, timings = measure(result.ColumnarData, repeat)
+    records.append(makeRecord("row_conversion_columnar", size, timings))
+    _, timings = measure(lambda: list(result.RowValues()), repeat)
+    records.append(makeRecord("row_conversion_rows", size, timings))
+
+    _, timings = measure(lambda: PropagatePositions(fixture["RA"], fixture["Dec"], fixture["PMRA"], fixture["PMDec"],
+                                                    "J2015.5", "J2000", fixture["Parallax"], fixture["RadialVelocity"]), repeat)
+    records.append(makeRecord("epoch_propagation", size, timings))
+
+    # left join with a cross match result covering most of the sources, as CrossMatching merges SIMBAD matches
+    matched = fixture["gaia_id"][np.random.default_rng(seed).random(size) < 0.8]
+    crossmatch_result = Table({"simbad_id": np.array([f"SIMBAD {value}" for value in matched]), "gaia_id": matched})
+    _, timings = measure(lambda: join(fixture, crossmatch_result, keys=["gaia_id"], join_type="left"), repeat)
+    records.append(makeRecord("crossmatch_join", size, timings))
+
+    head = {"catalog": "gaia", "query": "", "status": "success"}
+    body, timings = measure(lambda: "".join(JsonResponse(head, result, {"error": None})), repeat)
+    records.append(makeRecord("json_serialization", size, timings, bytes=len(body)))
+    json.loads(body)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of query processing stages on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=Default_Sizes, help="numbers of rows")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every stage, the median is compared")
+    parser.add_argument("--output", help="results file, by default benchmark_results/stages-<time>.json")
+    args = parser.parse_args()
+
+    records = []
+    for size in args.sizes:
+        size_records = benchmarkStages(size, args.repeat)
+        printRecords(size_records)
+        records.extend(size_records)
+    print(f"results: {saveResults('stages', records, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
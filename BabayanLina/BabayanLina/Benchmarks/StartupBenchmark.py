@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Add the root directory to sys.path
+Root_Dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(Root_Dir)
+
+from Benchmarks.BenchmarkResults import measure, makeRecord, saveResults, printRecords
+from Benchmarks.TapStandIn import TapStandIn
+
+# packages whose import dominated the start of a worker, a record lists the ones loaded when its code finished
+Heavy_Packages = ["numpy", "astropy", "pyvo"]
+
+# code run by a fresh interpreter, the code between the two perf_counter calls is measured
+Startup_Cases = {
+    "import_flask": "import API.StellarisAPI",
+    "import_asgi": "import API.StellarisASGI",
+    "import_warmup": "import API.StellarisAPI\n"
+                     "API.StellarisAPI.Warm_Up.Run()",
+    "first_request": "from API.StellarisAPI import app\n"
+                     "import DBaccess.DBAccessGaia as DBAccessGaia\n"
+                     "from DBaccess.QueryCache import Query_Cache\n"
+                     "DBAccessGaia.Gaia_Url = os.environ['STELLARIS_STARTUP_GAIA'] + '/sync'\n"
+                     "Query_Cache.cache_dir = tempfile.mkdtemp()\n"
+                     "body = {'db_name': 'gaia', 'query_params': json.dumps({'object_types': 'Star', 'limit': 1000})}\n"
+                     "response = app.test_client().post('/processQuery', data=json.dumps(body))\n"
+                     "assert response.status_code == 200, response.get_data()[:500]",
+}
+
+Child_Template = """import json, os, sys, tempfile, time
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+# run the case in a new interpreter, return the seconds measured inside it and the heavy packages it loaded
+def runCase(code, env):
+    completed = subprocess.run([sys.executable, "-c", Child_Template.format(code=code, heavy=Heavy_Packages)],
+                               cwd=Root_Dir, env=env, capture_output=True, text=True, timeout=300)
+    if completed.returncode != 0:
+        raise RuntimeError(f"startup case failed: {completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# time of every case measured from outside (interpreter start included) and from inside the new process
+# the API modules are imported in a fresh interpreter every run, so every run is a cold start
+def benchmarkStartup(cases, repeat, env):
+    records = []
+    for name in cases:
+        results = []
+        _, timings = measure(lambda: results.append(runCase(Startup_Cases[name], env)), repeat)
+        inner = sorted(result["seconds"] for result in results)
+        records.append(makeRecord(name, 0, timings, inner_seconds_median=inner[len(inner) // 2],
+                                  heavy_packages=results[-1]["heavy"]))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmarks: API import, warm-up and first request")
+    parser.add_argument("--cases", nargs="+", choices=list(Startup_Cases), default=list(Startup_Cases),
+                        help="measured startup cases")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every case, the median is compared")
+    parser.add_argument("--output", help="results file, by default benchmark_results/startup-<time>.json")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    # the measured processes don't share match store and query cache files with a running server
+    env.setdefault("STELLARIS_MATCH_STORE", os.path.join(tempfile.mkdtemp(), "matches.sqlite3"))
+    with TapStandIn(rows=1000) as stand_in:
+        env["STELLARIS_STARTUP_GAIA"] = stand_in.ServiceUrl("gaia")
+        records = benchmarkStartup(args.cases, args.repeat, env)
+    printRecords(records)
+    for record in records:
+        print(f"{record['name']:<28} in process {record['inner_seconds_median']:.4f} s, "
+              f"loaded: {', '.join(record['heavy_packages']) or 'none'}")
+    print(f"results: {saveResults('startup', records, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
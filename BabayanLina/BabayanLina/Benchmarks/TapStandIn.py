@@ -0,0 +1,505 @@
+import argparse
+import email.policy
+import gzip
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from astropy.io.votable import from_table, parse
+from astropy.table import Table
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DBaccess.ConeTileCache import AngToPixNest, AngularDistance, Source_Id_Healpix_Shift
+from DBaccess.DBAccessGaia import DBAccessGaia
+from DBaccess.DBAccessSimbad import DBAccessSimbad
+
+Default_Rows = 100000
+# serialized responses of this number of recent queries are kept, repeated benchmark runs don't pay for serialization
+Response_Cache_Size = 8
+
+# VOTable responses are gzipped for clients accepting gzip, the fastest level keeps the stand-in cheap
+Gzip_Level = 1
+
+# Gaia FORMAT parameter to VOTable serialization
+VOTable_Formats = {"votable": "binary", "votable_plain": "tabledata", "votable_binary2": "binary2"}
+
+Job_Xml = """<?xml version="1.0" encoding="UTF-8"?>
+<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">
+  <uws:jobId>{job_id}</uws:jobId>
+  <uws:phase>{phase}</uws:phase>
+  <uws:results>{results}</uws:results>
+</uws:job>
+"""
+
+
+# synthetic Gaia-like table: sources over the whole sphere ordered by source_id, source_id has HEALPix index of
+# the source like in Gaia, so source_id ranges and cone searches behave as in the archive
+def MakeGaiaFixture(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, rows)))
+    source_id = (AngToPixNest(12, ra, dec) << Source_Id_Healpix_Shift) + rng.integers(0, 1 << Source_Id_Healpix_Shift, rows)
+    pmra = rng.normal(0.0, 20.0, rows)
+    pmdec = rng.normal(0.0, 20.0, rows)
+    g_magnitude = rng.uniform(3.0, 21.0, rows)
+    radial_velocity = rng.normal(0.0, 40.0, rows)
+    # most Gaia sources have no radial velocity
+    radial_velocity[rng.random(rows) < 0.9] = np.nan
+    table = Table({
+        "gaia_id": source_id, "RA": ra, "Dec": dec, "PMRA": pmra, "PMDec": pmdec,
+        "Parallax": rng.uniform(0.1, 50.0, rows), "ProperMotion": np.hypot(pmra, pmdec),
+        "GMagnitude": g_magnitude, "BPMagnitude": g_magnitude + rng.uniform(0.0, 1.0, rows),
+        "RPMagnitude": g_magnitude - rng.uniform(0.0, 1.0, rows), "RadialVelocity": radial_velocity,
+        "Mass": rng.uniform(0.5, 5.0, rows), "Radius": rng.uniform(0.5, 10.0, rows),
+        "Luminosity": rng.uniform(0.1, 100.0, rows), "Temperature": rng.uniform(3000.0, 10000.0, rows),
+        "Gravity": rng.uniform(3.0, 5.0, rows),
+    })
+    table.sort("gaia_id")
+    return table
+
+
+# fixture recorded from a real archive response (any VOTable), the first column is taken as source id
+def LoadFixture(path):
+    table = parse(path).get_first_table().to_table()
+    table.sort(table.colnames[0])
+    return table
+
+
+# Local stand-in of Gaia and SIMBAD TAP services for benchmarks
+# It implements enough of TAP for this project: /sync, /async UWS jobs (phase, results, error, abort) and inline
+# TAP_UPLOAD. Every service (/gaia, /simbad, ...) answers from the same fixture table. SELECT columns are taken by
+# their aliases, TOP, keyset condition (source_id > N), source_id BETWEEN ranges and CONTAINS(POINT, CIRCLE) are
+# applied, other conditions are ignored. COUNT, AVG, MIN, MAX and SUM are computed, grouped by FLOOR bins. Queries with an uploaded table are answered as a cross match: a part of the
+# uploaded rows gets one to three synthetic matches near its position, only the nearest one when the query keeps the
+# minimum separation of every source (grouped subquery with MIN).
+# latency is added to every HTTP response, job_seconds is the time an asynchronous job stays EXECUTING.
+# VOTable responses are gzipped when compress is True and the client accepts gzip.
+class TapStandIn:
+    def __init__(self, fixture=None, rows=Default_Rows, latency=0.0, job_seconds=0.0, match_fraction=0.8,
+                 host="127.0.0.1", port=0, compress=True):
+        self.Fixture = fixture if fixture is not None else MakeGaiaFixture(rows)
+        self.Latency = latency
+        self.JobSeconds = job_seconds
+        self.MatchFraction = match_fraction
+        self.Compress = compress
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()
+        self._server = _TapServer((host, port), _TapRequestHandler)
+        self._server.stand_in = self
+        self._thread = None
+
+    def __enter__(self):
+        return self.Start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.Stop()
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="tap-stand-in", daemon=True)
+        self._thread.start()
+        return self
+
+    def Stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def Url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # base TAP URL of a service, for example ServiceUrl("gaia") + "/sync"
+    def ServiceUrl(self, service):
+        return f"{self.Url}/{service}"
+
+    # VOTable bytes answering the query
+    def Answer(self, query, uploads, votable_format="binary"):
+        key = (query, votable_format)
+        if not uploads:
+            with self._lock:
+                if key in self._responses:
+                    self._responses.move_to_end(key)
+                    return self._responses[key]
+
+        table = self._crossMatch(query, uploads) if uploads else self._select(query)
+        votable = from_table(table)
+        votable.get_first_table().format = votable_format
+        output = BytesIO()
+        votable.to_xml(output)
+        response = output.getvalue()
+
+        if not uploads:
+            with self._lock:
+                self._responses[key] = response
+                while len(self._responses) > Response_Cache_Size:
+                    self._responses.popitem(last=False)
+        return response
+
+    def CreateJob(self, query, uploads, votable_format):
+        with self._lock:
+            job_id = str(next(self._job_ids))
+            self._jobs[job_id] = {"phase": "PENDING", "query": query, "uploads": uploads, "format": votable_format,
+                                  "done_at": None, "result": None, "error": ""}
+        return job_id
+
+    def RunJob(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["phase"] == "PENDING":
+                job["phase"] = "EXECUTING"
+                job["done_at"] = time.monotonic() + self.JobSeconds
+
+    def AbortJob(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["phase"] in ("PENDING", "QUEUED", "EXECUTING"):
+                job["phase"] = "ABORTED"
+
+    def DeleteJob(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    # job state, wait_seconds > 0 waits for the end of execution like UWS 1.1 WAIT parameter
+    def JobState(self, job_id, wait_seconds=0.0):
+        with self._lock:
+            job = self._jobs[job_id]
+        if job["phase"] == "EXECUTING":
+            remaining = job["done_at"] - time.monotonic()
+            if 0 < remaining <= wait_seconds:
+                time.sleep(remaining)
+                remaining = 0
+            if remaining <= 0:
+                self._completeJob(job)
+        return job
+
+    def _completeJob(self, job):
+        try:
+            result = self.Answer(job["query"], job["uploads"], job["format"])
+            phase = "COMPLETED"
+        except Exception as e:
+            result = None
+            phase = "ERROR"
+            job["error"] = str(e)
+        with self._lock:
+            if job["phase"] == "EXECUTING":
+                job["result"] = result
+                job["phase"] = phase
+
+    def _select(self, query):
+        table = self.Fixture
+        source_id = np.asarray(table[table.colnames[0]], dtype=np.int64)
+        mask = np.ones(len(table), dtype=bool)
+
+        keyset = re.search(r"source_id\s*>\s*(-?\d+)", query)
+        if keyset:
+            mask &= source_id > int(keyset.group(1))
+        ranges = re.findall(r"source_id\s+BETWEEN\s+(-?\d+)\s+AND\s+(-?\d+)", query)
+        if ranges:
+            in_ranges = np.zeros(len(table), dtype=bool)
+            for low, high in ranges:
+                in_ranges |= (source_id >= int(low)) & (source_id <= int(high))
+            mask &= in_ranges
+        circle = re.search(r"CIRCLE\('ICRS',\s*([-\d.eE+]+),\s*([-\d.eE+]+),\s*([-\d.eE+]+)\)", query)
+        if circle and "RA" in table.colnames and "Dec" in table.colnames:
+            ra, dec, radius = (float(value) for value in circle.groups())
+            mask &= AngularDistance(ra, dec, np.asarray(table["RA"]), np.asarray(table["Dec"])) <= radius
+
+        if re.search(r"\b(COUNT|AVG|MIN|MAX|SUM)\s*\(", query, re.IGNORECASE):
+            return self._aggregate(query, table[mask])
+
+        selected = np.flatnonzero(mask)
+        top = re.search(r"SELECT\s+TOP\s+(\d+)", query, re.IGNORECASE)
+        if top:
+            selected = selected[:int(top.group(1))]
+
+        columns = [column for column in _selectAliases(query) if column in table.colnames] or table.colnames
+        return table[columns][selected]
+
+    # aggregates of the selected rows grouped by FLOOR(column / width) or FLOOR((column - column) / width) bins
+    def _aggregate(self, query, table):
+        select = re.search(r"SELECT\s+(?:TOP\s+(\d+)\s+)?(.*?)\s+FROM\s", query, re.IGNORECASE | re.DOTALL)
+        bins = []
+        aggregates = []
+        for item in _topLevelItems(select.group(2)):
+            function, argument, alias = re.match(r"\s*(\w+)\((.*)\)\s+AS\s+(\w+)\s*$", item, re.DOTALL).groups()
+            if function.upper() == "FLOOR":
+                expression, width = argument.rsplit("/", 1)
+                terms = [_fixtureColumn(table, term) for term in expression.strip(" ()").split(" - ")]
+                values = terms[0] - terms[1] if len(terms) > 1 else terms[0]
+                bins.append((alias, np.floor(values / float(width))))
+            else:
+                aggregates.append((function.upper(), None if argument.strip() == "*" else _fixtureColumn(table, argument), alias))
+
+        valid = np.ones(len(table), dtype=bool)
+        for alias, values in bins:
+            valid &= np.isfinite(values)
+        if bins:
+            keys, group = np.unique(np.column_stack([values[valid] for alias, values in bins]), axis=0, return_inverse=True)
+            group = group.ravel()
+        else:
+            keys, group = np.empty((1, 0)), np.zeros(int(valid.sum()), dtype=np.int64)
+
+        columns = {alias: keys[:, position] for position, (alias, values) in enumerate(bins)}
+        for function, values, alias in aggregates:
+            if values is None:
+                columns[alias] = np.bincount(group, minlength=len(keys))
+                continue
+            values = values[valid]
+            present = np.isfinite(values)
+            count = np.bincount(group[present], minlength=len(keys))
+            total = np.bincount(group[present], weights=values[present], minlength=len(keys))
+            if function == "COUNT":
+                columns[alias] = count
+            elif function == "SUM":
+                columns[alias] = total
+            elif function == "AVG":
+                columns[alias] = total / np.maximum(count, 1)
+            else:
+                extreme = np.full(len(keys), np.inf if function == "MIN" else -np.inf)
+                (np.minimum if function == "MIN" else np.maximum).at(extreme, group[present], values[present])
+                columns[alias] = extreme
+        result = Table(columns)
+        if select.group(1):
+            result = result[:int(select.group(1))]
+        return result
+
+    def _crossMatch(self, query, uploads):
+        upload = next(iter(uploads.values()))
+        aliases = _selectAliases(query)
+        id_column = next((alias for alias in aliases if alias in upload.colnames), upload.colnames[0])
+        ra_column, dec_column = upload.colnames[1], upload.colnames[2]
+
+        # the same rows are matched for the same source ids, so repeated runs return the same result
+        source_id = np.asarray(upload[id_column]).astype(np.int64)
+        matched = np.flatnonzero((source_id * 2654435761 % 1000) < self.MatchFraction * 1000)
+        candidates = 1 + source_id[matched] * 40503 % 3
+        if re.search(r"\bGROUP\s+BY\b", query, re.IGNORECASE) and re.search(r"\bMIN\s*\(", query, re.IGNORECASE):
+            candidates[:] = 1
+        # candidate rank 0 is the nearest object of the source
+        rows = np.repeat(matched, candidates)
+        rank = np.arange(len(rows)) - np.repeat(np.cumsum(candidates) - candidates, candidates)
+        offset = 0.0001 * (rank + 1)
+        columns = {}
+        for alias in aliases:
+            if alias == id_column:
+                columns[alias] = upload[id_column][rows]
+            elif alias.endswith("_ra"):
+                columns[alias] = np.asarray(upload[ra_column][rows], dtype=np.float64) + offset
+            elif alias.endswith("_dec"):
+                columns[alias] = np.asarray(upload[dec_column][rows], dtype=np.float64) + offset
+            elif alias.endswith("separation"):
+                columns[alias] = offset * np.sqrt(2.0)
+            else:
+                columns[alias] = np.array([f"{alias} {value}" if position == 0 else f"{alias} {value} {position}"
+                                           for value, position in zip(source_id[rows], rank)])
+        return Table(columns)
+
+
+# output column names of SELECT clause: alias of every item, or the column name if the item has no alias
+def _selectAliases(query):
+    select = re.search(r"SELECT\s+(.*?)\s+FROM\s", query, re.IGNORECASE | re.DOTALL)
+    if not select:
+        return []
+    items = _topLevelItems(re.sub(r"^TOP\s+\d+\s+", "", select.group(1).strip(), flags=re.IGNORECASE))
+    return [re.split(r"[\s.]+", item.strip())[-1] for item in items if item.strip()]
+
+
+# values of the fixture column of ADQL column like gs.phot_g_mean_mag: columns of the catalogs are mapped to
+# categories of the project, fixture columns are named by categories
+def _fixtureColumn(table, adql_column):
+    adql_column = adql_column.strip()
+    for db_access in (DBAccessGaia(), DBAccessSimbad()):
+        for category, field_data in db_access.CategoryInfo.items():
+            if field_data[0] == adql_column and category.name in table.colnames:
+                return np.ma.filled(np.ma.asarray(table[category.name], dtype=np.float64), np.nan)
+    raise ValueError(f"Column {adql_column} is not in the fixture")
+
+
+# items of SELECT clause separated by commas outside of function arguments, DISTANCE(POINT(...), POINT(...)) is one item
+def _topLevelItems(select_clause):
+    items = [""]
+    depth = 0
+    for char in select_clause:
+        if char == "," and depth == 0:
+            items.append("")
+            continue
+        depth += (char == "(") - (char == ")")
+        items[-1] += char
+    return items
+
+
+class _TapServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # concurrency benchmarks open hundreds of connections at once
+    request_queue_size = 1024
+
+    # clients close pooled keep-alive connections when they exit, it is not an error of the stand-in
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _TapRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        stand_in = self.server.stand_in
+        if stand_in.Latency:
+            time.sleep(stand_in.Latency)
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        try:
+            params, uploads = self._readParams(method, parse_qs(url.query))
+            if len(parts) == 2 and parts[1] == "sync" and method == "POST":
+                self._send(200, stand_in.Answer(params.get("QUERY", ""), uploads, _votableFormat(params)), "application/x-votable+xml")
+            elif len(parts) == 2 and parts[1] == "async" and method == "POST":
+                job_id = stand_in.CreateJob(params.get("QUERY", ""), uploads, _votableFormat(params))
+                if params.get("PHASE", "").upper() == "RUN":
+                    stand_in.RunJob(job_id)
+                self._redirect(f"/{parts[0]}/async/{job_id}")
+            elif len(parts) >= 3 and parts[1] == "async":
+                self._handleJob(method, parts, params)
+            else:
+                self._send(404, b"Not found", "text/plain")
+        except KeyError:
+            self._send(404, b"No such job", "text/plain")
+        except Exception as e:
+            self._send(500, str(e).encode(), "text/plain")
+
+    def _handleJob(self, method, parts, params):
+        stand_in = self.server.stand_in
+        job_id = parts[2]
+        job_path = "/" + "/".join(parts[:3])
+        resource = "/".join(parts[3:])
+
+        if method == "DELETE":
+            stand_in.DeleteJob(job_id)
+            self._redirect(f"/{parts[0]}/async")
+        elif resource == "phase" and method == "POST":
+            phase = params.get("PHASE", "").upper()
+            if phase == "RUN":
+                stand_in.RunJob(job_id)
+            elif phase == "ABORT":
+                stand_in.AbortJob(job_id)
+            self._redirect(job_path)
+        elif resource == "phase":
+            self._send(200, stand_in.JobState(job_id)["phase"].encode(), "text/plain")
+        elif resource == "error":
+            self._send(200, stand_in.JobState(job_id)["error"].encode(), "text/plain")
+        elif resource == "results/result":
+            job = stand_in.JobState(job_id)
+            if job["result"] is None:
+                self._send(404, f"Job {job_id} is {job['phase']}".encode(), "text/plain")
+            else:
+                self._send(200, job["result"], "application/x-votable+xml")
+        elif resource == "":
+            wait_seconds = float(params.get("WAIT", 0) or 0)
+            job = stand_in.JobState(job_id, wait_seconds=60.0 if wait_seconds < 0 else wait_seconds)
+            results = ""
+            if job["phase"] == "COMPLETED":
+                results = f'<uws:result id="result" xlink:href="{stand_in.Url}{job_path}/results/result"/>'
+            self._send(200, Job_Xml.format(job_id=job_id, phase=job["phase"], results=results).encode(), "text/xml")
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+    # form fields of the request (names in upper case) and inline uploads as astropy tables
+    def _readParams(self, method, query_params):
+        params = {name.upper(): values[-1] for name, values in query_params.items()}
+        uploads = {}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if method != "POST" or not body:
+            return params, uploads
+
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=email.policy.HTTP).parsebytes(
+                b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+            files = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is not None:
+                    files[name] = part.get_payload(decode=True)
+                else:
+                    params[name.upper()] = part.get_payload(decode=True).decode()
+        else:
+            params.update({name.upper(): values[-1] for name, values in parse_qs(body.decode()).items()})
+            files = {}
+
+        # UPLOAD=name,param:part;name2,param:part2
+        for upload in filter(None, params.get("UPLOAD", "").split(";")):
+            name, _, location = upload.partition(",")
+            if location.startswith("param:") and location[6:] in files:
+                uploads[name] = parse(BytesIO(files[location[6:]])).get_first_table().to_table()
+        return params, uploads
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if (self.server.stand_in.Compress and content_type == "application/x-votable+xml"
+                and "gzip" in self.headers.get("Accept-Encoding", "")):
+            body = gzip.compress(body, Gzip_Level)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, path):
+        self.send_response(303)
+        self.send_header("Location", self.server.stand_in.Url + path)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def _votableFormat(params):
+    return VOTable_Formats.get(params.get("FORMAT", "votable").lower(), "binary")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local TAP stand-in server answering from a fixture table")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rows", type=int, default=Default_Rows, help="rows of the synthetic fixture")
+    parser.add_argument("--fixture", help="VOTable file used instead of the synthetic fixture")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--job-seconds", type=float, default=0.0, help="execution time of asynchronous jobs")
+    parser.add_argument("--no-compression", action="store_true", help="don't gzip VOTable responses")
+    args = parser.parse_args()
+
+    fixture = LoadFixture(args.fixture) if args.fixture else None
+    stand_in = TapStandIn(fixture, args.rows, args.latency, args.job_seconds, port=args.port,
+                          compress=not args.no_compression).Start()
+    print(f"TAP stand-in with {len(stand_in.Fixture)} rows: {stand_in.ServiceUrl('gaia')}, {stand_in.ServiceUrl('simbad')}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.Stop()
+
+
+if __name__ == '__main__':
+    main()
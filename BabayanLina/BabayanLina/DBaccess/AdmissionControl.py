@@ -0,0 +1,174 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from .RequestProcessingError import AdmissionRejectedError
+
+# requests sent to every catalog at the same time, the other requests wait for a free slot
+Upstream_Limits = {"gaia": 8, "simbad": 6}
+default_upstream_limit = 8
+# slots of every catalog only small requests may take, so they don't wait behind big queries and background jobs
+reserved_slots = 2
+# seconds a request waits for a free slot before it is rejected, big requests run as background jobs and wait in the queue
+upstream_wait_seconds = 30
+upstream_poll_interval = 0.05
+
+# requests of one client served at the same time, and estimated rows one client may request per minute
+client_max_concurrent = 4
+client_rows_per_minute = 10000000
+
+# queries estimated to return more rows than this are not answered synchronously, they are run as background jobs
+Sync_Rows_Threshold = int(os.environ.get("STELLARIS_SYNC_ROWS") or 200000)
+
+Status_Too_Many_Requests = "Too many requests"
+
+
+# Admission control of requests before they reach the catalogs
+# Every catalog has a limit of concurrent requests; big requests (background jobs and rerouted queries) may take all
+# but reserved_slots of them. Every client has a limit of concurrent requests and a quota of estimated rows per
+# minute (token bucket). Rejected requests get AdmissionRejectedError with the time after which to retry.
+# Queries estimated to return more than sync_rows_threshold rows are rerouted by the API to background jobs.
+class AdmissionControl:
+    def __init__(self, upstream_limits=None, max_concurrent=client_max_concurrent, rows_per_minute=client_rows_per_minute,
+                 sync_rows_threshold=Sync_Rows_Threshold):
+        self.upstream_limits = dict(Upstream_Limits, **(upstream_limits or {}))
+        self.max_concurrent = max_concurrent
+        self.rows_per_minute = rows_per_minute
+        self.sync_rows_threshold = sync_rows_threshold
+
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._upstream_in_use = {}  # catalog -> requests sent
+        self._clients = {}  # client -> [requests served, rows left in the bucket, time the bucket was filled]
+        self._upstream_waits = 0
+        self._upstream_rejections = 0
+        self._client_rejections = 0
+
+    # slot of a request to the catalog held while the block runs
+    @contextmanager
+    def Upstream(self, catalog, big=False):
+        self.AcquireUpstream(catalog, big)
+        try:
+            yield
+        finally:
+            self.ReleaseUpstream(catalog)
+
+    # asyncio version of Upstream, the event loop is not blocked while the request waits for a slot
+    @asynccontextmanager
+    async def UpstreamAsync(self, catalog, big=False):
+        await self.AcquireUpstreamAsync(catalog, big)
+        try:
+            yield
+        finally:
+            self.ReleaseUpstream(catalog)
+
+    # take a slot of a request to the catalog, waiting for it as Upstream does; the slot is released by ReleaseUpstream,
+    # so it can be held by a request which outlives the caller (an abandoned hedge)
+    def AcquireUpstream(self, catalog, big=False):
+        deadline = time.monotonic() + upstream_wait_seconds
+        with self._lock:
+            if not self._takeUpstream(catalog, big):
+                self._upstream_waits += 1
+                while not self._takeUpstream(catalog, big):
+                    remaining = deadline - time.monotonic()
+                    if not big and remaining <= 0:
+                        self._rejectUpstream(catalog)
+                    self._released.wait(remaining if not big else None)
+
+    async def AcquireUpstreamAsync(self, catalog, big=False):
+        deadline = time.monotonic() + upstream_wait_seconds
+        with self._lock:
+            taken = self._takeUpstream(catalog, big)
+            if not taken:
+                self._upstream_waits += 1
+        while not taken:
+            await asyncio.sleep(upstream_poll_interval)
+            with self._lock:
+                taken = self._takeUpstream(catalog, big)
+                if not taken and not big and time.monotonic() >= deadline:
+                    self._rejectUpstream(catalog)
+
+    # take a slot only if one is free now, outside the slots reserved for small requests; hedged requests are sent
+    # only when it succeeds
+    def TryUpstream(self, catalog):
+        with self._lock:
+            return self._takeUpstream(catalog, True)
+
+    def ReleaseUpstream(self, catalog):
+        with self._lock:
+            self._upstream_in_use[catalog] -= 1
+            self._released.notify_all()
+
+    # admit a request of the client which is estimated to return rows, the request is counted while the block runs
+    @contextmanager
+    def Client(self, client, rows=0):
+        self._admitClient(client, rows, 1)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._clients[client][0] -= 1
+                self._forgetClient(client)
+
+    # admit a request of the client which is not served while the client waits: a background job or a streamed
+    # response, its rows are taken from the quota but it is not counted among the requests served
+    def Charge(self, client, rows):
+        self._admitClient(client, rows, 0)
+        with self._lock:
+            self._forgetClient(client)
+
+    @property
+    def Stats(self):
+        with self._lock:
+            stats = {f"{catalog}_in_use": in_use for catalog, in_use in self._upstream_in_use.items()}
+            stats.update({
+                "upstream_waits": self._upstream_waits,
+                "upstream_rejections": self._upstream_rejections,
+                "client_rejections": self._client_rejections,
+                "clients": len(self._clients),
+            })
+            return stats
+
+    def _admitClient(self, client, rows, served_added):
+        now = time.monotonic()
+        with self._lock:
+            served, bucket, filled = self._clients.get(client, (0, self.rows_per_minute, now))
+            bucket = min(self.rows_per_minute, bucket + (now - filled) * self.rows_per_minute / 60)
+            if served_added and served >= self.max_concurrent:
+                self._client_rejections += 1
+                raise AdmissionRejectedError(Status_Too_Many_Requests,
+                                             f"At most {self.max_concurrent} requests of a client are served at the same time", 1)
+            # a request bigger than the whole quota is admitted when the bucket is full, it empties the bucket
+            if rows > bucket and bucket < self.rows_per_minute:
+                self._client_rejections += 1
+                retry_after = (min(rows, self.rows_per_minute) - bucket) * 60 / self.rows_per_minute
+                raise AdmissionRejectedError(Status_Too_Many_Requests,
+                                             f"Quota of {self.rows_per_minute} rows per minute is used, {int(bucket)} rows are left", retry_after)
+            self._clients[client] = [served + served_added, max(0.0, bucket - rows), now]
+
+    # the lock must be held by the caller of the methods below
+    # clients without requests served and with a full bucket are not kept
+    def _forgetClient(self, client):
+        served, bucket, filled = self._clients[client]
+        if served == 0 and bucket + (time.monotonic() - filled) * self.rows_per_minute / 60 >= self.rows_per_minute:
+            del self._clients[client]
+
+    def _takeUpstream(self, catalog, big):
+        limit = self.upstream_limits.get(catalog, default_upstream_limit)
+        if big:
+            limit = max(1, limit - reserved_slots)
+        in_use = self._upstream_in_use.get(catalog, 0)
+        if in_use >= limit:
+            return False
+        self._upstream_in_use[catalog] = in_use + 1
+        return True
+
+    def _rejectUpstream(self, catalog):
+        self._upstream_rejections += 1
+        raise AdmissionRejectedError(Status_Too_Many_Requests, f"All {catalog} request slots are busy", upstream_wait_seconds)
+
+
+# Process-wide admission control shared by all requests
+Admission_Control = AdmissionControl()
@@ -0,0 +1,181 @@
+from abc import ABC
+import asyncio
+import re
+import numpy as np
+from astropy.table import vstack
+
+from .DBAccessBase import DBAccessBase
+from .DBAccessEnums import Category
+from .QueryResult import QueryResult
+from .StageMetrics import Stage_Metrics
+
+# aggregate functions of ADQL by their names in requests, count without category counts the rows
+Aggregate_Functions = {"count": "COUNT", "avg": "AVG", "min": "MIN", "max": "MAX", "sum": "SUM"}
+
+column_row_count = "row_count"
+# column of the object type when aggregates are computed for several object types
+column_object_type = "object_types"
+
+# aggregate rows returned at most, a histogram with more bins is cut
+max_groups = 10000
+
+
+# Aggregates of the rows selected by query parameters computed by the catalog: only the aggregate rows are transferred
+# Aggregates are COUNT, AVG, MIN, MAX and SUM of categories, optionally grouped into bins of categories or of the
+# difference of two categories (a colour like BP-RP). Bins are FLOOR(value / width), every bin row also has its
+# low and high edges. With a list of object_types the aggregates are computed for every object type and returned
+# in one table with object_types column.
+# The queries are requested like catalog queries, so their results are kept in the query cache.
+class Aggregation(ABC):
+    # aggregates and bins are validated by ParseAggregates and ParseBins
+    # Returns catalog name, ADQL queries and QueryResult of the aggregate table
+    def Aggregate(self, db_access: DBAccessBase, query_params_json, aggregates, bins, cancel_event=None):
+        queries = self.__queries(db_access, query_params_json, aggregates, bins)
+        # background jobs request Gaia asynchronous endpoint, whole catalog aggregates may run for minutes
+        request_args = {"use_async": True, "cancel_event": cancel_event} if cancel_event is not None else {}
+        tables = []
+        for object_type, query in queries:
+            tables.append((object_type, db_access._requestTableCached(query, **request_args)))
+        return db_access.Catalog, ";\n".join(query for object_type, query in queries), QueryResult(self.__combined(tables, bins))
+
+    # asyncio version of Aggregate, queries of several object types are requested concurrently
+    async def AggregateAsync(self, db_access: DBAccessBase, query_params_json, aggregates, bins):
+        queries = self.__queries(db_access, query_params_json, aggregates, bins)
+        results = await asyncio.gather(*[db_access._requestTableCachedAsync(query) for object_type, query in queries])
+        tables = [(object_type, table) for (object_type, query), table in zip(queries, results)]
+        return db_access.Catalog, ";\n".join(query for object_type, query in queries), QueryResult(self.__combined(tables, bins))
+
+    # ADQL query for every object type of object_types list: [(object type, query)], or [(None, query)] without a list
+    def __queries(self, db_access, query_params_json, aggregates, bins):
+        object_types = {k.lower(): v for k, v in query_params_json.items()}.get("object_types")
+        with Stage_Metrics.Stage("adql_build"):
+            if not isinstance(object_types, list):
+                return [(None, ConstructAggregateQuery(db_access, query_params_json, aggregates, bins))]
+            if not object_types:
+                raise ValueError("Empty object_types list")
+            queries = []
+            for object_type in object_types:
+                params = {k: v for k, v in query_params_json.items() if k.lower() != "object_types"}
+                params["object_types"] = object_type
+                queries.append((object_type, ConstructAggregateQuery(db_access, params, aggregates, bins)))
+            return queries
+
+    # aggregate tables with bin edges, tables of several object types are stacked with object_types column
+    def __combined(self, tables, bins):
+        results = []
+        for object_type, table in tables:
+            table = table.copy(copy_data=False)
+            for category, minus, width in bins:
+                alias = _binAlias(category, minus)
+                values = np.ma.filled(np.ma.asarray(table[alias], dtype=np.float64), np.nan)
+                table[alias[:-len("bin")] + "low"] = values * width
+                table[alias[:-len("bin")] + "high"] = (values + 1) * width
+            if object_type is not None:
+                table.add_column([object_type] * len(table), name=column_object_type, index=0)
+            results.append(table)
+        if len(results) == 1:
+            return results[0]
+        return vstack(results, join_type="outer", metadata_conflicts="silent")
+
+
+# ADQL query of the aggregates over the rows selected by query parameters
+def ConstructAggregateQuery(db_access: DBAccessBase, query_params_json, aggregates, bins, extra_condition=None):
+    try:
+        from_clause, where_clause, table_aliases = db_access._constructFromWhere(query_params_json)
+    except NotImplementedError:
+        raise ValueError(f"Aggregates are not supported for {db_access.Catalog}")
+    # condition added by the caller, for example the sample of the catalog statistics are collected on
+    if extra_condition:
+        where_clause = db_access._addConditionToWhere(where_clause, extra_condition)
+
+    select_items = []
+    group_items = []
+    for category, minus, width in bins:
+        expression = _categoryColumn(db_access, category, from_clause)
+        where_clause = db_access._addConditionToWhere(where_clause, f"{expression} IS NOT NULL")
+        if minus is not None:
+            minus_column = _categoryColumn(db_access, minus, from_clause)
+            where_clause = db_access._addConditionToWhere(where_clause, f"{minus_column} IS NOT NULL")
+            expression = f"({expression} - {minus_column})"
+        alias = _binAlias(category, minus)
+        select_items.append(f"FLOOR({expression} / {width}) AS {alias}")
+        group_items.append(alias)
+
+    for function, category in aggregates:
+        if category is None:
+            select_items.append(f"COUNT(*) AS {column_row_count}")
+        else:
+            select_items.append(f"{Aggregate_Functions[function]}({_categoryColumn(db_access, category, from_clause)}) AS {function}_{category.name}")
+
+    query = f"SELECT TOP {max_groups} " + ", ".join(select_items) + "\n FROM " + from_clause
+    if where_clause != "":
+        query += "\n WHERE " + where_clause
+    if group_items:
+        query += "\n GROUP BY " + ", ".join(group_items) + "\n ORDER BY " + ", ".join(group_items)
+    return query
+
+
+# validate aggregates of the request, a list of {"function": "avg", "category": "Parallax"}
+# Returns [(function, Category or None for row count)], the row count if no aggregates are requested
+def ParseAggregates(aggregates):
+    if not aggregates:
+        return [("count", None)]
+    if not isinstance(aggregates, list):
+        raise ValueError(f"Invalid aggregates={aggregates}, expected a list of {{function, category}}")
+    parsed = []
+    for aggregate in aggregates:
+        if not isinstance(aggregate, dict):
+            raise ValueError(f"Invalid aggregate {aggregate}, expected {{function, category}}")
+        function = str(aggregate.get("function", "")).lower()
+        if function not in Aggregate_Functions:
+            raise ValueError(f"Not supported aggregate function: {function}, expected one of {', '.join(Aggregate_Functions)}")
+        category = _category(aggregate.get("category")) if aggregate.get("category") else None
+        if category is None and function != "count":
+            raise ValueError(f"Aggregate function {function} requires a category")
+        parsed.append((function, category))
+    return parsed
+
+
+# validate bins of the request, a list of {"category": "BPMagnitude", "minus": "RPMagnitude", "width": 0.1}, minus is optional
+# Returns [(Category, Category subtracted from it or None, width)]
+def ParseBins(bins):
+    if not bins:
+        return []
+    if not isinstance(bins, list):
+        raise ValueError(f"Invalid bins={bins}, expected a list of {{category, width}}")
+    parsed = []
+    for bin_spec in bins:
+        if not isinstance(bin_spec, dict):
+            raise ValueError(f"Invalid bin {bin_spec}, expected {{category, width}}")
+        category = _category(bin_spec.get("category"))
+        minus = _category(bin_spec.get("minus")) if bin_spec.get("minus") else None
+        try:
+            width = float(bin_spec.get("width"))
+        except (TypeError, ValueError):
+            raise ValueError(f"Cannot convert to number bin width: {bin_spec.get('width')}")
+        if not width > 0:
+            raise ValueError(f"Bin width must be positive: {width}")
+        parsed.append((category, minus, width))
+    return parsed
+
+
+# Category by its name in any case
+def _category(name):
+    for category in Category:
+        if category.name.lower() == str(name).lower() and category != Category.ObjectsInCircle:
+            return category
+    raise ValueError(f"Not supported category: {name}")
+
+
+# column of the category in the query, the category must have a column in a table of FROM clause
+def _categoryColumn(db_access, category, from_clause):
+    field_data = db_access.CategoryInfo.get(category)
+    if not field_data or not field_data[0] or not re.search(rf"\bAS\s+{field_data[1]}\b", from_clause):
+        raise ValueError(f"{category.name} is not available in {db_access.Catalog} for the selected object type")
+    return field_data[0]
+
+
+def _binAlias(category, minus):
+    if minus is None:
+        return f"{category.name}_bin"
+    return f"{category.name}_minus_{minus.name}_bin"
@@ -0,0 +1,101 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+
+try:
+    import httpx
+except ImportError:  # httpx is required only by the asyncio serving mode (API/StellarisASGI.py)
+    httpx = None
+
+from .HttpTransport import Connect_Timeout, Read_Timeout, Max_Retries, Backoff_Factor, Backoff_Jitter, Retry_Status_Codes, Idempotent_Methods
+
+# connections are not held by threads here, so one event loop may keep hundreds of slow TAP queries in flight
+Max_Connections = 512
+Max_Keepalive_Connections = 64
+
+
+# Shared asyncio HTTP transport for catalog backends, the asyncio counterpart of HttpTransport
+# One httpx client keeps keep-alive connections of every host. Connection errors, and 5xx responses of idempotent
+# requests, are retried with the same jittered exponential backoff as HttpTransport, the last 5xx response is returned
+# to the caller. POST (TAP job creation) is retried only when the connection failed, as in HttpTransport.
+# Compressed responses are requested and decoded by httpx (gzip, deflate, and br or zstd when their packages are installed).
+class AsyncHttpTransport:
+    def __init__(self, max_connections=Max_Connections, max_keepalive_connections=Max_Keepalive_Connections,
+                 connect_timeout=Connect_Timeout, read_timeout=Read_Timeout, max_retries=Max_Retries,
+                 backoff_factor=Backoff_Factor, backoff_jitter=Backoff_Jitter):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+
+        self._client = None
+        self._loop = None
+
+    # client of the running event loop, created on first use: httpx connections belong to the loop they were opened in
+    @property
+    def Client(self):
+        if httpx is None:
+            raise RuntimeError("asyncio serving mode requires httpx, which is not installed on the server")
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=self.read_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive_connections))
+            self._loop = loop
+        return self._client
+
+    # response with the body read
+    async def Post(self, url, **kwargs):
+        return await self._send("POST", url, False, **kwargs)
+
+    async def Get(self, url, **kwargs):
+        return await self._send("GET", url, False, **kwargs)
+
+    async def Delete(self, url, **kwargs):
+        return await self._send("DELETE", url, False, **kwargs)
+
+    # response whose body is read by the caller with aiter_bytes(), the response is closed when the block exits
+    #   async with Async_Http_Transport.Stream("POST", url, data=params) as response:
+    #       async for chunk in response.aiter_bytes(): ...
+    @asynccontextmanager
+    async def Stream(self, method, url, **kwargs):
+        response = await self._send(method, url, True, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    # close pooled connections, the next request opens a new client
+    async def Close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def _send(self, method, url, stream, **kwargs):
+        client = self.Client
+        follow_redirects = kwargs.pop("follow_redirects", True)
+        idempotent = method in Idempotent_Methods
+        attempt = 0
+        while True:
+            try:
+                response = await client.send(client.build_request(method, url, **kwargs), stream=stream,
+                                             follow_redirects=follow_redirects)
+            except httpx.TransportError as e:
+                # read timeouts are not retried: TAP query which timed out once would time out again
+                not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if attempt >= self.max_retries or not (not_sent or (idempotent and not isinstance(e, httpx.TimeoutException))):
+                    raise
+            else:
+                if response.status_code not in Retry_Status_Codes or not idempotent or attempt >= self.max_retries:
+                    return response
+                await response.aclose()
+            attempt += 1
+            await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1) + random.uniform(0, self.backoff_jitter))
+
+
+# Transport shared by all catalog backends and cross matching in the asyncio serving mode
+Async_Http_Transport = AsyncHttpTransport()
@@ -0,0 +1,91 @@
+import importlib
+import os
+import threading
+
+# catalog backends of the API: name -> "module:class" built with no arguments
+Default_Backends = {
+    "gaia": "DBaccess.DBAccessGaia:DBAccessGaia",
+    "sdss": "DBaccess.DBAccessSDSS:DBAccessSDSS",
+    "stellaris": "DBaccess.DBAccessStellaris:DBAccessStellaris",
+    "simbad": "DBaccess.DBAccessSimbad:DBAccessSimbad",
+}
+
+# more backends, or other classes of the default ones: STELLARIS_BACKENDS="name=module:class,name=module:class"
+Backends_Variable = "STELLARIS_BACKENDS"
+
+
+# Catalog backends registered by name and built on first use
+# A backend is registered as "module:class" path, so its module (and the scientific packages the module imports) is
+# imported only when a request needs the catalog, or as a function building the backend. Every backend is built once
+# and shared by all requests. A backend which fails to build is built again by the next request needing it.
+class BackendRegistry:
+    def __init__(self, backends=None):
+        self._factories = {}  # name -> "module:class" or function
+        self._backends = {}  # name -> built backend
+        self._lock = threading.Lock()
+        for name, factory in (backends or {}).items():
+            self.Register(name, factory)
+
+    # register backend of the catalog, a backend registered before under the name is replaced
+    def Register(self, name, factory):
+        if not callable(factory) and (not isinstance(factory, str) or ":" not in factory):
+            raise ValueError(f"Backend of {name} should be a function or \"module:class\" path, not {factory!r}")
+        with self._lock:
+            self._factories[name.lower()] = factory
+            self._backends.pop(name.lower(), None)
+
+    # backend of the catalog built on first use, None if no backend is registered under the name
+    def Get(self, name):
+        name = name.lower()
+        backend = self._backends.get(name)
+        if backend is not None:
+            return backend
+        with self._lock:
+            factory = self._factories.get(name)
+            if factory is None:
+                return None
+            backend = self._backends.get(name)
+            if backend is None:
+                backend = self._backends[name] = _build(factory)
+            return backend
+
+    @property
+    def Names(self):
+        with self._lock:
+            return list(self._factories)
+
+    # build every registered backend, names of the backends which failed -> error
+    def Warm(self):
+        errors = {}
+        for name in self.Names:
+            try:
+                self.Get(name)
+            except Exception as e:
+                errors[name] = str(e)
+        return errors
+
+    @property
+    def Stats(self):
+        with self._lock:
+            return {"registered": len(self._factories), "built": len(self._backends)}
+
+
+def _build(factory):
+    if callable(factory):
+        return factory()
+    module_name, class_name = factory.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# backends of STELLARIS_BACKENDS added to the default ones
+def _configuredBackends():
+    backends = dict(Default_Backends)
+    for entry in (os.environ.get(Backends_Variable) or "").split(","):
+        if entry.strip():
+            name, _, factory = entry.partition("=")
+            backends[name.strip()] = factory.strip()
+    return backends
+
+
+# Process-wide registry shared by all requests
+Backend_Registry = BackendRegistry(_configuredBackends())
@@ -0,0 +1,256 @@
+import math
+import os
+import tempfile
+
+import numpy as np
+from astropy.table import Table, vstack
+
+from .DBAccessEnums import Category
+from .QueryCache import QueryCache, NormalizeQuery
+from .Resilience import Upstream_Resilience
+from .SingleFlight import Single_Flight
+
+# Gaia source_id contains HEALPix index of the source at order 12 (nested scheme): healpix_12 = source_id // 2**35
+Source_Id_Healpix_Shift = 35
+Max_Order = 12
+Min_Order = 4
+
+# cones larger than this radius (degrees) are requested as usual, their tiles would hold too many rows
+Max_Cone_Radius = 1.0
+# at most this number of tiles is requested for one cone
+Max_Tiles_Per_Cone = 256
+# tiles are not cached if the batch of missing tiles has more rows, the cone is requested as usual then
+# the tiles of such a batch are marked as too dense in the tile cache, so cones needing them are not fetched again
+Max_Tile_Rows = 200000
+# cached tiles of coarser orders are used for finer tiles of the same sky region
+Parent_Orders_Lookup = 3
+
+Tile_Cache_Dir = os.path.join(tempfile.gettempdir(), "stellaris_tile_cache")
+
+
+# Cache of cone search results split into HEALPix tiles
+# A cone is covered by tiles of an order chosen by its radius. Tiles which are not cached are requested in one ADQL
+# query by their source_id ranges, with the same filters as the cone query except the cone itself. The cone is then
+# answered from the tiles by a vectorized angular distance test. Tiles of a batch with more than Max_Tile_Rows rows
+# get a "too dense" marker instead, which expires with the tiles; cones needing a marked tile skip the tile cache.
+class ConeTileCache:
+    def __init__(self, tile_cache):
+        self._tiles = tile_cache
+
+    # rows of the cone query from the tiles or None if the query is not a cone search suitable for tiles
+    def QueryCone(self, db_access, query_params_json, limit, query):
+        cone = self._coneParams(query_params_json)
+        if cone is None or "CONTAINS(" not in query:
+            return None
+        ra, dec, radius = cone
+        if radius <= 0 or radius > Max_Cone_Radius:
+            return None
+
+        # the same query without the cone and without limit, tiles of different cones with the same filters are shared
+        tile_params = {k: v for k, v in query_params_json.items() if k.lower() != Category.ObjectsInCircle.name.lower()}
+        tiles_query = db_access._constructADQLQuery(tile_params, None, None)
+
+        order = self._chooseOrder(radius)
+        pixels = ConePixels(ra, dec, radius, order)
+        if len(pixels) > Max_Tiles_Per_Cone:
+            return None
+
+        tables = []
+        missing_pixels = []
+        for pixel in pixels:
+            table = self._getTile(db_access.Catalog, tiles_query, order, pixel)
+            if table is None:
+                missing_pixels.append(pixel)
+            else:
+                tables.append(table)
+
+        if missing_pixels:
+            if self._anyDense(db_access.Catalog, tiles_query, order, missing_pixels):
+                return None
+            fetched = self._fetchTiles(db_access, tile_params, tiles_query, order, missing_pixels)
+            if fetched is None:
+                return None
+            tables.append(fetched)
+
+        table = vstack(tables, join_type="exact") if len(tables) > 1 else tables[0]
+
+        # rows inside the cone, ordered by source id
+        distance = AngularDistance(ra, dec, np.ma.filled(table[Category.RA.name], np.nan), np.ma.filled(table[Category.Dec.name], np.nan))
+        table = table[distance <= radius]
+        table.sort(db_access.ColumnId)
+        if limit:
+            table = table[:limit]
+        return table
+
+    # cached tile or the part of a cached coarser tile which covers it
+    def _getTile(self, catalog, tiles_query, order, pixel):
+        for parent_order in range(order, max(order - Parent_Orders_Lookup, Min_Order) - 1, -1):
+            parent_pixel = pixel >> (2 * (order - parent_order))
+            table = self._tiles.Get(self._tileName(catalog, parent_order, parent_pixel), tiles_query)
+            if table is not None:
+                if parent_order == order:
+                    return table
+                low, high = SourceIdRange(order, pixel)
+                source_id = np.asarray(table[table.colnames[0]], dtype=np.int64)
+                return table[(source_id >= low) & (source_id <= high)]
+        return None
+
+    # request missing tiles in one query, store every tile separately and return all fetched rows
+    # concurrent cones missing the same tiles wait for one request, the fetched table is shared and must not be changed
+    def _fetchTiles(self, db_access, tile_params, tiles_query, order, pixels):
+        ranges = []
+        for pixel in sorted(pixels):
+            low, high = SourceIdRange(order, pixel)
+            # neighbour tiles in nested scheme have adjacent source_id ranges, they are requested as one range
+            if ranges and ranges[-1][1] + 1 == low:
+                ranges[-1][1] = high
+            else:
+                ranges.append([low, high])
+        condition = "(" + " OR ".join(f"gs.source_id BETWEEN {low} AND {high}" for low, high in ranges) + ")"
+
+        query = db_access._constructADQLQuery(tile_params, Max_Tile_Rows + 1, None, extra_condition=condition)
+        return Single_Flight.Do(("tiles", db_access.Catalog, NormalizeQuery(query)),
+                                lambda: self._requestTiles(db_access, query, tiles_query, order, pixels))
+
+    def _requestTiles(self, db_access, query, tiles_query, order, pixels):
+        table = Upstream_Resilience.Call(db_access.Catalog, query, lambda: db_access._requestTable(query))
+        if len(table) > Max_Tile_Rows:
+            marker = Table({"rows": [len(table)]})
+            for pixel in pixels:
+                self._tiles.Put(self._denseName(db_access.Catalog, order, pixel), tiles_query, marker)
+            return None
+
+        tile_pixels = np.asarray(table[table.colnames[0]], dtype=np.int64) >> (Source_Id_Healpix_Shift + 2 * (Max_Order - order))
+        for pixel in pixels:
+            self._tiles.Put(self._tileName(db_access.Catalog, order, pixel), tiles_query, table[tile_pixels == pixel])
+        return table
+
+    # True if a tile is marked as too dense to be fetched
+    def _anyDense(self, catalog, tiles_query, order, pixels):
+        return any(self._tiles.Get(self._denseName(catalog, order, pixel), tiles_query) is not None for pixel in pixels)
+
+    @staticmethod
+    def _tileName(catalog, order, pixel):
+        return f"{catalog}-tile-{order}-{pixel}"
+
+    @staticmethod
+    def _denseName(catalog, order, pixel):
+        return f"{catalog}-dense-{order}-{pixel}"
+
+    # tile size is about half of the cone radius, so a cone is covered by a few dozens tiles
+    @staticmethod
+    def _chooseOrder(radius):
+        order = math.ceil(math.log2(PixelSize(0) / (radius / 2)))
+        return min(max(order, Min_Order), Max_Order)
+
+    # center and radius of ObjectsInCircle in degrees or None if the query has no cone
+    @staticmethod
+    def _coneParams(query_params_json):
+        query_params_json = {k.lower(): v for k, v in query_params_json.items()}
+        objects_in_circle = query_params_json.get(Category.ObjectsInCircle.name.lower())
+        if not isinstance(objects_in_circle, dict):
+            return None
+        try:
+            return (float(objects_in_circle.get(Category.RA.name.lower())),
+                    float(objects_in_circle.get(Category.Dec.name.lower())),
+                    float(objects_in_circle.get(Category.Radius.name.lower())))
+        except (TypeError, ValueError):
+            return None
+
+
+# approximate size of HEALPix pixel of the order in degrees (square root of its area)
+def PixelSize(order):
+    return math.degrees(math.sqrt(4 * math.pi / (12 * 4 ** order)))
+
+
+# source_id range [low, high] of sources inside HEALPix pixel of the order
+def SourceIdRange(order, pixel):
+    shift = Source_Id_Healpix_Shift + 2 * (Max_Order - order)
+    return pixel << shift, ((pixel + 1) << shift) - 1
+
+
+# HEALPix pixels (nested scheme) of the order which intersect the cone
+# Points of a dense grid over the cone widened by a pixel diameter are mapped to pixels, the grid step is a quarter of
+# the pixel size, so every pixel intersecting the cone contains grid points
+def ConePixels(ra, dec, radius, order):
+    pixel_size = PixelSize(order)
+    outer_radius = radius + 2 * pixel_size
+    step = pixel_size / 4
+    steps = int(math.ceil(outer_radius / step))
+    offsets = np.radians(np.arange(-steps, steps + 1) * step)
+    x, y = np.meshgrid(offsets, offsets)
+    inside = np.hypot(x, y) <= math.radians(outer_radius)
+    x, y = np.tan(x[inside]), np.tan(y[inside])
+
+    # inverse gnomonic projection around the cone center
+    ra0, dec0 = math.radians(ra), math.radians(dec)
+    center = np.array([math.cos(dec0) * math.cos(ra0), math.cos(dec0) * math.sin(ra0), math.sin(dec0)])
+    east = np.array([-math.sin(ra0), math.cos(ra0), 0.0])
+    north = np.array([-math.sin(dec0) * math.cos(ra0), -math.sin(dec0) * math.sin(ra0), math.cos(dec0)])
+    vectors = center + x[:, None] * east + y[:, None] * north
+    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+
+    points_ra = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0]))
+    points_dec = np.degrees(np.arcsin(np.clip(vectors[:, 2], -1.0, 1.0)))
+    return np.unique(AngToPixNest(order, points_ra, points_dec)).tolist()
+
+
+# HEALPix index in nested scheme for positions in degrees (Gorski et al. 2005, as in healpix ang2pix_nest)
+def AngToPixNest(order, ra, dec):
+    nside = 1 << order
+    z = np.sin(np.radians(dec))
+    z_abs = np.abs(z)
+    tt = (np.radians(ra) % (2 * np.pi)) / (np.pi / 2)  # in [0, 4)
+
+    # equatorial region
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)  # index of ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # index of descending edge line
+    ifp = jp // nside
+    ifm = jm // nside
+    face_equatorial = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix_equatorial = jm & (nside - 1)
+    iy_equatorial = nside - (jp & (nside - 1)) - 1
+
+    # polar regions
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3 * (1 - z_abs))
+    jp_polar = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm_polar = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_polar = np.where(north, ntt, ntt + 8)
+    ix_polar = np.where(north, nside - jm_polar - 1, jp_polar)
+    iy_polar = np.where(north, nside - jp_polar - 1, jm_polar)
+
+    equatorial = z_abs <= 2.0 / 3.0
+    face = np.where(equatorial, face_equatorial, face_polar)
+    ix = np.where(equatorial, ix_equatorial, ix_polar)
+    iy = np.where(equatorial, iy_equatorial, iy_polar)
+    return face * nside * nside + _spreadBits(ix) + (_spreadBits(iy) << 1)
+
+
+# interleave bits of x with zeros: bit i goes to bit 2i
+def _spreadBits(x):
+    x = x.astype(np.int64) & 0xFFFFFFFF
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+    return x
+
+
+# angular distance in degrees between (ra, dec) and arrays of positions, haversine formula
+def AngularDistance(ra, dec, ra_array, dec_array):
+    ra1, dec1 = math.radians(ra), math.radians(dec)
+    ra2, dec2 = np.radians(ra_array), np.radians(dec_array)
+    sin_ddec = np.sin((dec2 - dec1) / 2)
+    sin_dra = np.sin((ra2 - ra1) / 2)
+    haversine = sin_ddec ** 2 + math.cos(dec1) * np.cos(dec2) * sin_dra ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(haversine, 0.0, 1.0))))
+
+
+# Process-wide tile cache used by Gaia cone searches
+Cone_Tile_Cache = ConeTileCache(QueryCache(max_entries=1024, cache_dir=Tile_Cache_Dir, ttl_seconds=24 * 3600))
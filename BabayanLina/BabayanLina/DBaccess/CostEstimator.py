@@ -0,0 +1,258 @@
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .DBAccessEnums import Category
+from .QueryCache import Query_Cache
+
+# Location of collected catalog statistics, they are kept between restarts of the API
+Statistics_Path = os.path.join(tempfile.gettempdir(), "stellaris_catalog_statistics.json")
+
+# rows of the whole catalogs used until COUNT probes answer: Gaia DR3 gaia_source and SIMBAD basic
+Default_Catalog_Rows = {"gaia": 1811709771, "simbad": 18000000}
+
+# selectivity of a range filter when the catalog has no histogram of its column yet
+default_range_selectivity = 1 / 3
+
+# widths of histogram bins of the columns statistics are collected for
+Statistics_Bin_Widths = {
+    Category.RA: 1.0, Category.Dec: 1.0, Category.PMRA: 1.0, Category.PMDec: 1.0, Category.Parallax: 0.5,
+    Category.ProperMotion: 1.0, Category.GMagnitude: 0.25, Category.BPMagnitude: 0.25, Category.RPMagnitude: 0.25,
+    Category.RadialVelocity: 5.0, Category.Mass: 0.1, Category.Radius: 0.1, Category.Luminosity: 1.0,
+    Category.Temperature: 100.0, Category.Gravity: 0.1,
+}
+
+# collected statistics are collected again after this time
+statistics_ttl = 7 * 24 * 3600
+
+# STELLARIS_STATISTICS_PROBES: sampled - statistics of catalogs with a random sample column (Gaia random_index) are
+# collected on Statistics_Sample_Rows rows, other catalogs are estimated with defaults; full - every catalog is probed
+# over all its rows (whole-catalog COUNT and histogram jobs); off - no probes, estimates use defaults and cached COUNTs
+Probes_Sampled = "sampled"
+Probes_Full = "full"
+Probes_Off = "off"
+statistics_probes = (os.environ.get("STELLARIS_STATISTICS_PROBES") or Probes_Sampled).lower()
+Statistics_Sample_Rows = 1000000
+# seconds between probe queries, so collecting statistics is never a burst of catalog jobs
+probe_interval = 10.0
+# statistics which failed to be collected are not probed again before this time
+probe_retry_seconds = 3600
+
+Basis_Count = "count"
+Basis_Statistics = "statistics"
+Basis_Defaults = "defaults"
+
+
+# Predicted size of a catalog query
+class QueryCost:
+    def __init__(self, catalog, matching_rows, limit, basis):
+        self.catalog = catalog
+        # rows matching the filters and rows the query returns, no more than its limit
+        self.matching_rows = int(matching_rows)
+        self.rows = int(min(matching_rows, limit)) if limit else int(matching_rows)
+        # count: exact COUNT of the filters, statistics: histograms of the catalog, defaults: no statistics yet
+        self.basis = basis
+
+    def ToDict(self):
+        return {"catalog": self.catalog, "estimated_rows": self.rows, "matching_rows": self.matching_rows, "basis": self.basis}
+
+
+# Estimates the number of rows a query returns from its query parameters before the catalog is requested
+# A COUNT of the same filters in the query cache (for example from /aggregate) is exact. Otherwise the rows of the
+# catalog (or of the object type) are multiplied by the selectivity of every range filter, taken from histograms of
+# the column, and by the fraction of the sky covered by the cone. Histograms and row counts are collected by
+# aggregate probes in a background thread, estimates never wait for them and use defaults until they answer.
+# Probes run one at a time, probe_interval apart, on a random sample of the catalog (see statistics_probes).
+class CostEstimator:
+    def __init__(self, statistics_path=Statistics_Path, ttl_seconds=statistics_ttl):
+        self.statistics_path = statistics_path
+        self.ttl_seconds = ttl_seconds
+
+        self._statistics = None  # "catalog:object type" -> {"collected": time, "rows": N, "histograms": {...}}
+        self._collecting = set()
+        self._failed = {}  # "catalog:object type" -> time of the failed collection
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stellaris-statistics")
+
+    # QueryCost of the query or None if the catalog has no ADQL queries (the local catalog answers any query quickly)
+    def Estimate(self, db_access, query_params_json, limit):
+        try:
+            from_clause, where_clause, table_aliases = db_access._constructFromWhere(query_params_json)
+        except NotImplementedError:
+            return None
+
+        # an exact COUNT of these filters is known
+        count = self._cachedCount(db_access, query_params_json)
+        if count is not None:
+            return QueryCost(db_access.Catalog, count, limit, Basis_Count)
+
+        object_type = _objectType(query_params_json)
+        statistics = self._getStatistics(db_access, object_type)
+        basis = Basis_Statistics if statistics else Basis_Defaults
+        rows = (statistics or {}).get("rows") or Default_Catalog_Rows.get(db_access.Catalog, 0)
+        histograms = (statistics or {}).get("histograms", {})
+
+        params = {k.lower(): v for k, v in query_params_json.items()}
+        for category, field_data in db_access.CategoryInfo.items():
+            # filters the catalog ignores (no column or its table is not joined) don't select rows
+            if not field_data[0] or field_data[1] not in table_aliases:
+                continue
+            low = _number(params.get('min_' + category.name.lower()))
+            high = _number(params.get('max_' + category.name.lower()))
+            if low is None and high is None:
+                continue
+            histogram = histograms.get(category.name)
+            if histogram is None:
+                rows *= default_range_selectivity
+            else:
+                rows *= _histogramSelectivity(histogram, low, high)
+
+        cone = params.get(Category.ObjectsInCircle.name.lower())
+        if isinstance(cone, dict) and Category.ObjectsInCircle in db_access.CategoryInfo:
+            radius = _number(cone.get(Category.Radius.name.lower()))
+            if radius:
+                # fraction of the sphere inside the circle, sources are taken to be spread evenly
+                rows *= (1 - math.cos(math.radians(min(radius, 180.0)))) / 2
+        return QueryCost(db_access.Catalog, math.ceil(rows), limit, basis)
+
+    @property
+    def Stats(self):
+        with self._lock:
+            statistics = self._statistics or {}
+            return {"catalogs_with_statistics": len(statistics), "collecting": len(self._collecting), "failed": len(self._failed)}
+
+    # exact COUNT of the filters if the query cache has it, the cache is not waited for and no request is sent
+    # Aggregation and the scientific packages it needs are imported by the first estimate, not by the API
+    def _cachedCount(self, db_access, query_params_json):
+        from .Aggregation import ConstructAggregateQuery
+        try:
+            count_query = ConstructAggregateQuery(db_access, query_params_json, [("count", None)], [])
+        except ValueError:
+            return None
+        # a peek: estimates are not cache requests, they would turn every estimate into a miss of the cache statistics
+        table = Query_Cache.Peek(db_access.Catalog, count_query)
+        if table is None or len(table) == 0:
+            return None
+        return int(table[table.colnames[0]][0])
+
+    # statistics of the catalog and object type, stale or absent statistics are collected in the background
+    def _getStatistics(self, db_access, object_type):
+        key = f"{db_access.Catalog}:{object_type}"
+        with self._lock:
+            if self._statistics is None:
+                self._statistics = self._readStatistics()
+            statistics = self._statistics.get(key)
+            stale = statistics is None or time.time() - statistics["collected"] > self.ttl_seconds
+            failed_at = self._failed.get(key)
+            if stale and key not in self._collecting and (failed_at is None or time.time() - failed_at > probe_retry_seconds):
+                probe, sample_condition = self._probeSample(db_access)
+                if probe:
+                    self._collecting.add(key)
+                    self._executor.submit(self._collectStatistics, db_access, object_type, key, sample_condition)
+        return statistics
+
+    # whether the catalog is probed and the condition of the sample the probes run on, None for the whole catalog
+    @staticmethod
+    def _probeSample(db_access):
+        if statistics_probes == Probes_Full:
+            return True, None
+        if statistics_probes != Probes_Sampled or db_access.Catalog not in Default_Catalog_Rows:
+            return False, None
+        sample_condition = db_access._sampleCondition(Statistics_Sample_Rows)
+        return sample_condition is not None, sample_condition
+
+    # COUNT of the rows and a histogram of every column of the catalog, probes are requested like background jobs,
+    # so Gaia runs them as asynchronous jobs, and their results go to the query cache
+    # on a sample the COUNT is scaled to the rows of the whole catalog, histograms are used as fractions anyway
+    def _collectStatistics(self, db_access, object_type, key, sample_condition):
+        import numpy as np
+        from .Aggregation import ConstructAggregateQuery
+        try:
+            params = {"object_types": object_type} if object_type else {}
+            from_clause, where_clause, table_aliases = db_access._constructFromWhere(params)
+            request_args = {"use_async": True, "cancel_event": threading.Event()}
+            scale = Default_Catalog_Rows[db_access.Catalog] / Statistics_Sample_Rows if sample_condition else 1
+
+            count_table = db_access._requestTableCached(ConstructAggregateQuery(db_access, params, [("count", None)], [], sample_condition), **request_args)
+            statistics = {"collected": time.time(), "rows": int(count_table[count_table.colnames[0]][0] * scale),
+                          "sampled": bool(sample_condition), "histograms": {}}
+            for category, width in Statistics_Bin_Widths.items():
+                field_data = db_access.CategoryInfo.get(category)
+                if not field_data or not field_data[0] or field_data[1] not in table_aliases:
+                    continue
+                time.sleep(probe_interval)
+                try:
+                    query = ConstructAggregateQuery(db_access, params, [("count", None)], [(category, None, width)], sample_condition)
+                    table = db_access._requestTableCached(query, **request_args)
+                except Exception:
+                    continue
+                bins = np.ma.filled(np.ma.asarray(table[table.colnames[0]], dtype=np.float64), np.nan)
+                counts = np.ma.filled(np.ma.asarray(table[table.colnames[1]], dtype=np.float64), 0)
+                statistics["histograms"][category.name] = {"width": width, "bins": bins.tolist(), "counts": counts.tolist()}
+
+            with self._lock:
+                self._statistics[key] = statistics
+                self._failed.pop(key, None)
+                self._writeStatistics()
+        except Exception:
+            # the catalog is not available, defaults are used until the next attempt after probe_retry_seconds
+            with self._lock:
+                self._failed[key] = time.time()
+        finally:
+            with self._lock:
+                self._collecting.discard(key)
+
+    # the lock must be held by the caller of the methods below
+    def _readStatistics(self):
+        try:
+            with open(self.statistics_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeStatistics(self):
+        try:
+            temporary_path = self.statistics_path + ".tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(self._statistics, file)
+            os.replace(temporary_path, self.statistics_path)
+        except OSError:
+            pass
+
+
+# fraction of the histogram rows between low and high, rows of partly covered bins are taken to be spread evenly
+def _histogramSelectivity(histogram, low, high):
+    import numpy as np
+    width = histogram["width"]
+    bin_low = np.asarray(histogram["bins"], dtype=np.float64) * width
+    counts = np.asarray(histogram["counts"], dtype=np.float64)
+    total = counts.sum()
+    if total <= 0:
+        return default_range_selectivity
+    covered_low = np.maximum(bin_low, -np.inf if low is None else low)
+    covered_high = np.minimum(bin_low + width, np.inf if high is None else high)
+    covered = np.clip((covered_high - covered_low) / width, 0.0, 1.0)
+    return float((counts * covered).sum() / total)
+
+
+def _objectType(query_params_json):
+    object_type = {k.lower(): v for k, v in query_params_json.items()}.get("object_types")
+    return str(object_type).lower() if object_type else ""
+
+
+# filter value as number, empty and zero values are not filters, the catalogs don't apply them
+def _number(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Process-wide estimator shared by all requests
+Cost_Estimator = CostEstimator()
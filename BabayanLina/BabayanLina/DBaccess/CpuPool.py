@@ -0,0 +1,81 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# tasks on fewer rows or bytes run in the calling thread, sending them to a worker process costs more than the work
+Inline_Max_Rows = 5000
+Inline_Max_Bytes = 512 * 1024
+
+# modules of the functions run in the workers, every worker imports them when it starts, not on its first task
+Worker_Modules = ["DBaccess.VOTableStream", "DBaccess.EpochPropagation", "DBaccess.CrossMatching", "DBaccess.FederatedQuery",
+                  "API.ResponseFormats"]
+
+
+# Pool of worker processes for CPU-heavy steps of the asyncio serving mode: VOTable decoding, epoch propagation,
+# cross match join and response serialization. The event loop only awaits their results, so it keeps serving other
+# requests while a big table is processed, and CPU work of concurrent requests runs on all cores despite the GIL.
+# Arguments and results are pickled to and from the workers; functions must be importable module-level functions.
+# Workers are started with "spawn" on first use: forking a process with running threads and an event loop is unsafe.
+# With workers=0 tasks run in threads of the default executor instead.
+class CpuPool:
+    def __init__(self, workers=None):
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # number of worker processes, None is the number of CPUs; changes take effect when the pool is started next time
+    def Configure(self, workers=None):
+        self.Shutdown()
+        self._workers = workers
+
+    @property
+    def Workers(self):
+        return self._workers if self._workers is not None else (os.cpu_count() or 1)
+
+    # function(*args) computed in a worker process, tasks smaller than the inline limits run right in the caller
+    async def Run(self, function, *args, rows=None, size=None):
+        if (rows is not None and rows <= Inline_Max_Rows) or (size is not None and size <= Inline_Max_Bytes):
+            return function(*args)
+        if self.Workers == 0:
+            return await asyncio.to_thread(function, *args)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._getExecutor(), function, *args)
+        except BrokenProcessPool:
+            # a worker was killed (out of memory for example), the next task starts a new pool
+            self.Shutdown()
+            raise
+
+    def Shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def Stats(self):
+        return {"workers": self.Workers, "started": int(self._executor is not None)}
+
+    def _getExecutor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.Workers, mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=_importModules, initargs=(Worker_Modules,))
+            return self._executor
+
+
+# initializer of a worker, a module which fails to import fails only the tasks needing it
+def _importModules(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+
+
+# Process-wide pool, STELLARIS_CPU_WORKERS sets the number of its workers (0 runs CPU-heavy steps in threads)
+Cpu_Pool = CpuPool(int(os.environ["STELLARIS_CPU_WORKERS"]) if os.environ.get("STELLARIS_CPU_WORKERS") else None)
@@ -1,145 +1,681 @@
 from abc import ABC
-import pyvo
-from astropy.table import join
+import asyncio
+import contextvars
+import re
+import time
+from io import BytesIO
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.table import join, vstack
+from astropy.io.votable import from_table
 from .DBAccessEnums import Category
 from DBaccess.RequestProcessingError import RequestProcessingError
 from DBaccess.RequestProcessingError import CrossMatchRequestProcessingError
-from astropy.table import Table
-from astropy.coordinates import SkyCoord
+from DBaccess.RequestProcessingError import UpstreamUnavailableError
+from astropy.table import Table, Column, MaskedColumn
 import astropy.units as u
-from astropy.time import Time
 
 from .DBAccessBase import DBAccessBase
+from .QueryResult import QueryResult
+from .QueryCache import NormalizeQuery
+from .SingleFlight import Single_Flight, Async_Single_Flight
+from .HttpTransport import Http_Transport
+from .AsyncHttpTransport import Async_Http_Transport
+from .CpuPool import Cpu_Pool
+from .VOTableStream import ReadVOTableBytes
+from .SpatialMatching import SpatialIndex
+from .EpochPropagation import PropagatePositions
+from .StageMetrics import Stage_Metrics
+from .MatchStore import Match_Store
+from .Resilience import Upstream_Resilience
 #from DBaccess.RequestProcessingError import RequestProcessingError
 
-simbad_tap = pyvo.dal.tap.TAPService("http://simbad.u-strasbg.fr/simbad/sim-tap")
+# SIMBAD TAP service uses the shared transport, so its connections are pooled together with other catalogs
+# it is created by SimbadTap on first use, pyvo is imported only when SIMBAD is requested
+Simbad_Tap_Url = "http://simbad.u-strasbg.fr/simbad/sim-tap"
+simbad_tap = None
 
 column_adjusted_ra = 'adjusted_ra'
 column_adjusted_dec = 'adjusted_dec'
+column_separation = 'separation'
+
+# radius of cross matching in degrees
+match_radius = 0.001
+
+
+# interval between checks of SIMBAD job phase when cross matching runs as a background job
+job_poll_interval = 1
+# the asyncio serving mode waits for SIMBAD jobs with UWS blocking WAIT of this number of seconds,
+# services ignoring WAIT are polled with interval growing up to job_poll_interval
+job_wait_seconds = 30
+job_min_poll_interval = 0.1
+
+# match policies: the nearest SIMBAD object of every source, all objects within match_radius, or all objects with
+# the list of their identifiers. Every matched object is one row, simbad_name is its common name or its main
+# identifier when SIMBAD has no common name of the object.
+Match_Best = "best"
+Match_All = "all"
+Match_Identifiers = "identifiers"
+Match_Policies = [Match_Best, Match_All, Match_Identifiers]
+
+column_identifiers = 'simbad_identifiers'
+
+# SIMBAD common names are the identifiers with this prefix in ident table
+Simbad_Name_Prefix = "NAME "
+
+# SIMBAD selects the nearest objects of every source itself for Match_Best with a grouped subquery (ADQL derived
+# table), so about one row per source is transferred instead of every object within match_radius. ReduceMatches
+# keeps one of equally near objects. Set it to False for TAP services without subqueries in FROM.
+remote_best_match = True
+
+# columns of SIMBAD cross match result which follow the source id in the response, when the result has them
+simbad_columns = ['simbad_id', 'simbad_name', 'simbad_otype', 'simbad_type_description', column_separation, column_identifiers]
+
+# upload table is split into shards of this number of rows, shards are cross matched by concurrent SIMBAD jobs
+shard_size = 5000
+shard_concurrency = 4
+# number of times a failed shard job is submitted again
+shard_retries = 2
+
+# ABORT requests of SIMBAD jobs nobody waits for, sent in the background
+_abort_tasks = set()
 
 
 class CrossMatching(ABC):
-    def CrossMatching(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, query_params_json, limit, chunk_size):
+    # cancel_event is passed when cross matching runs as a background job, setting it stops waiting for the catalogs
+    # Identical cross matches requested at the same time are done once, background jobs are not coalesced
+    def CrossMatching(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, query_params_json, limit, chunk_size, cancel_event=None, match_policy=Match_Best):
+        source_query = catalog_source._constructADQLQuery(query_params_json, limit, None)
+        if cancel_event is not None or source_query is None:
+            return self.__crossMatching(catalog_source, catalog_to_match, query_params_json, limit, chunk_size, cancel_event, match_policy)
+
+        key = ("crossmatch", catalog_source.Catalog, NormalizeQuery(source_query), catalog_to_match.Catalog, match_radius, match_policy)
+        return _ownResult(Single_Flight.Do(key, lambda: self.__crossMatching(catalog_source, catalog_to_match, query_params_json, limit, chunk_size, None, match_policy)))
+
+    def __crossMatching(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, query_params_json, limit, chunk_size, cancel_event, match_policy):
         try:
-            catalog, query, gaia_columns, gaia_rows, table = catalog_source.QueryCatalog(query_params_json, limit, chunk_size)
+            if cancel_event is None:
+                catalog, query, source_result = catalog_source.QueryCatalog(query_params_json, limit, chunk_size)
+            else:
+                catalog, query, source_result = catalog_source.QueryCatalogAsyncJob(query_params_json, limit, chunk_size, cancel_event)
+        except UpstreamUnavailableError:
+            raise
         except RequestProcessingError as e:
             raise CrossMatchRequestProcessingError(e.catalog, e.query, catalog_to_match.Catalog, "", "Request to source catalog failed", str(e))
+        table = source_result.Table
 
         # Extract gaia_id, "ra", "dec" to upload temporary table to Simbad
         crossmatch_query = ""
 
         try:
             #We need to adjust coordinates (RA and DEC) read from source to RA and DEC of catalog to match
-            column_ra = self.__setColumnUnitToDeg(table[Category.RA.name])  # RA in degrees
-            column_dec = self.__setColumnUnitToDeg(table[Category.Dec.name])  # Dec in degrees
-            column_pmra = self.__setColumnUnitToMilliarcsecPerYear(table[Category.PMRA.name])  # Proper motion in RA (mas/yr)
-            column_pmdec = self.__setColumnUnitToMilliarcsecPerYear(table[Category.PMDec.name])  # Proper motion in Dec (mas/yr)
-
-            #obstime = Time("J2000.0")
-            #new_obstime = Time("J2015.5")
-            #coords = SkyCoord(
-            #    ra=88.79293899077537 * u.deg,
-            #    dec=7.407063995272694* u.deg,
-            #    pm_ra_cosdec=self.__setColumnUnitToMilliarcsecPerYear(27.54),
-            #    pm_dec=self.__setColumnUnitToMilliarcsecPerYear(11.3) ,
-            #    frame="icrs",
-            #    obstime=obstime
-            #)
-            #adjusted_coords = coords.apply_space_motion(new_obstime=new_obstime)
-
-            # Create SkyCoord object for source
-            obstime = Time(catalog_source.Epoch)
-            coords = SkyCoord(
-                ra=column_ra,
-                dec=column_dec,
-                pm_ra_cosdec=column_pmra,
-                pm_dec=column_pmdec,
-                frame="icrs",
-                obstime=obstime
-            )
+            propagation_arguments = self.__propagationArguments(table, catalog_source, catalog_to_match)
+
             # Adjust source coordinates to catalog_to_match (for example, adjust Gaia coordinates to SIMBAD epoch )
-            new_obstime = Time(catalog_to_match.Epoch)
-            adjusted_coords = coords.apply_space_motion(new_obstime=new_obstime)
+            with Stage_Metrics.Stage("epoch_propagation") as stage:
+                adjusted_ra, adjusted_dec = PropagatePositions(*propagation_arguments)
+                stage.Rows = len(adjusted_ra)
 
             # Add columns for adjusted RA and Dec to the table
-            table[column_adjusted_ra] = adjusted_coords.ra.deg
-            table[column_adjusted_dec] = adjusted_coords.dec.deg
+            table[column_adjusted_ra] = adjusted_ra
+            table[column_adjusted_dec] = adjusted_dec
 
         except Exception as e:
             raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, f"Error adjusting source coordinates to the target", str(e))
 
+        # cross match in process when rows of the target catalog are available locally
+        try:
+            target_table = catalog_to_match.LocalCrossMatchTable(table[column_adjusted_ra], table[column_adjusted_dec], match_radius)
+        except Exception as e:
+            # SIMBAD is asked only for its own rows, a catalog with all rows local has no remote cross match
+            if catalog_to_match.HasLocalRows:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Local cross match failed", str(e))
+            target_table = None
+        if target_table is not None:
+            crossmatch_query = f"Local cross match with {catalog_to_match.Catalog} within {match_radius} deg"
+            try:
+                with Stage_Metrics.Stage("local_crossmatch") as stage:
+                    merged_table = self.CrossMatchLocal(table, catalog_source, catalog_to_match, target_table, match_policy)
+                    stage.Rows = len(merged_table)
+                return catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, QueryResult(merged_table)
+            except Exception as e:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Local cross match failed", str(e))
+
         try:
             # create table to upload to the target catalog with the columns source_id, adjusted_ra, adjusted_dec
             upload_table = table[catalog_source.ColumnId, column_adjusted_ra, column_adjusted_dec]
 
             # Define crossmatch query
-            crossmatch_query = (" SELECT basic.main_id AS simbad_id,\n" +
-                                "        ident.id AS simbad_name,\n"
-                                "        basic.otype AS simbad_otype,\n"
-                                "        otypedef.description simbad_type_description,\n"                               
-                                "        basic.ra AS simbad_ra,\n"
-                                "        basic.dec AS simbad_dec,\n"
-                               f"        tmp_table.{catalog_source.ColumnId}\n"
-                                "  FROM  basic \n"
-                                "       INNER JOIN ident ON basic.oid = ident.oidref\n"
-                                "       INNER JOIN otypedef ON basic.otype = otypedef.otype\n"
-                               f"       INNER JOIN TAP_UPLOAD.tmp_table ON 1=CONTAINS(POINT('ICRS', basic.ra, basic.dec), CIRCLE('ICRS', tmp_table.{column_adjusted_ra}, tmp_table.{column_adjusted_dec}, 0.001))")
-                                #"WHERE basic.otype IN ('Star', 'V*', 'SB*')")
-                                #basic.otype IN ('Star', 'V*', 'SB*')
-
-            # Submit the job: Upload source data (Gaia) as a temporary table to the target catalog and run cross matching query
-            job = simbad_tap.submit_job(crossmatch_query, uploads={"tmp_table": upload_table})
-            job.run()
-            job.wait()
+            crossmatch_query = self.__crossMatchQuery(catalog_source, match_policy)
 
-            if job.phase == "COMPLETED":
-                # Fetch the results
-                crossmatch_result = job.fetch_result().to_table()
+            # Submit the jobs: Upload source data (Gaia) as temporary tables to the target catalog and run cross matching query
+            # big upload is split into shards which are cross matched by concurrent jobs
+            # sources cross matched before are taken from the match store, only the others are uploaded
+            crossmatch_result = self.__runStoredJobs(catalog_source, catalog_to_match, crossmatch_query, upload_table, cancel_event, match_policy)
 
-                # Merge the tables using source_id
-                table[catalog_source.ColumnId].description = "Unique source identifier"
-                crossmatch_result[catalog_source.ColumnId].description = "Unique source identifier"
-                merged_table = join(table, crossmatch_result, keys=[f"{catalog_source.ColumnId}"], join_type="left")
+            # Merge the tables using source_id
+            with Stage_Metrics.Stage("crossmatch_join") as stage:
+                merged_table = JoinCrossMatchResult(table, crossmatch_result, catalog_source.ColumnId)
+                stage.Rows = len(merged_table)
 
-                if len(merged_table) == 0:
-                    raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, job.phase, "Cross matching result is empty")
+            if len(merged_table) == 0:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "COMPLETED", "Cross matching result is empty")
 
-                simbad_columns = ['simbad_id', 'simbad_name', 'simbad_otype', 'simbad_type_description']
+            return catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, QueryResult(merged_table)
 
-                #reorder columns, put simbad id, name ... right after gaia_id
-                #the first column is gaia_id
-                reordered_columns = [catalog_source.ColumnId]
-                #the next columns are simbad id, name, type and type description
-                reordered_columns += simbad_columns
+        except UpstreamUnavailableError:
+            raise
+        except Exception as e:
+            raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Cross match request failed", str(e))
 
-                for col in merged_table.colnames:
-                    if col not in reordered_columns:
-                        reordered_columns.append(col)
+    # asyncio version of CrossMatching used by the asyncio serving mode
+    # SIMBAD jobs are submitted and waited for without blocking the event loop. Epoch propagation, decoding of job
+    # results and the join run in worker processes of Cpu_Pool.
+    async def CrossMatchingAsync(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, query_params_json, limit, chunk_size, match_policy=Match_Best):
+        source_query = catalog_source._constructADQLQuery(query_params_json, limit, None)
+        if source_query is None:
+            return await self.__crossMatchingAsync(catalog_source, catalog_to_match, query_params_json, limit, chunk_size, match_policy)
 
-                merged_table = merged_table[reordered_columns]
+        key = ("crossmatch", catalog_source.Catalog, NormalizeQuery(source_query), catalog_to_match.Catalog, match_radius, match_policy)
+        return _ownResult(await Async_Single_Flight.Do(key, lambda: self.__crossMatchingAsync(catalog_source, catalog_to_match, query_params_json, limit, chunk_size, match_policy)))
 
-                columns = merged_table.colnames
-                rows = [dict(zip(columns, row)) for row in merged_table]
+    async def __crossMatchingAsync(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, query_params_json, limit, chunk_size, match_policy):
+        try:
+            catalog, query, source_result = await catalog_source.QueryCatalogAsync(query_params_json, limit, chunk_size)
+        except UpstreamUnavailableError:
+            raise
+        except RequestProcessingError as e:
+            raise CrossMatchRequestProcessingError(e.catalog, e.query, catalog_to_match.Catalog, "", "Request to source catalog failed", str(e))
+        table = source_result.Table
+        crossmatch_query = ""
 
-                return catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, columns, rows
-            else:
-                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, job.phase, job.results)
+        try:
+            propagation_arguments = self.__propagationArguments(table, catalog_source, catalog_to_match)
+            with Stage_Metrics.Stage("epoch_propagation") as stage:
+                adjusted_ra, adjusted_dec = await Cpu_Pool.Run(PropagatePositions, *propagation_arguments, rows=len(table))
+                stage.Rows = len(adjusted_ra)
+            table[column_adjusted_ra] = adjusted_ra
+            table[column_adjusted_dec] = adjusted_dec
+        except Exception as e:
+            raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, f"Error adjusting source coordinates to the target", str(e))
+
+        # local rows of the target catalog stay in this process, so the local cross match runs in a thread
+        try:
+            target_table = await asyncio.to_thread(catalog_to_match.LocalCrossMatchTable, table[column_adjusted_ra], table[column_adjusted_dec], match_radius)
+        except Exception as e:
+            # SIMBAD is asked only for its own rows, a catalog with all rows local has no remote cross match
+            if catalog_to_match.HasLocalRows:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Local cross match failed", str(e))
+            target_table = None
+        if target_table is not None:
+            crossmatch_query = f"Local cross match with {catalog_to_match.Catalog} within {match_radius} deg"
+            try:
+                with Stage_Metrics.Stage("local_crossmatch") as stage:
+                    merged_table = await asyncio.to_thread(self.CrossMatchLocal, table, catalog_source, catalog_to_match, target_table, match_policy)
+                    stage.Rows = len(merged_table)
+                return catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, QueryResult(merged_table)
+            except Exception as e:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Local cross match failed", str(e))
+
+        try:
+            upload_table = table[catalog_source.ColumnId, column_adjusted_ra, column_adjusted_dec]
+            crossmatch_query = self.__crossMatchQuery(catalog_source, match_policy)
+
+            crossmatch_result = await self.__runStoredJobsAsync(catalog_source, catalog_to_match, crossmatch_query, upload_table, match_policy)
+
+            with Stage_Metrics.Stage("crossmatch_join") as stage:
+                merged_table = await Cpu_Pool.Run(JoinCrossMatchResult, table, crossmatch_result, catalog_source.ColumnId, rows=len(table))
+                stage.Rows = len(merged_table)
+
+            if len(merged_table) == 0:
+                raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "COMPLETED", "Cross matching result is empty")
+
+            return catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, QueryResult(merged_table)
 
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             raise CrossMatchRequestProcessingError(catalog_source.Catalog, query, catalog_to_match.Catalog, crossmatch_query, "Cross match request failed", str(e))
 
-    # set unit degree for the column if it is not specified
-    def __setColumnUnitToDeg(self, column):
-        if hasattr(column, "unit"):
-            column = column.to(u.deg, equivalencies=u.dimensionless_angles())
+    # Cross match source table with target rows available locally, the nearest target within match_radius is taken
+    # with Match_Best policy, every target within match_radius is a row with the other policies
+    # Target columns are added with the target catalog name prefix (RA -> simbad_ra), unmatched rows are masked
+    def CrossMatchLocal(self, table, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, target_table, match_policy=Match_Best):
+        index = SpatialIndex(target_table[Category.RA.name], target_table[Category.Dec.name], match_radius)
+        if match_policy == Match_Best:
+            target_index, separation = index.MatchNearest(table[column_adjusted_ra], table[column_adjusted_dec])
         else:
-            column = column * u.deg
-        return column
+            source_index, target_index, separation = _allMatches(index, table[column_adjusted_ra], table[column_adjusted_dec])
+            table = table[source_index]
 
-    #set unit milliarcseconds per year for the column if it is not specified
-    def __setColumnUnitToMilliarcsecPerYear(self, column):
-        if hasattr(column, "unit"):
-            column = column.to(u.mas / u.yr)  # Ensure correct unit
-        else:
-            column = column * u.mas / u.yr
-        return column
+        matched = target_index >= 0
+        rows_index = np.where(matched, target_index, 0)
+        target_columns = []
+        for col in target_table.colnames:
+            column_name = col if col.lower().startswith(catalog_to_match.Catalog + "_") else f"{catalog_to_match.Catalog}_{col.lower()}"
+            # the source catalog may be the catalog to match (stellaris with itself)
+            if column_name in table.colnames:
+                column_name = "matched_" + column_name
+            if len(target_table) > 0:
+                values = target_table[col][rows_index]
+                mask = np.ma.getmaskarray(values) | ~matched
+            else:
+                values = np.zeros(len(table), dtype=target_table[col].dtype)
+                mask = np.ones(len(table), dtype=bool)
+            table[column_name] = MaskedColumn(np.asarray(values), mask=mask)
+            target_columns.append(column_name)
+        table[column_separation] = MaskedColumn(separation, mask=~matched, unit=u.deg)
+        target_columns.append(column_separation)
+
+        #the first column is source id, the next ones are target columns
+        return _reorderColumns(table, catalog_source.ColumnId, target_columns)
+
+    # Cross match the sources which are not in Match_Store or expired there and store their matches, matches of the
+    # other sources are taken from the store. The store is an optimization: if it fails, all sources are uploaded.
+    def __runStoredJobs(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, crossmatch_query, upload_table, cancel_event, match_policy):
+        store_key = (catalog_source.Catalog, catalog_to_match.Catalog, match_radius, crossmatch_query)
+        stored_result, missing = self.__lookupStored(store_key, upload_table[catalog_source.ColumnId])
+        if not missing.any():
+            return stored_result
+
+        upload_table = upload_table[missing]
+        with Stage_Metrics.Stage("simbad_crossmatch") as stage:
+            crossmatch_result = self.__runShardedJobs(crossmatch_query, upload_table, cancel_event)
+            stage.Rows = len(crossmatch_result)
+        with Stage_Metrics.Stage("match_reduction") as stage:
+            crossmatch_result = ReduceMatches(crossmatch_result, catalog_source.ColumnId, match_policy)
+            stage.Rows = len(crossmatch_result)
+        self.__putStored(store_key, upload_table[catalog_source.ColumnId], crossmatch_result, catalog_source.ColumnId)
+        return _combinedMatches(crossmatch_result, stored_result)
+
+    # asyncio version of __runStoredJobs, the store is read and written in a thread
+    async def __runStoredJobsAsync(self, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase, crossmatch_query, upload_table, match_policy):
+        store_key = (catalog_source.Catalog, catalog_to_match.Catalog, match_radius, crossmatch_query)
+        stored_result, missing = await asyncio.to_thread(self.__lookupStored, store_key, upload_table[catalog_source.ColumnId])
+        if not missing.any():
+            return stored_result
+
+        upload_table = upload_table[missing]
+        with Stage_Metrics.Stage("simbad_crossmatch") as stage:
+            crossmatch_result = await self.__runShardedJobsAsync(crossmatch_query, upload_table)
+            stage.Rows = len(crossmatch_result)
+        with Stage_Metrics.Stage("match_reduction") as stage:
+            crossmatch_result = ReduceMatches(crossmatch_result, catalog_source.ColumnId, match_policy)
+            stage.Rows = len(crossmatch_result)
+        await asyncio.to_thread(self.__putStored, store_key, upload_table[catalog_source.ColumnId], crossmatch_result, catalog_source.ColumnId)
+        return _combinedMatches(crossmatch_result, stored_result)
+
+    # stored matches and the sources to upload, all sources are uploaded when the store is not available
+    def __lookupStored(self, store_key, source_ids):
+        try:
+            with Stage_Metrics.Stage("match_store_lookup") as stage:
+                stored_result, missing = Match_Store.Lookup(*store_key, source_ids)
+                stage.Rows = len(stored_result)
+            return stored_result, missing
+        except Exception:
+            return Table([source_ids[:0]]), np.ones(len(source_ids), dtype=bool)
+
+    def __putStored(self, store_key, source_ids, crossmatch_result, column_id):
+        try:
+            with Stage_Metrics.Stage("match_store_put") as stage:
+                Match_Store.Put(*store_key, source_ids, crossmatch_result, column_id)
+                stage.Rows = len(source_ids)
+        except Exception:
+            pass
+
+    # Split upload table into shards by declination, so every remote join covers a narrow sky stripe, cross match
+    # the shards by concurrent jobs and merge their results into one table
+    def __runShardedJobs(self, crossmatch_query, upload_table, cancel_event):
+        order = np.argsort(np.asarray(upload_table[column_adjusted_dec]), kind="stable")
+        shards = [upload_table[order[start:start + shard_size]] for start in range(0, len(upload_table), shard_size)]
+        if len(shards) <= 1:
+            return self.__runShardJob(crossmatch_query, upload_table, cancel_event)
+
+        with ThreadPoolExecutor(max_workers=min(shard_concurrency, len(shards))) as executor:
+            # shards run in the context of the request, so their stages are added to its timings
+            futures = [executor.submit(contextvars.copy_context().run, self.__runShardJob, crossmatch_query, shard, cancel_event)
+                       for shard in shards]
+            try:
+                results = [future.result() for future in futures]
+            except Exception:
+                # don't start shards which are still queued, the whole cross match fails anyway
+                for future in futures:
+                    future.cancel()
+                raise
+        return vstack(results, join_type="exact")
+
+    # run cross matching job for one shard, failed job is submitted again up to shard_retries times
+    # jobs are not submitted while the circuit breaker of SIMBAD is open
+    def __runShardJob(self, crossmatch_query, shard, cancel_event):
+        error = ""
+        for attempt in range(shard_retries + 1):
+            try:
+                # upload of the shard and the time SIMBAD job is queued and executed
+                # every shard job takes a request slot of SIMBAD until it is finished
+                with Stage_Metrics.Stage("simbad_shard_job") as stage:
+                    stage.Rows = len(shard)
+                    job = Upstream_Resilience.Call("simbad", crossmatch_query, lambda: self.__runJob(crossmatch_query, shard, cancel_event),
+                                                   hedge=False, big=cancel_event is not None)
+                # Fetch the results
+                with Stage_Metrics.Stage("simbad_result_fetch") as stage:
+                    result = job.fetch_result().to_table()
+                    stage.Rows = len(result)
+                return result
+            except UpstreamUnavailableError:
+                raise
+            except Exception as e:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise
+                error = str(e)
+        raise Exception(f"Cross matching of {len(shard)} rows failed after {shard_retries + 1} attempts. {error}")
+
+    # submit SIMBAD job and wait until it is finished, the job is returned if it is completed
+    def __runJob(self, crossmatch_query, shard, cancel_event):
+        job = SimbadTap().submit_job(crossmatch_query, uploads={"tmp_table": shard})
+        job.run()
+        self.__waitForJob(job, cancel_event)
+        if job.phase != "COMPLETED":
+            raise Exception(f"Job phase {job.phase}: {job.results}")
+        return job
+
+    # wait until SIMBAD job is finished, abort it if cross matching job is cancelled
+    def __waitForJob(self, job, cancel_event):
+        if cancel_event is None:
+            job.wait()
+            return
+        while job.phase not in ("COMPLETED", "ERROR", "ABORTED"):
+            if cancel_event.wait(job_poll_interval):
+                job.abort()
+                raise Exception("Cross matching job is cancelled")
+
+    # asyncio version of __runShardedJobs, at most shard_concurrency shard jobs run at the same time
+    async def __runShardedJobsAsync(self, crossmatch_query, upload_table):
+        order = np.argsort(np.asarray(upload_table[column_adjusted_dec]), kind="stable")
+        shards = [upload_table[order[start:start + shard_size]] for start in range(0, len(upload_table), shard_size)]
+        if len(shards) <= 1:
+            return await self.__runShardJobAsync(crossmatch_query, upload_table)
+
+        semaphore = asyncio.Semaphore(shard_concurrency)
+
+        async def runShard(shard):
+            async with semaphore:
+                return await self.__runShardJobAsync(crossmatch_query, shard)
+
+        tasks = [asyncio.ensure_future(runShard(shard)) for shard in shards]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # the whole cross match fails, running shard jobs are aborted
+            for task in tasks:
+                task.cancel()
+            raise
+        return vstack(results, join_type="exact")
+
+    # asyncio version of __runShardJob
+    async def __runShardJobAsync(self, crossmatch_query, shard):
+        error = ""
+        for attempt in range(shard_retries + 1):
+            try:
+                with Stage_Metrics.Stage("simbad_shard_job") as stage:
+                    stage.Rows = len(shard)
+                    job_url = await Upstream_Resilience.CallAsync("simbad", crossmatch_query, lambda: self.__runJobAsync(crossmatch_query, shard), hedge=False)
+                with Stage_Metrics.Stage("simbad_result_fetch") as stage:
+                    response = await Async_Http_Transport.Get(job_url + "/results/result")
+                    if response.status_code != 200:
+                        raise Exception(f"HTTP error {response.status_code}: {response.text}")
+                    result = await Cpu_Pool.Run(ReadVOTableBytes, response.content, size=len(response.content))
+                    stage.Rows = len(result)
+                return result
+            except UpstreamUnavailableError:
+                raise
+            except Exception as e:
+                error = str(e)
+        raise Exception(f"Cross matching of {len(shard)} rows failed after {shard_retries + 1} attempts. {error}")
+
+    # asyncio version of __runJob, the URL of the completed job is returned
+    async def __runJobAsync(self, crossmatch_query, shard):
+        job_url = await self.__submitJobAsync(crossmatch_query, shard)
+        phase = await self.__waitForJobAsync(job_url)
+        if phase != "COMPLETED":
+            raise Exception(f"Job phase {phase}: {(await Async_Http_Transport.Get(job_url + '/error')).text}")
+        return job_url
+
+    # create and run SIMBAD job with the shard uploaded as tmp_table, return the job URL
+    async def __submitJobAsync(self, crossmatch_query, shard):
+        upload = await Cpu_Pool.Run(_uploadVOTable, shard, rows=len(shard))
+        params = {"REQUEST": "doQuery", "LANG": "ADQL", "QUERY": crossmatch_query, "UPLOAD": "tmp_table,param:tmp_table", "PHASE": "RUN"}
+        response = await Async_Http_Transport.Post(SimbadTap().baseurl + "/async", data=params, follow_redirects=False,
+                                                   files={"tmp_table": ("tmp_table.xml", upload, "application/x-votable+xml")})
+        job_url = response.headers.get("Location")
+        if response.status_code not in (200, 303) or not job_url:
+            raise Exception(f"HTTP error {response.status_code}: {response.text}")
+        return urljoin(str(response.url), job_url)
+
+    # wait until SIMBAD job is finished and return its phase, the job is aborted if the request is cancelled
+    async def __waitForJobAsync(self, job_url):
+        poll_interval = job_min_poll_interval
+        try:
+            while True:
+                started = time.monotonic()
+                response = await Async_Http_Transport.Get(job_url, params={"WAIT": job_wait_seconds})
+                phase = _jobPhase(response.text)
+                if response.status_code != 200 or phase is None:
+                    raise Exception(f"Job {job_url} state is not available, HTTP {response.status_code}: {response.text[:500]}")
+                if phase in ("COMPLETED", "ERROR", "ABORTED"):
+                    return phase
+                if time.monotonic() - started < poll_interval:
+                    await asyncio.sleep(poll_interval)
+                    poll_interval = min(poll_interval * 2, job_poll_interval)
+        except asyncio.CancelledError:
+            # nobody waits for the result any more, SIMBAD doesn't need to finish the job
+            # the event loop keeps only weak references to tasks, the abort task is kept until it is done
+            abort = asyncio.ensure_future(Async_Http_Transport.Post(job_url + "/phase", data={"PHASE": "ABORT"}))
+            _abort_tasks.add(abort)
+            abort.add_done_callback(_abortDone)
+            raise
+
+    # ADQL query joining SIMBAD objects to the uploaded table tmp_table of source ids and adjusted positions
+    # Every matched object is one row with its separation from the source and its common name ("NAME" identifier of
+    # ident table), an object with several common names has a row for every one of them and ReduceMatches keeps one.
+    # SIMBAD has one row per object in ids table with all its identifiers, so they are added without a row per
+    # identifier. The nearest object of every source (Match_Best) is always selected by ReduceMatches; with
+    # remote_best_match SIMBAD returns only the objects at the minimum separation of their source.
+    def __crossMatchQuery(self, catalog_source, match_policy=Match_Best):
+        select_identifiers = ""
+        join_identifiers = ""
+        join_best = ""
+        where_best = ""
+        if match_policy == Match_Identifiers:
+            select_identifiers = f"        ids.ids AS {column_identifiers},\n"
+            join_identifiers = "       LEFT OUTER JOIN ids ON basic.oid = ids.oidref\n"
+        if match_policy == Match_Best and remote_best_match:
+            join_best = (f"       INNER JOIN (SELECT upload.{catalog_source.ColumnId} AS best_source_id,\n"
+                         f"                          MIN({_separation('candidate', 'upload')}) AS best_separation\n"
+                          "                     FROM basic AS candidate\n"
+                         f"                          INNER JOIN TAP_UPLOAD.tmp_table AS upload ON {_withinRadius('candidate', 'upload')}\n"
+                         f"                    GROUP BY upload.{catalog_source.ColumnId}) AS best ON best.best_source_id = tmp_table.{catalog_source.ColumnId}\n")
+            where_best = f" WHERE {_separation('basic', 'tmp_table')} = best.best_separation\n"
+        return (" SELECT basic.main_id AS simbad_id,\n" +
+                "        ident.id AS simbad_name,\n"
+                "        basic.otype AS simbad_otype,\n"
+                "        otypedef.description simbad_type_description,\n"
+                "        basic.ra AS simbad_ra,\n"
+                "        basic.dec AS simbad_dec,\n"
+               f"        {_separation('basic', 'tmp_table')} AS {column_separation},\n"
+               + select_identifiers +
+               f"        tmp_table.{catalog_source.ColumnId}\n"
+                "  FROM  basic \n"
+                "       INNER JOIN otypedef ON basic.otype = otypedef.otype\n"
+               f"       LEFT OUTER JOIN ident ON basic.oid = ident.oidref AND ident.id LIKE '{Simbad_Name_Prefix}%'\n"
+               + join_identifiers +
+               f"       INNER JOIN TAP_UPLOAD.tmp_table ON {_withinRadius('basic', 'tmp_table')}\n"
+               + join_best + where_best)
+
+    # arguments of PropagatePositions for the source table: positions and motions in degrees, mas/yr, mas and km/s
+    def __propagationArguments(self, table, catalog_source: DBAccessBase, catalog_to_match: DBAccessBase):
+        column_ra = ColumnFloatValues(table[Category.RA.name], u.deg)  # RA in degrees
+        column_dec = ColumnFloatValues(table[Category.Dec.name], u.deg)  # Dec in degrees
+        column_pmra = ColumnFloatValues(table[Category.PMRA.name], u.mas / u.yr)  # Proper motion in RA (mas/yr)
+        column_pmdec = ColumnFloatValues(table[Category.PMDec.name], u.mas / u.yr)  # Proper motion in Dec (mas/yr)
+        # parallax and radial velocity are used for radial motion when the source catalog returns them
+        column_parallax = None
+        column_radial_velocity = None
+        if Category.Parallax.name in table.colnames and Category.RadialVelocity.name in table.colnames:
+            column_parallax = ColumnFloatValues(table[Category.Parallax.name], u.mas)  # Parallax (mas)
+            column_radial_velocity = ColumnFloatValues(table[Category.RadialVelocity.name], u.km / u.s)  # Radial velocity (km/s)
+        return (column_ra, column_dec, column_pmra, column_pmdec, catalog_source.Epoch, catalog_to_match.Epoch,
+                column_parallax, column_radial_velocity)
+
+
+# SIMBAD TAP service created on the first call, unless simbad_tap was set before (benchmarks set a stand-in service)
+# two threads calling it first may both create the service, one of them is kept; they are equivalent
+def SimbadTap():
+    global simbad_tap
+    if simbad_tap is None:
+        import pyvo
+        simbad_tap = pyvo.dal.tap.TAPService(Simbad_Tap_Url, session=Http_Transport.Session)
+    return simbad_tap
+
+
+# values of the column as float array in the given unit, masked values are NaN
+# the column is taken to be in this unit already if its unit is not specified
+def ColumnFloatValues(column, unit):
+    values = np.ma.filled(np.ma.asarray(column, dtype=np.float64), np.nan)
+    if getattr(column, "unit", None) is not None:
+        values = (values * column.unit).to_value(unit, equivalencies=u.dimensionless_angles())
+    return values
+
+
+# Keep the nearest match of every source with Match_Best policy, all matches with the other policies
+# Every policy keeps one row per source and object, simbad_name is set to the common name or the main identifier
+def ReduceMatches(crossmatch_result, column_id, match_policy):
+    crossmatch_result = _preferredNames(crossmatch_result, column_id)
+    if match_policy != Match_Best or len(crossmatch_result) == 0:
+        return crossmatch_result
+    source_ids = np.asarray(crossmatch_result[column_id])
+    separation = ColumnFloatValues(crossmatch_result[column_separation], u.deg)
+    order = np.lexsort((np.nan_to_num(separation, nan=np.inf), source_ids))
+    # matches are ordered by source and separation, so the first match of every source is the nearest one
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = source_ids[order[1:]] != source_ids[order[:-1]]
+    return crossmatch_result[np.sort(order[first])]
+
+
+# join cross match result to the source table by source id, SIMBAD columns go right after the source id
+# when no source has a match, the SIMBAD columns are added to the source table fully masked
+def JoinCrossMatchResult(table, crossmatch_result, column_id):
+    table[column_id].description = "Unique source identifier"
+    crossmatch_result[column_id].description = "Unique source identifier"
+    if column_separation in crossmatch_result.colnames:
+        crossmatch_result[column_separation].unit = u.deg
+    if len(crossmatch_result) > 0:
+        merged_table = join(table, crossmatch_result, keys=[f"{column_id}"], join_type="left")
+    else:
+        merged_table = table.copy(copy_data=False)
+        for name in crossmatch_result.colnames:
+            if name not in merged_table.colnames:
+                column = crossmatch_result[name]
+                merged_table[name] = MaskedColumn(np.zeros(len(table), dtype=column.dtype), mask=np.ones(len(table), dtype=bool),
+                                                  unit=column.unit, description=column.description)
+
+    #reorder columns, put simbad id, name ... right after gaia_id
+    return _reorderColumns(merged_table, column_id, [name for name in simbad_columns if name in merged_table.colnames])
+
+
+# ADQL separation of a SIMBAD object from the adjusted position of an uploaded source, tables are given by alias
+def _separation(simbad_table, upload_table):
+    return (f"DISTANCE(POINT('ICRS', {simbad_table}.ra, {simbad_table}.dec), "
+            f"POINT('ICRS', {upload_table}.{column_adjusted_ra}, {upload_table}.{column_adjusted_dec}))")
+
+
+# ADQL condition of a SIMBAD object within match_radius of an uploaded source
+def _withinRadius(simbad_table, upload_table):
+    return (f"1=CONTAINS(POINT('ICRS', {simbad_table}.ra, {simbad_table}.dec), "
+            f"CIRCLE('ICRS', {upload_table}.{column_adjusted_ra}, {upload_table}.{column_adjusted_dec}, {match_radius}))")
+
+
+# one row per source and SIMBAD object, the first common name of the object in alphabetical order is kept
+# common names lose their prefix, objects without a common name are named by their main identifier
+def _preferredNames(crossmatch_result, column_id):
+    if len(crossmatch_result) == 0 or 'simbad_name' not in crossmatch_result.colnames:
+        return crossmatch_result
+    source_ids = np.asarray(crossmatch_result[column_id])
+    simbad_ids = _stringValues(crossmatch_result['simbad_id'])
+    names = _stringValues(crossmatch_result['simbad_name'])
+    order = np.lexsort((names, simbad_ids, source_ids))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (source_ids[order[1:]] != source_ids[order[:-1]]) | (simbad_ids[order[1:]] != simbad_ids[order[:-1]])
+    rows = np.sort(order[first])
+    crossmatch_result = crossmatch_result[rows]
+    simbad_ids, names = simbad_ids[rows], names[rows]
+    names = np.where(np.char.startswith(names, Simbad_Name_Prefix), np.char.partition(names, Simbad_Name_Prefix)[:, 2], names)
+    crossmatch_result['simbad_name'] = Column(np.where(names == "", simbad_ids, names), description="SIMBAD common name or main identifier")
+    return crossmatch_result
+
+
+# values of a string column as str array, masked values are empty strings
+def _stringValues(column):
+    values = np.ma.getdata(column)
+    if values.dtype.kind == "S":
+        values = np.char.decode(values, "utf-8")
+    values = values.astype(str)
+    values[np.ma.getmaskarray(column)] = ""
+    return values
+
+
+# all targets within the radius of every source: source rows, target rows and separations
+# sources without a target are kept with target row -1 and NaN separation, rows are ordered by source
+def _allMatches(index, ra, dec):
+    source_index, target_index, separation = index.MatchWithinRadius(ra, dec)
+    unmatched = np.setdiff1d(np.arange(len(ra)), source_index)
+    source_index = np.concatenate([source_index, unmatched])
+    target_index = np.concatenate([target_index, np.full(len(unmatched), -1, dtype=np.int64)])
+    separation = np.concatenate([separation, np.full(len(unmatched), np.nan)])
+    order = np.argsort(source_index, kind="stable")
+    return source_index[order], target_index[order], separation[order]
+
+
+# put source id column first, then given target columns and then all other columns
+def _reorderColumns(merged_table, source_id_column, target_columns):
+    reordered_columns = [source_id_column]
+    reordered_columns += target_columns
+
+    for col in merged_table.colnames:
+        if col not in reordered_columns:
+            reordered_columns.append(col)
+
+    return merged_table[reordered_columns]
+
+
+# cross match result shared by coalesced callers with its own table object for every caller, callers add columns to it
+def _ownResult(crossmatch):
+    *names, result = crossmatch
+    return (*names, QueryResult(result.Table.copy(copy_data=False)))
+
+
+# matches of the uploaded sources followed by the stored matches
+def _combinedMatches(crossmatch_result, stored_result):
+    if len(stored_result) == 0:
+        return crossmatch_result
+    return vstack([crossmatch_result, stored_result], join_type="outer", metadata_conflicts="silent")
+
+
+# an abort which failed leaves the job to SIMBAD, it is removed when its destruction time comes
+def _abortDone(task):
+    _abort_tasks.discard(task)
+    if not task.cancelled():
+        task.exception()
+
+
+# uploaded table as VOTable document
+def _uploadVOTable(table):
+    output = BytesIO()
+    from_table(table).to_xml(output)
+    return output.getvalue()
+
+
+# phase of UWS job from its XML description or None
+def _jobPhase(job_xml):
+    match = re.search(r"<(?:\w+:)?phase>\s*(\w+)\s*</", job_xml)
+    return match.group(1).upper() if match else None
@@ -1,5 +1,13 @@
-`from abc import ABC, abstractmethod
+from abc import ABC, abstractmethod
+import asyncio
 import json
+from .QueryCache import Query_Cache, NormalizeQuery
+from .SingleFlight import Single_Flight, Async_Single_Flight
+from .HttpTransport import Http_Transport
+from .AsyncHttpTransport import Async_Http_Transport
+from .StageMetrics import Stage_Metrics
+from .Resilience import Upstream_Resilience, IsUpstreamFailure
+from .RequestProcessingError import RequestProcessingError, UpstreamUnavailableError
 
 
 
@@ -7,11 +15,125 @@ class DBAccessBase(ABC):
     def _constructADQLQuery(self, query_params_json, limit, chunk_size) -> str: #protected(_)
        pass
         
+    #FROM and WHERE clauses of ADQL query selecting the rows matching query parameters and aliases of the tables in FROM
+    #clause, queries of other rows than the catalog rows (aggregates) are formed from them
+    def _constructFromWhere(self, query_params_json): #protected(_)
+        raise NotImplementedError(f"ADQL queries of the selected rows are not supported for {self.Catalog}")
+
     #Form ADQL query, request it to the catalog API, process response and return result
+    #Returns catalog name, ADQL query and QueryResult wrapping the result table
     @abstractmethod
     def QueryCatalog(self, query_params_json, limit, chunk_size):
         pass
 
+    #Request the catalog page by page and yield the result of every page as soon as it is received
+    #Catalogs without chunked mode return the whole result as a single page
+    def QueryCatalogChunks(self, query_params_json, limit, chunk_size):
+        yield self.QueryCatalog(query_params_json, limit, chunk_size)
+
+    #Form ADQL query and request it as a background job, stop waiting for the catalog when cancel_event is set
+    #Catalogs without asynchronous API request the query the same way as QueryCatalog
+    def QueryCatalogAsyncJob(self, query_params_json, limit, chunk_size, cancel_event):
+        return self.QueryCatalog(query_params_json, limit, chunk_size)
+
+    #ADQL condition selecting a random sample of about rows rows of the catalog, None if the catalog has no random sample
+    #column; statistics of the catalog are collected on the sample
+    def _sampleCondition(self, rows): #protected(_)
+        return None
+
+    #Request ADQL query to the catalog API and return the result as astropy table
+    def _requestTable(self, query, **request_args): #protected(_)
+        raise NotImplementedError(f"Requesting ADQL query is not supported for {self.Catalog}")
+
+    #Return the result of ADQL query from the process-wide cache, request the catalog API only on cache miss
+    #Identical queries requested at the same time wait for one request to the catalog API. Background jobs
+    #(request_args has cancel_event) are not coalesced, so cancelling one job doesn't fail the others.
+    def _requestTableCached(self, query, **request_args): #protected(_)
+        if request_args.get("cancel_event") is not None:
+            return self._requestTableToCache(query, **request_args)
+        table = Single_Flight.Do(("query", self.Catalog, NormalizeQuery(query)), lambda: self._requestTableToCache(query, **request_args))
+        # every caller gets its own table object, callers add columns to it
+        return table.copy(copy_data=False)
+
+    #cache misses wait for a free request slot of the catalog, background jobs may not take the slots kept for small requests
+    #sync requests are hedged and time out, background jobs are not. When the catalog fails or its circuit breaker is
+    #open, an expired result of the same query is returned if the cache still has it.
+    def _requestTableToCache(self, query, **request_args): #protected(_)
+        with Stage_Metrics.Stage("cache_lookup"):
+            table = Query_Cache.Get(self.Catalog, query)
+        if table is None:
+            background = request_args.get("cancel_event") is not None
+            try:
+                table = Upstream_Resilience.Call(self.Catalog, query, lambda: self._requestTable(query, **request_args), hedge=not background, big=background)
+            except RequestProcessingError as e:
+                table = self._staleTable(query, e)
+                if table is None:
+                    raise
+                return table
+            Query_Cache.Put(self.Catalog, query, table)
+        return table
+
+    #expired cached result of the query if the request failed because of the catalog, None otherwise
+    def _staleTable(self, query, error): #protected(_)
+        if not isinstance(error, UpstreamUnavailableError) and not IsUpstreamFailure(error):
+            return None
+        with Stage_Metrics.Stage("stale_cache") as stage:
+            table = Query_Cache.GetStale(self.Catalog, query)
+            stage.Rows = len(table) if table is not None else 0
+        if table is not None:
+            Upstream_Resilience.RecordStale(self.Catalog)
+        return table
+
+    #asyncio version of QueryCatalog used by the asyncio serving mode
+    #Catalogs without asynchronous requests run QueryCatalog in a thread of the default executor
+    async def QueryCatalogAsync(self, query_params_json, limit, chunk_size):
+        return await asyncio.to_thread(self.QueryCatalog, query_params_json, limit, chunk_size)
+
+    #asyncio version of QueryCatalogChunks, catalogs without chunked mode return the whole result as a single page
+    async def QueryCatalogChunksAsync(self, query_params_json, limit, chunk_size):
+        yield await self.QueryCatalogAsync(query_params_json, limit, chunk_size)
+
+    #asyncio version of _requestTable, catalogs without asynchronous requests run _requestTable in a thread
+    async def _requestTableAsync(self, query): #protected(_)
+        return await asyncio.to_thread(self._requestTable, query)
+
+    #asyncio version of _requestTableCached: identical queries of concurrent requests wait for one request to the catalog
+    #Cache files are read and written in a thread, so the event loop doesn't wait for the disk
+    async def _requestTableCachedAsync(self, query): #protected(_)
+        table = await Async_Single_Flight.Do(("query", self.Catalog, NormalizeQuery(query)), lambda: self._requestTableToCacheAsync(query))
+        return table.copy(copy_data=False)
+
+    async def _requestTableToCacheAsync(self, query): #protected(_)
+        with Stage_Metrics.Stage("cache_lookup"):
+            table = await asyncio.to_thread(Query_Cache.Get, self.Catalog, query)
+        if table is None:
+            try:
+                table = await Upstream_Resilience.CallAsync(self.Catalog, query, lambda: self._requestTableAsync(query))
+            except RequestProcessingError as e:
+                table = await asyncio.to_thread(self._staleTable, query, e)
+                if table is None:
+                    raise
+                return table
+            await asyncio.to_thread(Query_Cache.Put, self.Catalog, query, table)
+        return table
+
+    #Rows of the catalog around the given positions (in degrees) if they are available locally without request to the
+    #catalog API, None otherwise. Cross matching with local rows is done in process instead of remote join.
+    def LocalCrossMatchTable(self, ra, dec, radius):
+        return None
+
+    #True if all rows of the catalog are available locally (LocalCrossMatchTable never returns None), such catalogs
+    #may be the target of cross matching besides SIMBAD
+    @property
+    def HasLocalRows(self):
+        return False
+
+    #add condition to WHERE clause joining it with AND
+    def _addConditionToWhere(self, where_clause, condition) -> str: #protected(_)
+        if where_clause == "":
+            return condition
+        return where_clause + "\n   AND " + condition
+
     #collection of Categories supported by DBAccess
     @property
     @abstractmethod
@@ -30,6 +152,16 @@ class DBAccessBase(ABC):
     def ColumnId(self):
          pass
 
+    #HTTP transport shared by all catalogs: pooled keep-alive connections, timeouts and retries
+    @property
+    def Transport(self):
+        return Http_Transport
+
+    #asyncio HTTP transport shared by all catalogs in the asyncio serving mode
+    @property
+    def AsyncTransport(self):
+        return Async_Http_Transport
+
     #Epoch used for the catalog
     @property
     def Epoch(self):
@@ -1,20 +1,74 @@
-import requests
-from astropy.io.votable import parse
-from io import BytesIO
+import asyncio
+import re
+import time
 from .DBAccessBase import DBAccessBase
+from .QueryResult import QueryResult
+from .ConeTileCache import Cone_Tile_Cache
+from .StageMetrics import Stage_Metrics
+from .HttpTransport import Accept_Encoding
+from .VOTableStream import ReadVOTableStream, ReadVOTableBytes, Read_Chunk_Size
+from .CpuPool import Cpu_Pool
 from DBaccess.RequestProcessingError import RequestProcessingError
 from .DBAccessEnums import Category, ObjectTypes
 
 # Gaia API endpoint
 Gaia_Url = "https://gea.esac.esa.int/tap-server/tap/sync"
+# Gaia API endpoint for asynchronous (UWS) jobs
+Gaia_Async_Url = "https://gea.esac.esa.int/tap-server/tap/async"
+
+# queries without limit or with limit above this number of rows are requested as asynchronous jobs
+Async_Rows_Threshold = 50000
+# interval between checks of asynchronous job phase, it grows up to the maximum while the job is running
+Async_Poll_Interval = 0.5
+Async_Poll_Max_Interval = 5
+# seconds an asynchronous job may take from its creation, a longer job is aborted
+Async_Job_Timeout = 3600
+# UWS phases of a job which is still going to run, any other phase than these and COMPLETED fails the request
+Async_Running_Phases = ("PENDING", "QUEUED", "EXECUTING")
+
+# binary VOTable: rows are decoded from the response stream while it is downloaded
+Gaia_Format = "votable"
 
 HTTP_Headers = {
     "Content-Type": "application/x-www-form-urlencoded",
+    # VOTable text compresses several times, the body is decompressed while it is decoded
+    "Accept-Encoding": Accept_Encoding,
 }
 
 
 class DBAccessGaia(DBAccessBase):
-    def _constructADQLQuery(self, query_params_json, limit, chunk_size) -> str:
+    def _constructADQLQuery(self, query_params_json, limit, chunk_size, last_source_id=None, extra_condition=None) -> str:
+        from_clause, where_clause, table_aliases = self._constructFromWhere(query_params_json)
+
+        # chunked mode: keyset pagination on source_id, the next page starts right after the last source_id of the previous page
+        if chunk_size and last_source_id is not None:
+            where_clause = self._addConditionToWhere(where_clause, f"gs.source_id > {last_source_id}")
+
+        # condition added by the caller, for example source_id ranges of sky tiles
+        if extra_condition:
+            where_clause = self._addConditionToWhere(where_clause, extra_condition)
+
+        #form SELECT clause
+        select_criteria = ""
+        if chunk_size:
+            select_criteria = f"TOP {chunk_size}"
+        elif limit:
+            select_criteria = f"TOP {limit}"
+        select_clause = f"SELECT {select_criteria} gs.source_id AS {self.ColumnId}"
+        for category, field_data in self.CategoryInfo.items():
+            if  field_data[1] in table_aliases and field_data[0]:
+                field_name = field_data[0]
+                select_clause += f", {field_name} AS {category.name}"
+
+        query = select_clause + "\n FROM " + from_clause
+        if where_clause != "":
+            query += "\n WHERE " + where_clause
+        if chunk_size:
+            query += "\n ORDER BY gs.source_id"
+        return query
+
+    # FROM and WHERE clauses of the rows selected by query parameters and aliases of the tables in FROM clause
+    def _constructFromWhere(self, query_params_json):
         query_params_json = {k.lower(): v for k, v in query_params_json.items()}
 
         from_clause = "gaiadr3.gaia_source AS gs\n"
@@ -59,36 +113,102 @@ class DBAccessGaia(DBAccessBase):
                         circle_center_radius = objects_in_circle.get(Category.Radius.name.lower())
                         where_clause = self._addConditionToWhere(where_clause,
                                             f"1=CONTAINS(POINT('ICRS', {self.CategoryInfo.get(Category.RA)[0]}, {self.CategoryInfo.get(Category.Dec)[0]}), CIRCLE('ICRS', {circle_center_ra}, {circle_center_dec}, {circle_center_radius}))")
+        return from_clause, where_clause, table_aliases
 
-        #if chunk_size
+    def QueryCatalog(self, query_params_json, limit, chunk_size):
+        # the whole result is requested at once, chunk_size is used only by QueryCatalogChunks
+        with Stage_Metrics.Stage("adql_build"):
+            query = self._constructADQLQuery(query_params_json, limit, None)
+        # cone searches are answered from cached sky tiles when possible
+        table = Cone_Tile_Cache.QueryCone(self, query_params_json, limit, query)
+        if table is None:
+            table = self._requestTableCached(query)
 
-        #form SELECT clause
-        select_criteria = ""
-        if limit:
-            select_criteria = f"TOP {limit}"
-        select_clause = f"SELECT {select_criteria} gs.source_id AS {self.ColumnId}"
-        for category, field_data in self.CategoryInfo.items():
-            if  field_data[1] in table_aliases and field_data[0]:
-                field_name = field_data[0]
-                select_clause += f", {field_name} AS {category.name}"
+        return self.Catalog, query, QueryResult(table)
 
-        query = select_clause + "\n FROM " + from_clause
-        if where_clause != "":
-            query += "\n WHERE " + where_clause
-        return query
+    def QueryCatalogChunks(self, query_params_json, limit, chunk_size):
+        last_source_id = None
+        rows_count = 0
+        while True:
+            # the last page is shortened so that no more than limit rows are returned in total
+            page_size = chunk_size
+            if limit:
+                page_size = min(chunk_size, limit - rows_count)
+                if page_size <= 0:
+                    return
 
-    def QueryCatalog(self, query_params_json, limit, chunk_size):
+            with Stage_Metrics.Stage("adql_build"):
+                query = self._constructADQLQuery(query_params_json, limit, page_size, last_source_id)
+            table = self._requestTableCached(query)
+            # the first page is returned even if it is empty, so that the client gets the query and columns
+            if len(table) == 0 and last_source_id is not None:
+                return
+
+            yield self.Catalog, query, QueryResult(table)
+
+            rows_count += len(table)
+            if len(table) < page_size:
+                return
+            last_source_id = int(table[self.ColumnId][-1])
 
-        query = self._constructADQLQuery(query_params_json, limit, chunk_size)
+    # big queries are requested through Gaia asynchronous endpoint, small ones through the synchronous endpoint
+    def QueryCatalogAsyncJob(self, query_params_json, limit, chunk_size, cancel_event):
+        with Stage_Metrics.Stage("adql_build"):
+            query = self._constructADQLQuery(query_params_json, limit, None)
+        use_async = not limit or limit > Async_Rows_Threshold
+        table = self._requestTableCached(query, use_async=use_async, cancel_event=cancel_event)
+
+        return self.Catalog, query, QueryResult(table)
+
+    # asyncio version of QueryCatalog, cone searches which need tiles not cached yet request them in a thread
+    async def QueryCatalogAsync(self, query_params_json, limit, chunk_size):
+        with Stage_Metrics.Stage("adql_build"):
+            query = self._constructADQLQuery(query_params_json, limit, None)
+        table = None
+        if "CONTAINS(" in query:
+            table = await asyncio.to_thread(Cone_Tile_Cache.QueryCone, self, query_params_json, limit, query)
+        if table is None:
+            table = await self._requestTableCachedAsync(query)
+
+        return self.Catalog, query, QueryResult(table)
+
+    # asyncio version of QueryCatalogChunks
+    async def QueryCatalogChunksAsync(self, query_params_json, limit, chunk_size):
+        last_source_id = None
+        rows_count = 0
+        while True:
+            page_size = chunk_size
+            if limit:
+                page_size = min(chunk_size, limit - rows_count)
+                if page_size <= 0:
+                    return
+
+            with Stage_Metrics.Stage("adql_build"):
+                query = self._constructADQLQuery(query_params_json, limit, page_size, last_source_id)
+            table = await self._requestTableCachedAsync(query)
+            if len(table) == 0 and last_source_id is not None:
+                return
+
+            yield self.Catalog, query, QueryResult(table)
+
+            rows_count += len(table)
+            if len(table) < page_size:
+                return
+            last_source_id = int(table[self.ColumnId][-1])
+
+    # request ADQL query to Gaia API and return the result as astropy table
+    def _requestTable(self, query, use_async=False, cancel_event=None):
         #query = "SELECT TOP 10 source_id, ra, dec FROM gaiadr3.gaia_source"
-        params = {
-            "REQUEST": "doQuery",
-            "LANG": "ADQL",
-            "QUERY": query,
-            "FORMAT": "votable"
-        }
+        params = self._queryParams(query)
         try:
-            response = requests.post(Gaia_Url, data=params, headers=HTTP_Headers)
+            if use_async:
+                response = self._requestAsyncJob(query, params, cancel_event)
+            else:
+                # the body is not read here, it is decoded while it is received
+                with Stage_Metrics.Stage("gaia_request"):
+                    response = self.Transport.Post(Gaia_Url, data=params, headers=HTTP_Headers, stream=True)
+        except RequestProcessingError:
+            raise
         except Exception as e:
             raise RequestProcessingError(self.Catalog, query,f"Error processing Gaia request", str(e))
 
@@ -97,18 +217,113 @@ class DBAccessGaia(DBAccessBase):
                 #print(response.headers)
                 #print(response.text[:500])
 
-                votable = parse(BytesIO(response.content))
-                table = votable.get_first_table().to_table()
-
-                columns = table.colnames
-                rows = [dict(zip(columns, row)) for row in table]
-                return self.Catalog, query, columns, rows, table
+                # download and decoding of the body overlap, the stage includes both
+                with Stage_Metrics.Stage("votable_stream") as stage:
+                    table, stage.Bytes = ReadVOTableStream(response, self._expectedRows(query))
+                    stage.Rows = len(table)
+                return table
 
             except Exception as e:
                 raise RequestProcessingError(self.Catalog, query, "API request failed", str(e))
 
         raise RequestProcessingError(self.Catalog, query, "API request failed",  f"HTTP error {response.status_code}: {response.text}")
 
+    # asyncio version of _requestTable for Gaia synchronous endpoint
+    # The body is received without blocking the event loop and decoded in a worker process
+    async def _requestTableAsync(self, query):
+        try:
+            with Stage_Metrics.Stage("gaia_request") as stage:
+                async with self.AsyncTransport.Stream("POST", Gaia_Url, data=self._queryParams(query)) as response:
+                    if response.status_code != 200:
+                        error = (await response.aread()).decode("utf-8", errors="replace")
+                        raise RequestProcessingError(self.Catalog, query, "API request failed", f"HTTP error {response.status_code}: {error}")
+                    body = b"".join([chunk async for chunk in response.aiter_bytes(Read_Chunk_Size)])
+                stage.Bytes = len(body)
+        except RequestProcessingError:
+            raise
+        except Exception as e:
+            raise RequestProcessingError(self.Catalog, query, f"Error processing Gaia request", str(e))
+
+        try:
+            with Stage_Metrics.Stage("votable_parse") as stage:
+                table = await Cpu_Pool.Run(ReadVOTableBytes, body, self._expectedRows(query), size=len(body))
+                stage.Rows = len(table)
+            return table
+        except Exception as e:
+            raise RequestProcessingError(self.Catalog, query, "API request failed", str(e))
+
+    # parameters of TAP request for the ADQL query
+    @staticmethod
+    def _queryParams(query):
+        return {
+            "REQUEST": "doQuery",
+            "LANG": "ADQL",
+            "QUERY": query,
+            "FORMAT": Gaia_Format
+        }
+
+    # create Gaia asynchronous job, wait until it is finished and return the response with its result
+    def _requestAsyncJob(self, query, params, cancel_event):
+        # the job is created and waited for, this time is mostly spent in Gaia queue and execution
+        with Stage_Metrics.Stage("gaia_async_job"):
+            job_url = self._waitForAsyncJob(query, params, cancel_event)
+        with Stage_Metrics.Stage("gaia_result_request"):
+            return self.Transport.Get(job_url + "/results/result", stream=True)
+
+    # random_index is a random permutation of the row numbers of gaia_source, its ranges are random samples
+    def _sampleCondition(self, rows):
+        return f"gs.random_index < {int(rows)}"
+
+    # the number of rows the query returns at most (its TOP) or None, column arrays are allocated for it
+    @staticmethod
+    def _expectedRows(query):
+        top = re.match(r"\s*SELECT\s+TOP\s+(\d+)", query, re.IGNORECASE)
+        return int(top.group(1)) if top else None
+
+    # create Gaia asynchronous job and return its URL when it is completed
+    def _waitForAsyncJob(self, query, params, cancel_event):
+        response = self.Transport.Post(Gaia_Async_Url, data=dict(params, PHASE="RUN"), headers=HTTP_Headers, allow_redirects=False)
+        job_url = response.headers.get("Location")
+        if response.status_code not in (200, 303) or not job_url:
+            raise RequestProcessingError(self.Catalog, query, "API request failed", f"HTTP error {response.status_code}: {response.text}")
+
+        deadline = time.monotonic() + Async_Job_Timeout
+        poll_interval = Async_Poll_Interval
+        while True:
+            response = self.Transport.Get(job_url + "/phase")
+            phase = response.text.strip()
+            if response.status_code != 200:
+                raise RequestProcessingError(self.Catalog, query, "API request failed",
+                                             f"Gaia job {job_url} phase is not available, HTTP error {response.status_code}: {response.text[:500]}")
+            if phase == "COMPLETED":
+                return job_url
+            if phase in ("ERROR", "ABORTED"):
+                error = self.Transport.Get(job_url + "/error").text
+                raise RequestProcessingError(self.Catalog, query, phase, f"Gaia job {job_url} failed: {error}")
+            # HELD, SUSPENDED, UNKNOWN or a page which is not a phase: the job wouldn't finish by itself
+            if phase not in Async_Running_Phases:
+                self._abortAsyncJob(job_url)
+                raise RequestProcessingError(self.Catalog, query, "API request failed", f"Gaia job {job_url} is in phase {phase[:100]}")
+            if time.monotonic() >= deadline:
+                self._abortAsyncJob(job_url)
+                raise RequestProcessingError(self.Catalog, query, "Timeout", f"Gaia job {job_url} is not finished in {Async_Job_Timeout} s")
+
+            # wait for the next check, abort Gaia job if our job is cancelled in the meantime
+            poll_interval = min(poll_interval, max(0.0, deadline - time.monotonic()))
+            if cancel_event is not None and cancel_event.wait(poll_interval):
+                self._abortAsyncJob(job_url)
+                raise RequestProcessingError(self.Catalog, query, "ABORTED", f"Gaia job {job_url} is cancelled")
+            if cancel_event is None:
+                time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, Async_Poll_Max_Interval)
+
+    # the request fails with the error of the job even if Gaia doesn't accept the abort, the job is removed by Gaia later
+    def _abortAsyncJob(self, job_url):
+        try:
+            self.Transport.Post(job_url + "/phase", data={"PHASE": "ABORT"}, headers=HTTP_Headers)
+        except Exception:
+            pass
+
     @property
     def CategoryInfo(self):
         return {
@@ -1,77 +1,124 @@
 from .DBAccessBase import DBAccessBase
+from .QueryResult import QueryResult
+from .StageMetrics import Stage_Metrics
+from .HttpTransport import Accept_Encoding
+from .VOTableStream import ReadVOTableStream
 from DBaccess.RequestProcessingError import RequestProcessingError
 from .DBAccessEnums import Category, ObjectTypes
 
+# SIMBAD TAP synchronous endpoint
+Simbad_Url = "http://simbad.u-strasbg.fr/simbad/sim-tap/sync"
+
+Simbad_Format = "votable"
+
+HTTP_Headers = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Accept-Encoding": Accept_Encoding,
+}
+
 class DBAccessSimbad(DBAccessBase):
-    def QueryCatalog(self, query_params_json, limit, chunk_size):
-        def _constructADQLQuery(self, query_params_json, limit, chunk_size) -> str:
-            query_params_json = {k.lower(): v for k, v in query_params_json.items()}
+    def _constructADQLQuery(self, query_params_json, limit, chunk_size) -> str:
+        from_clause, where_clause, table_aliases = self._constructFromWhere(query_params_json)
 
-            from_clause = ("basic AS bs\n" +
-                    "       INNER JOIN ident ON bs.oid = ident.oidref\n"
-                    "       INNER JOIN otypedef ON bs.otype = otypedef.otype\n")
-            where_clause = ""
+        # form SELECT clause
+        select_criteria = ""
+        if limit:
+            select_criteria = f"TOP {limit}"
+        select_clause = (f'SELECT {select_criteria} bs.main_id AS {self.ColumnId}, '
+                          'bs.otype AS simbad_otype, otypedef.description AS simbad_type_description')
+        for category, field_data in self.CategoryInfo.items():
+            if field_data[1] in table_aliases and field_data[0]:
+                field_name = field_data[0]
+                select_clause += f", {field_name} AS {category.name}"
 
-            table_aliases = []
-            # form FROM and WHERE clauses depending on specified object type
-            if query_params_json.get('object_types'):
-                object_types = query_params_json['object_types']
-                object_types = object_types.lower()
+        query = select_clause + "\n FROM " + from_clause
+        if where_clause != "":
+            query += "\n WHERE " + where_clause
+        return query
 
-                if object_types == ObjectTypes.Star.value.lower():
-                    where_clause = self._addConditionToWhere(where_clause, " bs.otype LIKE '*%'")
+    # FROM and WHERE clauses of the rows selected by query parameters and aliases of the tables in FROM clause
+    def _constructFromWhere(self, query_params_json):
+        query_params_json = {k.lower(): v for k, v in query_params_json.items()}
 
-                elif object_types == ObjectTypes.Galaxy.value.lower():
-                    table_aliases = ["gs"]
-                    where_clause = self._addConditionToWhere(where_clause,
-                                                             " gs.classprob_dsc_combmod_galaxy > 0.8 AND ABS(gs.parallax) < 0.1 AND ABS(gs.pmra) < 0.1 AND ABS(gs.pmdec) < 0.1")
+        # one row per object: identifiers (ident) are not joined, every object has many of them
+        from_clause = ("basic AS bs\n" +
+                "       INNER JOIN otypedef ON bs.otype = otypedef.otype\n"
+                "       LEFT OUTER JOIN allfluxes AS af ON af.oidref = bs.oid\n")
+        where_clause = ""
+
+        table_aliases = ["bs", "af"]
+        # form WHERE clause depending on specified object type, 'T..' selects type T and all its subtypes
+        if query_params_json.get('object_types'):
+            object_types = query_params_json['object_types']
+            object_types = object_types.lower()
+
+            if object_types == ObjectTypes.Star.value.lower():
+                where_clause = self._addConditionToWhere(where_clause, "bs.otype = '*..'")
+
+            elif object_types == ObjectTypes.Galaxy.value.lower():
+                where_clause = self._addConditionToWhere(where_clause, "bs.otype = 'G..'")
+
+            elif object_types == ObjectTypes.Quasar.value.lower():
+                where_clause = self._addConditionToWhere(where_clause, "bs.otype = 'QSO..'")
+            else:
+                raise ValueError(f"Invalid object_types={object_types} is specified.")
 
-                elif object_types == ObjectTypes.Quasar.value.lower():
-                    table_aliases = ["gs"]
+        # form WHERE clauses depending on specified categories, categories without SIMBAD column are not filtered
+        for category, field_data in self.CategoryInfo.items():
+            category_name = category.name.lower()
+            if field_data[1] in table_aliases:
+                if field_data[0] and query_params_json.get('min_' + category_name):
                     where_clause = self._addConditionToWhere(where_clause,
-                                                             " gs.classprob_dsc_combmod_quasar > 0.8 AND ABS(gs.parallax) < 0.1 AND ABS(gs.pmra) < 0.1 AND ABS(gs.pmdec) < 0.1")
-                else:
-                    raise ValueError("Invalid object_types={object_types} is specified.")
-
-            # form WHERE clauses depending on specified categories
-            for category, field_data in self.CategoryInfo.items():
-                category_name = category.name.lower()
-                if field_data[1] in table_aliases:
-                    if query_params_json.get('min_' + category_name):
-                        where_clause = self._addConditionToWhere(where_clause,
-                                                                 f"{field_data[0]} >= {query_params_json['min_' + category_name]}")
-                    if query_params_json.get('max_' + category_name):
+                                                             f"{field_data[0]} >= {query_params_json['min_' + category_name]}")
+                if field_data[0] and query_params_json.get('max_' + category_name):
+                    where_clause = self._addConditionToWhere(where_clause,
+                                                             f"{field_data[0]} <= {query_params_json['max_' + category_name]}")
+                if category_name == Category.ObjectsInCircle.name.lower() and query_params_json.get(category_name):
+                    objects_in_circle = query_params_json.get(category_name)
+                    if (objects_in_circle.get(Category.RA.name.lower()) and
+                            objects_in_circle.get(Category.Dec.name.lower()) and
+                            objects_in_circle.get(Category.Radius.name.lower())):
+                        circle_center_ra = objects_in_circle.get(Category.RA.name.lower())
+                        circle_center_dec = objects_in_circle.get(Category.Dec.name.lower())
+                        circle_center_radius = objects_in_circle.get(Category.Radius.name.lower())
                         where_clause = self._addConditionToWhere(where_clause,
-                                                                 f"{field_data[0]} <= {query_params_json['max_' + category_name]}")
-                    if category_name == Category.ObjectsInCircle.name.lower() and query_params_json.get(category_name):
-                        objects_in_circle = query_params_json.get(category_name)
-                        if (objects_in_circle.get(Category.RA.name.lower()) and
-                                objects_in_circle.get(Category.Dec.name.lower()) and
-                                objects_in_circle.get(Category.Radius.name.lower())):
-                            circle_center_ra = objects_in_circle.get(Category.RA.name.lower())
-                            circle_center_dec = objects_in_circle.get(Category.Dec.name.lower())
-                            circle_center_radius = objects_in_circle.get(Category.Radius.name.lower())
-                            where_clause = self._addConditionToWhere(where_clause,
-                                                                     f"1=CONTAINS(POINT('ICRS', {self.CategoryInfo.get(Category.RA)[0]}, {self.CategoryInfo.get(Category.Dec)[0]}), CIRCLE('ICRS', {circle_center_ra}, {circle_center_dec}, {circle_center_radius}))")
-
-            # if chunk_size
-
-            # form SELECT clause
-            select_criteria = ""
-            if limit:
-                select_criteria = f"TOP {limit}"
-            select_clause = (f'SELECT {select_criteria} bs.main_id AS {self.ColumnId}, ' 
-                              'ident.id AS simbad_name, bs.otype AS simbad_otype, otypedef.description simbad_type_description,\n')
-            for category, field_data in self.CategoryInfo.items():
-                if field_data[1] in table_aliases and field_data[0]:
-                    field_name = field_data[0]
-                    select_clause += f", {field_name} AS {category.name}"
-
-            query = select_clause + "\n FROM " + from_clause
-            if where_clause != "":
-                query += "\n WHERE " + where_clause
-            return query
+                                                                 f"1=CONTAINS(POINT('ICRS', {self.CategoryInfo.get(Category.RA)[0]}, {self.CategoryInfo.get(Category.Dec)[0]}), CIRCLE('ICRS', {circle_center_ra}, {circle_center_dec}, {circle_center_radius}))")
+        return from_clause, where_clause, table_aliases
+
+    def QueryCatalog(self, query_params_json, limit, chunk_size):
+        # SIMBAD has no chunked mode, the whole result is requested at once
+        with Stage_Metrics.Stage("adql_build"):
+            query = self._constructADQLQuery(query_params_json, limit, None)
+        table = self._requestTableCached(query)
+
+        return self.Catalog, query, QueryResult(table)
+
+    # request ADQL query to SIMBAD TAP synchronous endpoint and return the result as astropy table
+    def _requestTable(self, query, **request_args):
+        params = {
+            "REQUEST": "doQuery",
+            "LANG": "ADQL",
+            "QUERY": query,
+            "FORMAT": Simbad_Format
+        }
+        try:
+            with Stage_Metrics.Stage("simbad_request"):
+                response = self.Transport.Post(Simbad_Url, data=params, headers=HTTP_Headers, stream=True)
+        except Exception as e:
+            raise RequestProcessingError(self.Catalog, query, f"Error processing SIMBAD request", str(e))
+
+        if response.status_code == 200:
+            try:
+                with Stage_Metrics.Stage("votable_stream") as stage:
+                    table, stage.Bytes = ReadVOTableStream(response)
+                    stage.Rows = len(table)
+                return table
+            except Exception as e:
+                raise RequestProcessingError(self.Catalog, query, "API request failed", str(e))
+
+        raise RequestProcessingError(self.Catalog, query, "API request failed",  f"HTTP error {response.status_code}: {response.text}")
 
+    # columns of SIMBAD for the categories, an empty column means SIMBAD has no such value
     @property
     def CategoryInfo(self):
         return {
@@ -80,11 +127,12 @@ class DBAccessSimbad(DBAccessBase):
             Category.Dec: ['bs.dec', 'bs'],
             Category.PMRA: ['bs.pmra', 'bs'],
             Category.PMDec: ['bs.pmdec', 'bs'],
-            Category.Parallax: ['gs.plx_value', 'bs'],
-            Category.ProperMotion: ['gs.pm', 'bs'],
-            Category.GMagnitude: ['bs.g_mag', 'bs'],
-            Category.BPMagnitude: ['bs.bp_mag', 'bs'],
-            Category.RPMagnitude: ['bs.rp_mag', 'bs'],
+            Category.Parallax: ['bs.plx_value', 'bs'],
+            Category.ProperMotion: ['', 'bs'],
+            # from allfluxes AS af, G is Gaia G-band magnitude
+            Category.GMagnitude: ['af.G', 'af'],
+            Category.BPMagnitude: ['', 'af'],
+            Category.RPMagnitude: ['', 'af'],
             #Radial velocity in km/s
             Category.RadialVelocity: ['bs.rvz_radvel', 'bs'],
             Category.ObjectsInCircle: ['', 'bs'],
@@ -101,4 +149,4 @@ class DBAccessSimbad(DBAccessBase):
     # Epoch used for the catalog
     @property
     def Epoch(self):
-        return "J2000.0" # SIMBAD epoch (J2000.0)
\ No newline at end of file
+        return "J2000.0" # SIMBAD epoch (J2000.0)
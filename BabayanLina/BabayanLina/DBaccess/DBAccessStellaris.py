@@ -1 +1,121 @@
+from .DBAccessBase import DBAccessBase
+from .QueryResult import QueryResult
+from .StageMetrics import Stage_Metrics
+from .StellarisStore import Stellaris_Store, Store_Epoch, Column_Id, Column_Object_Type, ObjectTypeName
+from DBaccess.RequestProcessingError import RequestProcessingError
+from .DBAccessEnums import Category
 
+# Our own catalog: Gaia and SIMBAD extracts ingested into the local store (StellarisStore)
+# Queries take the same query parameters as the remote catalogs and are answered locally without any request.
+# The query in responses is ADQL equivalent of the local query, it names columns of the store (alias st).
+class DBAccessStellaris(DBAccessBase):
+    def _constructADQLQuery(self, query_params_json, limit, chunk_size) -> str:
+        ranges, cone, object_type = self._storeFilters(query_params_json)
+
+        where_clause = ""
+        if object_type:
+            where_clause = self._addConditionToWhere(where_clause, f"st.{Column_Object_Type} = '{object_type}'")
+        for name, (low, high) in ranges.items():
+            if low is not None:
+                where_clause = self._addConditionToWhere(where_clause, f"st.{name} >= {low}")
+            if high is not None:
+                where_clause = self._addConditionToWhere(where_clause, f"st.{name} <= {high}")
+        if cone is not None:
+            where_clause = self._addConditionToWhere(where_clause,
+                                f"1=CONTAINS(POINT('ICRS', {self.CategoryInfo.get(Category.RA)[0]}, {self.CategoryInfo.get(Category.Dec)[0]}), CIRCLE('ICRS', {cone[0]}, {cone[1]}, {cone[2]}))")
+
+        select_criteria = f"TOP {limit} " if limit else ""
+        query = f"SELECT {select_criteria}st.*\n FROM stellaris AS st"
+        if where_clause != "":
+            query += "\n WHERE " + where_clause
+        return query
+
+    def QueryCatalog(self, query_params_json, limit, chunk_size):
+        with Stage_Metrics.Stage("adql_build"):
+            query = self._constructADQLQuery(query_params_json, limit, None)
+        ranges, cone, object_type = self._storeFilters(query_params_json)
+        try:
+            with Stage_Metrics.Stage("local_query") as stage:
+                table = Stellaris_Store.Query(ranges, cone, object_type, limit)
+                stage.Rows = len(table)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise RequestProcessingError(self.Catalog, query, "Local catalog query failed", str(e))
+
+        return self.Catalog, query, QueryResult(table)
+
+    # the result is read at once, pages of chunk_size rows are cut from it
+    def QueryCatalogChunks(self, query_params_json, limit, chunk_size):
+        catalog, query, result = self.QueryCatalog(query_params_json, limit, None)
+        table = result.Table
+        for start in range(0, max(len(table), 1), chunk_size):
+            yield catalog, query, QueryResult(table[start:start + chunk_size])
+
+    # all rows of the local catalog are available locally, cross matching with them never requests a remote catalog
+    def LocalCrossMatchTable(self, ra, dec, radius):
+        return Stellaris_Store.RowsNear(ra, dec, radius)
+
+    @property
+    def HasLocalRows(self):
+        return True
+
+    # filters of the query parameters in terms of the store: {column: (low, high)}, cone (ra, dec, radius) or None
+    # and object type or None
+    def _storeFilters(self, query_params_json):
+        query_params_json = {k.lower(): v for k, v in query_params_json.items()}
+
+        object_type = None
+        if query_params_json.get('object_types'):
+            object_type = ObjectTypeName(query_params_json['object_types'])
+
+        ranges = {}
+        for category, field_data in self.CategoryInfo.items():
+            if not field_data[0]:
+                continue
+            category_name = category.name.lower()
+            low = self._filterValue(query_params_json, 'min_' + category_name)
+            high = self._filterValue(query_params_json, 'max_' + category_name)
+            if low is not None or high is not None:
+                ranges[category.name] = (low, high)
+
+        cone = None
+        objects_in_circle = query_params_json.get(Category.ObjectsInCircle.name.lower())
+        if objects_in_circle:
+            try:
+                cone = (float(objects_in_circle.get(Category.RA.name.lower())),
+                        float(objects_in_circle.get(Category.Dec.name.lower())),
+                        float(objects_in_circle.get(Category.Radius.name.lower())))
+            except (TypeError, ValueError, AttributeError):
+                raise ValueError(f"Invalid {Category.ObjectsInCircle.name}={objects_in_circle}, expected ra, dec and radius")
+        return ranges, cone, object_type
+
+    @staticmethod
+    def _filterValue(query_params_json, name):
+        value = query_params_json.get(name)
+        if value is None or value == "":
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Cannot convert to number {name} value: {value}")
+
+    @property
+    def CategoryInfo(self):
+        # every category is a column of the store
+        category_info = {category: [f"st.{category.name}", 'st'] for category in Category}
+        category_info[Category.ObjectsInCircle] = ['', 'st']
+        return category_info
+
+    @property
+    def Catalog(self):
+        return "stellaris"
+
+    @property
+    def ColumnId(self):
+        return Column_Id
+
+    # Epoch used for the catalog, positions of all extracts are propagated to it when they are ingested
+    @property
+    def Epoch(self):
+        return Store_Epoch
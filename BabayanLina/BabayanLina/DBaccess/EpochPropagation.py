@@ -0,0 +1,76 @@
+import numpy as np
+
+# Number of rows propagated at once, temporary arrays of a block fit into CPU cache
+Block_Size = 8192
+
+# Astronomical unit per Julian year in km/s, converts radial velocity * parallax into radial proper motion
+Au_Per_Year_In_Km_Per_S = 4.740470463533348
+Mas_To_Rad = np.pi / (180.0 * 3600.0 * 1000.0)
+
+
+# Convert catalog epoch ("J2015.5", 2015.5) to Julian year
+def EpochToJulianYear(epoch):
+    if isinstance(epoch, str):
+        epoch = epoch.strip()
+        if epoch[:1].upper() == "J":
+            epoch = epoch[1:]
+    return float(epoch)
+
+
+# Propagate ICRS positions from epoch to new_epoch with the linear space motion model (uniform motion along a straight
+# line, ESA Hipparcos catalogue vol. 1, section 1.2.8)
+# ra, dec are in degrees, pmra (including cos(dec)), pmdec and parallax are in mas and mas/yr, radial_velocity is in km/s.
+# Undefined (NaN or masked) proper motion is taken as zero motion, undefined parallax or radial velocity as zero
+# radial motion. Returns propagated ra and dec in degrees as float64 arrays.
+def PropagatePositions(ra, dec, pmra, pmdec, epoch, new_epoch, parallax=None, radial_velocity=None, block_size=Block_Size):
+    ra = _toFloatArray(ra)
+    dec = _toFloatArray(dec)
+    pmra = np.nan_to_num(_toFloatArray(pmra), nan=0.0)
+    pmdec = np.nan_to_num(_toFloatArray(pmdec), nan=0.0)
+    # radial proper motion in mas/yr
+    if parallax is not None and radial_velocity is not None:
+        pmr = np.nan_to_num(_toFloatArray(radial_velocity) * _toFloatArray(parallax) / Au_Per_Year_In_Km_Per_S, nan=0.0)
+    else:
+        pmr = None
+
+    years = EpochToJulianYear(new_epoch) - EpochToJulianYear(epoch)
+    new_ra = np.empty_like(ra)
+    new_dec = np.empty_like(dec)
+    for start in range(0, len(ra), block_size):
+        block = slice(start, start + block_size)
+        new_ra[block], new_dec[block] = _propagateBlock(ra[block], dec[block], pmra[block], pmdec[block],
+                                                        None if pmr is None else pmr[block], years)
+    return new_ra, new_dec
+
+
+def _propagateBlock(ra, dec, pmra, pmdec, pmr, years):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    sin_ra, cos_ra = np.sin(ra), np.cos(ra)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+
+    # proper motion vector mu0 = p * pmra + q * pmdec multiplied by time, p and q are unit vectors towards
+    # increasing ra and dec, r is the direction to the source
+    pmra_t = pmra * (Mas_To_Rad * years)
+    pmdec_t = pmdec * (Mas_To_Rad * years)
+    x = cos_dec * cos_ra - sin_ra * pmra_t - sin_dec * cos_ra * pmdec_t
+    y = cos_dec * sin_ra + cos_ra * pmra_t - sin_dec * sin_ra * pmdec_t
+    z = sin_dec + cos_dec * pmdec_t
+
+    # radial motion only changes the scale of the vector r + mu0 * t, the direction is r * (1 + mu_r * t) + mu0 * t
+    if pmr is not None:
+        pmr_t = pmr * (Mas_To_Rad * years)
+        x += cos_dec * cos_ra * pmr_t
+        y += cos_dec * sin_ra * pmr_t
+        z += sin_dec * pmr_t
+
+    new_ra = np.degrees(np.arctan2(y, x)) % 360.0
+    new_dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return new_ra, new_dec
+
+
+# plain float64 array from list, numpy array, astropy column or quantity, masked values become NaN
+def _toFloatArray(values):
+    if hasattr(values, "unit") and hasattr(values, "value") and not hasattr(values, "mask"):
+        values = values.value
+    return np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
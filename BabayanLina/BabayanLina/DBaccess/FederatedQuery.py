@@ -0,0 +1,301 @@
+from abc import ABC
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+import astropy.units as u
+from astropy.table import Table, MaskedColumn, vstack
+
+from .DBAccessBase import DBAccessBase
+from .DBAccessEnums import Category
+from .QueryResult import QueryResult
+from .SpatialMatching import SpatialIndex
+from .EpochPropagation import PropagatePositions, EpochToJulianYear
+from .CrossMatching import match_radius, column_separation, ColumnFloatValues
+from .CpuPool import Cpu_Pool
+from .StageMetrics import Stage_Metrics
+from DBaccess.RequestProcessingError import RequestProcessingError
+
+# results of the catalogs are returned side by side, or merged into one table by position
+Merge_Side_By_Side = "side_by_side"
+Merge_Position = "position"
+Merge_Modes = (Merge_Side_By_Side, Merge_Position)
+
+# seconds every catalog is waited for unless the request sets its own timeout
+federated_timeout = 60
+
+# rows of different catalogs closer than this radius in degrees are merged into one row, the same radius as cross matching
+merge_radius = match_radius
+
+Status_Success = "success"
+Status_Timeout = "Timeout"
+Status_Not_Merged = "Not merged"
+
+
+# Result of one catalog of a federated query: the result table, or the status and error if the catalog failed
+class FederatedCatalogResult:
+    def __init__(self, catalog, ignored_filters):
+        self.catalog = catalog
+        self.query = ""
+        # filters of the request which the catalog has no column for, they are not applied to its rows
+        self.ignored_filters = ignored_filters
+        self.status = Status_Success
+        self.error = None
+        self.result = None
+        self.seconds = None
+
+    @property
+    def Succeeded(self):
+        return self.result is not None
+
+    def Fail(self, status, error):
+        self.status = status
+        self.error = error
+        self.result = None
+
+    def ToDict(self):
+        return {
+            "catalog": self.catalog,
+            "query": self.query,
+            "ignored_filters": self.ignored_filters,
+            "rows": len(self.result) if self.result is not None else 0,
+            "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+            "status": self.status,
+            "error": self.error,
+        }
+
+
+# Query several catalogs with the same query parameters
+# Catalogs are requested concurrently, so the query takes as long as the slowest catalog. Every catalog has its own
+# timeout; a catalog which fails or doesn't answer in time is reported in its result, and the results of the other
+# catalogs are still returned. The query fails only when all catalogs fail.
+class FederatedQuery(ABC):
+    # catalogs are DBAccess objects, timeouts maps catalog name to seconds (federated_timeout by default)
+    # Returns results of the catalogs in the order of catalogs and, for Merge_Position, QueryResult of the merged table
+    def Query(self, catalogs, query_params_json, limit, merge=Merge_Side_By_Side, timeouts=None):
+        prepared = self.__prepare(catalogs, query_params_json, limit)
+        requested = [(db_access, params, catalog_result) for db_access, params, catalog_result in prepared if catalog_result.status == Status_Success]
+
+        # threads of catalogs which timed out are not waited for, their requests end in the background and still fill the cache
+        executor = ThreadPoolExecutor(max_workers=max(1, len(requested)), thread_name_prefix="stellaris-federated")
+        try:
+            # catalogs are requested in the context of the request, so their stages are added to its timings
+            futures = [executor.submit(contextvars.copy_context().run, self.__timedQuery, db_access, params, limit)
+                       for db_access, params, catalog_result in requested]
+            start = time.monotonic()
+            # catalogs are waited for in the order of their deadlines, so a catalog is never waited for past its own deadline
+            waited = sorted(zip(requested, futures), key=lambda item: _timeout(timeouts, item[0][0].Catalog))
+            for (db_access, params, catalog_result), future in waited:
+                timeout = _timeout(timeouts, db_access.Catalog)
+                try:
+                    catalog_result.result, catalog_result.seconds = future.result(timeout=max(0.0, start + timeout - time.monotonic()))
+                except FutureTimeoutError:
+                    catalog_result.Fail(Status_Timeout, f"{db_access.Catalog} didn't answer in {timeout} seconds")
+                except RequestProcessingError as e:
+                    catalog_result.Fail(e.status, str(e))
+                except Exception as e:
+                    catalog_result.Fail("System error", str(e))
+        finally:
+            executor.shutdown(wait=False)
+
+        catalog_results = [catalog_result for db_access, params, catalog_result in prepared]
+        self.__checkResults(catalog_results)
+        if merge != Merge_Position:
+            return catalog_results, None
+
+        tables = self.__mergedTables(prepared)
+        with Stage_Metrics.Stage("federated_merge") as stage:
+            merged_table = MergeByPosition(tables)
+            stage.Rows = len(merged_table)
+        return catalog_results, QueryResult(merged_table)
+
+    # asyncio version of Query used by the asyncio serving mode, the merge runs in a worker process of Cpu_Pool
+    async def QueryAsync(self, catalogs, query_params_json, limit, merge=Merge_Side_By_Side, timeouts=None):
+        prepared = self.__prepare(catalogs, query_params_json, limit)
+
+        async def queryCatalog(db_access, params, catalog_result):
+            timeout = _timeout(timeouts, db_access.Catalog)
+            start = time.perf_counter()
+            try:
+                catalog, query, catalog_result.result = await asyncio.wait_for(db_access.QueryCatalogAsync(params, limit, None), timeout)
+                catalog_result.seconds = time.perf_counter() - start
+            except asyncio.TimeoutError:
+                catalog_result.Fail(Status_Timeout, f"{db_access.Catalog} didn't answer in {timeout} seconds")
+            except RequestProcessingError as e:
+                catalog_result.Fail(e.status, str(e))
+            except Exception as e:
+                catalog_result.Fail("System error", str(e))
+
+        await asyncio.gather(*[queryCatalog(db_access, params, catalog_result)
+                               for db_access, params, catalog_result in prepared if catalog_result.status == Status_Success])
+
+        catalog_results = [catalog_result for db_access, params, catalog_result in prepared]
+        self.__checkResults(catalog_results)
+        if merge != Merge_Position:
+            return catalog_results, None
+
+        tables = self.__mergedTables(prepared)
+        with Stage_Metrics.Stage("federated_merge") as stage:
+            merged_table = await Cpu_Pool.Run(MergeByPosition, tables, rows=sum(len(table) for catalog, table, epoch in tables))
+            stage.Rows = len(merged_table)
+        return catalog_results, QueryResult(merged_table)
+
+    # query parameters of every catalog and its result with the ADQL query, catalogs with invalid parameters fail
+    # right away and are not requested
+    def __prepare(self, catalogs, query_params_json, limit):
+        prepared = []
+        for db_access in catalogs:
+            params, ignored_filters = TranslateQueryParams(db_access, query_params_json)
+            catalog_result = FederatedCatalogResult(db_access.Catalog, ignored_filters)
+            try:
+                catalog_result.query = db_access._constructADQLQuery(params, limit, None) or ""
+            except ValueError as e:
+                catalog_result.Fail("Input error", str(e))
+            prepared.append((db_access, params, catalog_result))
+        return prepared
+
+    def __timedQuery(self, db_access: DBAccessBase, params, limit):
+        start = time.perf_counter()
+        catalog, query, result = db_access.QueryCatalog(params, limit, None)
+        return result, time.perf_counter() - start
+
+    def __checkResults(self, catalog_results):
+        if not any(catalog_result.Succeeded for catalog_result in catalog_results):
+            errors = "; ".join(f"{catalog_result.catalog}: {catalog_result.error}" for catalog_result in catalog_results)
+            raise RequestProcessingError(", ".join(catalog_result.catalog for catalog_result in catalog_results), "", "All catalogs failed", errors)
+
+    # (catalog, table, epoch) of the results to merge, results without positions can't be merged and are reported so
+    def __mergedTables(self, prepared):
+        tables = []
+        for db_access, params, catalog_result in prepared:
+            if not catalog_result.Succeeded:
+                continue
+            table = catalog_result.result.Table
+            if Category.RA.name not in table.colnames or Category.Dec.name not in table.colnames:
+                catalog_result.status = Status_Not_Merged
+                catalog_result.error = f"Result of {db_access.Catalog} has no {Category.RA.name} and {Category.Dec.name} columns"
+                continue
+            tables.append((db_access.Catalog, table, db_access.Epoch))
+        if not tables:
+            raise RequestProcessingError(", ".join(db_access.Catalog for db_access, params, catalog_result in prepared), "",
+                                         "Merge failed", "No catalog result has positions to merge by")
+        return tables
+
+
+# Query parameters for the catalog: the shared Category filters (min_<category>, max_<category>, objectsincircle)
+# are kept only if the catalog has a column for the category in its CategoryInfo, other parameters are kept as they are
+# Returns the parameters and the names of the filters which were dropped
+def TranslateQueryParams(db_access: DBAccessBase, query_params_json):
+    category_info = db_access.CategoryInfo
+    params = {}
+    ignored_filters = []
+    for name, value in query_params_json.items():
+        category = _filterCategory(name)
+        if category is not None and not _supportsCategory(category_info, category):
+            ignored_filters.append(name)
+            continue
+        params[name] = value
+    return params, ignored_filters
+
+
+# Merge result tables of several catalogs into one table by position
+# Rows of every next catalog are matched to the nearest row merged so far within merge_radius, every row is matched at
+# most once and rows without a match are added as new rows. Columns get the catalog name prefix (RA -> gaia_ra),
+# RA and Dec hold the position at the epoch of the first catalog, <catalog>_separation is the distance in degrees of
+# the matched row. Positions of the other catalogs are propagated to that epoch when they have proper motions.
+# tables is a list of (catalog, table, epoch)
+def MergeByPosition(tables, radius=merge_radius):
+    merged = None
+    merged_epoch = None
+    for catalog, table, epoch in tables:
+        if merged is None:
+            merged_epoch = epoch
+        ra, dec = _positions(table, epoch, merged_epoch)
+        columns = _prefixedColumns(table, catalog)
+        if merged is None:
+            merged = Table([ra, dec] + list(columns.values()), names=[Category.RA.name, Category.Dec.name] + list(columns))
+            continue
+
+        index = SpatialIndex(ra, dec, radius)
+        target_index, separation = index.MatchNearest(np.asarray(merged[Category.RA.name]), np.asarray(merged[Category.Dec.name]))
+        row_target = _uniqueMatches(target_index, separation)
+        matched = row_target >= 0
+        rows_index = np.where(matched, row_target, 0)
+        for column_name, column in columns.items():
+            if len(table) > 0:
+                values = column[rows_index]
+                mask = np.ma.getmaskarray(values) | ~matched
+            else:
+                values = np.zeros(len(merged), dtype=column.dtype)
+                mask = np.ones(len(merged), dtype=bool)
+            merged[column_name] = MaskedColumn(np.asarray(values), mask=mask)
+        merged[f"{catalog}_{column_separation}"] = MaskedColumn(np.where(matched, separation, np.nan), mask=~matched, unit=u.deg)
+
+        unmatched = np.setdiff1d(np.arange(len(table)), row_target[matched])
+        if len(unmatched) > 0:
+            rest = Table([ra[unmatched], dec[unmatched]] + [column[unmatched] for column in columns.values()],
+                         names=[Category.RA.name, Category.Dec.name] + list(columns))
+            merged = vstack([merged, rest], join_type="outer", metadata_conflicts="silent")
+    return merged
+
+
+def _timeout(timeouts, catalog):
+    return (timeouts or {}).get(catalog, federated_timeout)
+
+
+# Category of min_<category>, max_<category> or <category> parameter, None for other parameters
+def _filterCategory(name):
+    name = name.lower()
+    for prefix in ("min_", "max_"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+            break
+    for category in Category:
+        if category.name.lower() == name:
+            return category
+    return None
+
+
+# cone search needs position columns, other categories need their own column
+def _supportsCategory(category_info, category):
+    if category == Category.ObjectsInCircle:
+        return (category in category_info and bool(category_info.get(Category.RA, [''])[0]) and
+                bool(category_info.get(Category.Dec, [''])[0]))
+    return bool(category_info.get(category, [''])[0])
+
+
+# positions of the table in degrees at the epoch, propagated with proper motions when the table has them
+def _positions(table, epoch, new_epoch):
+    ra = ColumnFloatValues(table[Category.RA.name], u.deg)
+    dec = ColumnFloatValues(table[Category.Dec.name], u.deg)
+    if (not epoch or not new_epoch or EpochToJulianYear(epoch) == EpochToJulianYear(new_epoch) or
+            Category.PMRA.name not in table.colnames or Category.PMDec.name not in table.colnames):
+        return ra, dec
+
+    parallax = None
+    radial_velocity = None
+    if Category.Parallax.name in table.colnames and Category.RadialVelocity.name in table.colnames:
+        parallax = ColumnFloatValues(table[Category.Parallax.name], u.mas)
+        radial_velocity = ColumnFloatValues(table[Category.RadialVelocity.name], u.km / u.s)
+    return PropagatePositions(ra, dec, ColumnFloatValues(table[Category.PMRA.name], u.mas / u.yr),
+                              ColumnFloatValues(table[Category.PMDec.name], u.mas / u.yr), epoch, new_epoch,
+                              parallax, radial_velocity)
+
+
+# columns of the table with the catalog name prefix, columns already starting with it (gaia_id) keep their names
+def _prefixedColumns(table, catalog):
+    return {(name if name.lower().startswith(catalog + "_") else f"{catalog}_{name.lower()}"): table[name]
+            for name in table.colnames}
+
+
+# target row of every merged row (-1 if none): a target nearest to several merged rows is kept for the closest one
+def _uniqueMatches(target_index, separation):
+    row_target = np.full(len(target_index), -1, dtype=np.int64)
+    matched = np.flatnonzero(target_index >= 0)
+    if len(matched) == 0:
+        return row_target
+    matched = matched[np.argsort(separation[matched], kind="stable")]
+    targets, first = np.unique(target_index[matched], return_index=True)
+    row_target[matched[first]] = targets
+    return row_target
@@ -0,0 +1,92 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+# Default transport settings
+Pool_Size = 10              # keep-alive connections kept per host
+Connect_Timeout = 10        # seconds
+Read_Timeout = 300          # seconds, TAP servers may take long to answer sync queries
+Max_Retries = 3
+Backoff_Factor = 0.5        # seconds, doubled on every retry
+Backoff_Jitter = 0.5        # seconds, random addition to every backoff
+Retry_Status_Codes = (500, 502, 503, 504)
+# requests of these methods are retried on 5xx responses and read errors too; other requests (POST) only when the
+# connection failed, so they were not sent: a repeated POST may create a second TAP job on the server
+Idempotent_Methods = frozenset(Retry.DEFAULT_ALLOWED_METHODS)
+# compressed response encodings urllib3 can decode here (gzip, deflate, and br or zstd when their packages are installed)
+Accept_Encoding = make_headers(accept_encoding=True)["accept-encoding"]
+
+
+# requests session which applies default connect/read timeouts to requests sent without explicit timeout
+class _TimeoutSession(requests.Session):
+    def __init__(self, transport):
+        super().__init__()
+        self._transport = transport
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (self._transport.connect_timeout, self._transport.read_timeout)
+        return super().request(method, url, **kwargs)
+
+
+# Shared HTTP transport for all catalog backends
+# One session keeps a pool of keep-alive connections per host, so TCP and TLS handshakes are done once per connection,
+# not once per request. Connection errors, and 5xx responses of idempotent requests, are retried with jittered
+# exponential backoff.
+class HttpTransport:
+    def __init__(self, pool_size=Pool_Size, connect_timeout=Connect_Timeout, read_timeout=Read_Timeout,
+                 max_retries=Max_Retries, backoff_factor=Backoff_Factor, backoff_jitter=Backoff_Jitter):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+
+        self._session = _TimeoutSession(self)
+        # responses are requested compressed and decoded while they are read, streamed bodies too
+        self._session.headers["Accept-Encoding"] = Accept_Encoding
+        self._mountAdapters()
+
+    # change transport settings, the session object stays the same so services holding it get the new settings
+    def Configure(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise ValueError(f"Unknown transport setting: {name}")
+            setattr(self, name, value)
+        self._mountAdapters()
+
+    # session to pass to clients which send requests themselves (for example, pyvo TAPService)
+    @property
+    def Session(self):
+        return self._session
+
+    def Post(self, url, **kwargs):
+        return self._session.post(url, **kwargs)
+
+    def Get(self, url, **kwargs):
+        return self._session.get(url, **kwargs)
+
+    def _mountAdapters(self):
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            backoff_jitter=self.backoff_jitter,
+            status_forcelist=Retry_Status_Codes,
+            # POST creates TAP jobs, it is retried only on connection errors (connect is counted for every method)
+            allowed_methods=Idempotent_Methods,
+            # the last 5xx response is returned to the caller, so the catalog reports HTTP error as before
+            raise_on_status=False,
+        )
+        # pool_connections is the number of hosts whose pools are kept, pool_maxsize is the pool size of every host
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+
+# Transport shared by all catalog backends and cross matching
+Http_Transport = HttpTransport()
@@ -0,0 +1,123 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Job phases, named as UWS phases used by TAP services
+Phase_Queued = "QUEUED"
+Phase_Executing = "EXECUTING"
+Phase_Completed = "COMPLETED"
+Phase_Error = "ERROR"
+Phase_Aborted = "ABORTED"
+
+Final_Phases = (Phase_Completed, Phase_Error, Phase_Aborted)
+
+
+# Long-running request executed in background, its result is kept until the job expires
+class QueryJob:
+    def __init__(self, job_type, description):
+        self.job_id = uuid.uuid4().hex
+        self.job_type = job_type
+        self.description = description
+        self.phase = Phase_Queued
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.error_status = None
+        # set when the job is cancelled, running job function checks it to stop waiting for the catalog
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def ToDict(self):
+        return {
+            "job_id": self.job_id,
+            "job_type": self.job_type,
+            "description": self.description,
+            "phase": self.phase,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "status": self.error_status,
+            "error": self.error,
+        }
+
+
+# Runs jobs on a bounded pool of background threads, so Flask workers are not blocked by long catalog requests
+class JobManager:
+    def __init__(self, max_workers=8, max_jobs=1000, result_ttl_seconds=3600):
+        self.max_jobs = max_jobs
+        self.result_ttl_seconds = result_ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stellaris-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # submit job_function(cancel_event) for execution, its return value becomes the job result
+    def Submit(self, job_type, description, job_function):
+        job = QueryJob(job_type, description)
+        with self._lock:
+            self._expireJobs()
+            if len(self._jobs) >= self.max_jobs:
+                raise ValueError(f"Too many jobs, at most {self.max_jobs} jobs can be kept at the same time")
+            self._jobs[job.job_id] = job
+        job.future = self._executor.submit(self._runJob, job, job_function)
+        return job
+
+    def Get(self, job_id):
+        with self._lock:
+            self._expireJobs()
+            return self._jobs.get(job_id)
+
+    # cancel queued job or ask running job to stop, finished jobs are not changed
+    def Cancel(self, job_id):
+        job = self.Get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finishJob(job, Phase_Aborted, error_status=Phase_Aborted, error="Job is cancelled")
+        return job
+
+    @property
+    def Stats(self):
+        with self._lock:
+            phases = {}
+            for job in self._jobs.values():
+                phases[job.phase] = phases.get(job.phase, 0) + 1
+            return {"jobs": len(self._jobs), "phases": phases}
+
+    def _runJob(self, job, job_function):
+        if job.cancel_event.is_set():
+            self._finishJob(job, Phase_Aborted, error_status=Phase_Aborted, error="Job is cancelled")
+            return
+        job.phase = Phase_Executing
+        job.started = time.time()
+        try:
+            result = job_function(job.cancel_event)
+        except Exception as e:
+            if job.cancel_event.is_set():
+                self._finishJob(job, Phase_Aborted, error_status=Phase_Aborted, error=str(e))
+            else:
+                self._finishJob(job, Phase_Error, error_status=getattr(e, "status", "System error"), error=str(e))
+            return
+        self._finishJob(job, Phase_Completed, result=result)
+
+    def _finishJob(self, job, phase, result=None, error_status=None, error=None):
+        job.result = result
+        job.error_status = error_status
+        job.error = error
+        job.finished = time.time()
+        job.phase = phase
+
+    # the lock must be held by the caller
+    def _expireJobs(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.phase in Final_Phases and now - job.finished > self.result_ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+# Process-wide job manager used by the /jobs endpoints
+Job_Manager = JobManager()
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+
+from .QueryCache import NormalizeQuery
+
+# Default location of the match store, it is kept between restarts of the API
+Match_Store_Path = os.environ.get("STELLARIS_MATCH_STORE") or os.path.join(os.path.expanduser("~"), ".stellaris", "matches.sqlite3")
+
+# SIMBAD objects are added and corrected slowly, stored matches are requested again after this time
+match_store_ttl = 30 * 24 * 3600
+
+# number of stored sources above which the expired ones are removed when new matches are stored
+match_store_max_sources = 10000000
+# the number of stored sources is checked by a process at most once in this time, counting them reads the whole store
+match_store_prune_seconds = 3600
+
+
+# Persistent store of cross match results per source
+# A source is identified by its catalog and id, its matches by the target catalog, the match radius and the cross
+# match query, so matches of an older query are not reused. For every cross matched source the rows of the target
+# catalog matched to it are stored, an empty list means the source has no match. Cross matching uploads only the
+# sources that are not stored or expired and takes the others from the store. The columns of the cross match result
+# are stored once per query, so stored sources without any match still give a table with all target columns.
+# Every call opens its own SQLite connection, so the store is shared by Flask worker threads and API processes.
+class MatchStore:
+    def __init__(self, path=Match_Store_Path, ttl_seconds=match_store_ttl, max_sources=match_store_max_sources):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_sources = max_sources
+
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._pruned_at = None
+        self._stored_sources = 0
+        self._missing_sources = 0
+
+    # matches of the stored sources as a table like the cross match result and a boolean array of the sources to be
+    # cross matched, source_ids is the id column of the source table
+    # without stored columns of the query (a store written by an older version) all sources are cross matched
+    def Lookup(self, source_catalog, target_catalog, radius, crossmatch_query, source_ids):
+        keys = [_sourceKey(value) for value in np.asarray(source_ids).tolist()]
+        query_key = (source_catalog, target_catalog, float(radius), _queryKey(crossmatch_query))
+        stored = {}
+        columns = []
+        if len(keys) > 0:
+            with self._connect() as connection:
+                schema = connection.execute("SELECT columns FROM schemas WHERE source_catalog = ? AND target_catalog = ? AND radius = ? AND query = ?",
+                                            query_key).fetchone()
+                if schema is not None:
+                    columns = json.loads(schema[0])
+                    connection.execute("CREATE TEMP TABLE lookup (source_id TEXT PRIMARY KEY)")
+                    connection.executemany("INSERT OR IGNORE INTO lookup VALUES (?)", ((key,) for key in keys))
+                    rows = connection.execute(
+                        "SELECT matches.source_id, matches.result FROM matches INNER JOIN lookup ON matches.source_id = lookup.source_id"
+                        " WHERE matches.source_catalog = ? AND matches.target_catalog = ? AND matches.radius = ? AND matches.query = ?"
+                        " AND matches.matched_at >= ?",
+                        query_key + (time.time() - self.ttl_seconds,))
+                    stored = {source_id: json.loads(result) for source_id, result in rows}
+
+        missing = np.array([key not in stored for key in keys], dtype=bool)
+        with self._lock:
+            self._stored_sources += int(len(keys) - missing.sum())
+            self._missing_sources += int(missing.sum())
+
+        # one row per stored match, the source id is taken from the source table to keep its type
+        source_rows = []
+        match_rows = []
+        for row, key in enumerate(keys):
+            for match in stored.get(key, ()):
+                source_rows.append(row)
+                match_rows.append(match)
+        return _matchesTable(source_ids, source_rows, match_rows, columns), missing
+
+    # store matches of the cross matched sources, crossmatch_result has the source id column and target columns
+    # sources without rows in crossmatch_result are stored as having no match
+    def Put(self, source_catalog, target_catalog, radius, crossmatch_query, source_ids, crossmatch_result, column_id):
+        target_columns = [name for name in crossmatch_result.colnames if name != column_id]
+        matches = {_sourceKey(value): [] for value in np.asarray(source_ids).tolist()}
+        if len(crossmatch_result) > 0:
+            column_values = [_jsonValues(crossmatch_result[name]) for name in target_columns]
+            for row, value in enumerate(np.asarray(crossmatch_result[column_id]).tolist()):
+                matches.setdefault(_sourceKey(value), []).append({name: values[row] for name, values in zip(target_columns, column_values)})
+
+        now = time.time()
+        query_key = (source_catalog, target_catalog, float(radius), _queryKey(crossmatch_query))
+        columns = [[name, crossmatch_result[name].dtype.str] for name in target_columns]
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO schemas VALUES (?, ?, ?, ?, ?)", query_key + (json.dumps(columns),))
+            connection.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (query_key + (key, now, json.dumps(result)) for key, result in matches.items()))
+            if self._takePrune():
+                if connection.execute("SELECT COUNT(*) FROM matches").fetchone()[0] > self.max_sources:
+                    connection.execute("DELETE FROM matches WHERE matched_at < ?", (now - self.ttl_seconds,))
+
+    def Clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM matches")
+            connection.execute("DELETE FROM schemas")
+        with self._lock:
+            self._stored_sources = 0
+            self._missing_sources = 0
+
+    @property
+    def Stats(self):
+        try:
+            with self._connect() as connection:
+                sources = connection.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        except sqlite3.Error:
+            sources = 0
+        with self._lock:
+            looked_up = self._stored_sources + self._missing_sources
+            return {
+                "stored_sources": self._stored_sources,
+                "missing_sources": self._missing_sources,
+                "hit_ratio": self._stored_sources / looked_up if looked_up else 0.0,
+                "sources": sources,
+            }
+
+    # the first Put of the process and the Puts after match_store_prune_seconds check the size of the store
+    def _takePrune(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._pruned_at is not None and now - self._pruned_at < match_store_prune_seconds:
+                return False
+            self._pruned_at = now
+            return True
+
+    # connection to the store, the transaction is committed when the block succeeds and the connection is closed
+    @contextmanager
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            if not self._initialized:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS matches (source_catalog TEXT, target_catalog TEXT, radius REAL,"
+                                   " query TEXT, source_id TEXT, matched_at REAL, result TEXT,"
+                                   " PRIMARY KEY (source_catalog, target_catalog, radius, query, source_id))")
+                connection.execute("CREATE TABLE IF NOT EXISTS schemas (source_catalog TEXT, target_catalog TEXT, radius REAL,"
+                                   " query TEXT, columns TEXT, PRIMARY KEY (source_catalog, target_catalog, radius, query))")
+                self._initialized = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+# key of the source in the store, ids of any type are stored as text
+def _sourceKey(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return str(value)
+
+
+# the same cross match query with other whitespace matches the same
+def _queryKey(crossmatch_query):
+    return hashlib.sha256(NormalizeQuery(crossmatch_query).encode("utf-8")).hexdigest()
+
+
+# values of the column for JSON, masked values are None
+def _jsonValues(column):
+    values = np.asarray(column).tolist()
+    mask = np.ma.getmaskarray(column)
+    result = []
+    for value, masked in zip(values, mask):
+        if masked or (isinstance(value, float) and np.isnan(value)):
+            result.append(None)
+        elif isinstance(value, bytes):
+            result.append(value.decode("utf-8"))
+        else:
+            result.append(value)
+    return result
+
+
+# table of the stored matches: source id column followed by the target columns, None values are masked
+# columns are the [name, dtype] pairs of the cross match result, they are in the table even if no source has a match
+def _matchesTable(source_ids, source_rows, match_rows, columns):
+    table = Table()
+    table[source_ids.name] = source_ids[np.asarray(source_rows, dtype=np.int64)]
+    dtypes = dict(columns)
+    names = [name for name, _ in columns]
+    for match in match_rows:
+        names += [name for name in match if name not in names]
+    for name in names:
+        values = [match.get(name) for match in match_rows]
+        present = next((value for value in values if value is not None), None)
+        if present is None:
+            table[name] = MaskedColumn(np.zeros(len(values), dtype=np.dtype(dtypes.get(name, "f8"))), mask=np.ones(len(values), dtype=bool))
+            continue
+        fill = type(present)()
+        table[name] = MaskedColumn([fill if value is None else value for value in values],
+                                   mask=[value is None for value in values])
+    return table
+
+
+# Process-wide match store shared by all cross matches
+Match_Store = MatchStore()
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Default location of the cache files spilled to disk
+Cache_Dir = os.path.join(tempfile.gettempdir(), "stellaris_query_cache")
+# files being written have this suffix until they are complete
+Temporary_Suffix = ".tmp"
+
+
+# queries that differ only in whitespace are the same query
+def NormalizeQuery(query):
+    return re.sub(r"\s+", " ", query).strip()
+
+
+# Cache of catalog query results keyed on catalog name and normalized ADQL query
+# The most recently used results are kept in memory, results evicted from memory are spilled to disk as FITS files
+# The same cache object is shared between all Flask worker threads, the entries in memory are accessed under the lock,
+# the files are read and written outside of it. A file is written under a temporary name and renamed, so readers never
+# see a partly written file. Results being spilled are still served from memory until their file is renamed.
+# Expired results are kept for stale_seconds more, they are served by GetStale when the catalog is not available
+class QueryCache:
+    def __init__(self, max_entries=64, cache_dir=Cache_Dir, ttl_seconds=3600, max_disk_bytes=1024 * 1024 * 1024,
+                 stale_seconds=24 * 3600, max_memory_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self.stale_seconds = stale_seconds
+        self.max_memory_bytes = max_memory_bytes
+
+        self._memory = OrderedDict()  # key -> (time when stored, table, size in bytes)
+        self._memory_bytes = 0
+        self._spilling = {}  # key -> entry evicted from memory and not yet written to disk
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._stale_hits = 0
+
+    # return cached result table for the query or None if it is absent or expired
+    def Get(self, catalog, query):
+        table, source = self._get(self._makeKey(catalog, query), self.ttl_seconds)
+        with self._lock:
+            if source == "memory":
+                self._memory_hits += 1
+            elif source == "disk":
+                self._disk_hits += 1
+            else:
+                self._misses += 1
+        return table
+
+    # cached result table of the query from memory, not counted among hits and misses and the disk is not read
+    # used by lookups which don't request the catalog on a miss (cost estimates)
+    def Peek(self, catalog, query):
+        key = self._makeKey(catalog, query)
+        with self._lock:
+            entry = self._memory.get(key) or self._spilling.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                return None
+            return entry[1].copy(copy_data=False)
+
+    # return cached result table for the query even if it is expired, but no older than TTL and stale_seconds
+    # used only when the catalog does not answer, so it is not counted among hits and misses
+    def GetStale(self, catalog, query):
+        table, source = self._get(self._makeKey(catalog, query), self.ttl_seconds + self.stale_seconds)
+        if table is not None:
+            with self._lock:
+                self._stale_hits += 1
+        return table
+
+    # store result table of the query
+    def Put(self, catalog, query, table):
+        key = self._makeKey(catalog, query)
+        # store a copy so that columns added to the table by the caller don't get into the cache
+        with self._lock:
+            evicted = self._putToMemory(key, table.copy(copy_data=False), time.time())
+        self._spillToDisk(evicted)
+
+    def Clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._spilling.clear()
+        if os.path.isdir(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                self._removeFile(os.path.join(self.cache_dir, file_name))
+
+    @property
+    def Stats(self):
+        disk_files = self._diskFiles()
+        with self._lock:
+            requests_count = self._memory_hits + self._disk_hits + self._misses
+            return {
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "stale_hits": self._stale_hits,
+                "hit_ratio": (self._memory_hits + self._disk_hits) / requests_count if requests_count else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(disk_files),
+                "disk_bytes": sum(size for path, size, mtime in disk_files),
+            }
+
+    @staticmethod
+    def _makeKey(catalog, query):
+        return hashlib.sha256(f"{catalog}\n{NormalizeQuery(query)}".encode("utf-8")).hexdigest()
+
+    # table no older than max_age and where it was found, memory or disk
+    def _get(self, key, max_age):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, table, size = entry
+                age = time.time() - stored_at
+                if age <= max_age:
+                    self._memory.move_to_end(key)
+                    return table.copy(copy_data=False), "memory"
+                if age > self.ttl_seconds + self.stale_seconds:
+                    del self._memory[key]
+                    self._memory_bytes -= size
+                # a result on disk is never newer than the one in memory
+                return None, None
+            entry = self._spilling.get(key)
+            if entry is not None:
+                if time.time() - entry[0] <= max_age:
+                    return entry[1].copy(copy_data=False), "memory"
+                return None, None
+
+        table, stored_at = self._readFromDisk(key, max_age)
+        if table is None:
+            return None, None
+        with self._lock:
+            # a result put while the file was read is newer, it is kept
+            evicted = self._putToMemory(key, table, stored_at) if key not in self._memory else []
+        self._spillToDisk(evicted)
+        return table.copy(copy_data=False), "disk"
+
+    # the lock must be held by the caller, the returned evicted entries are spilled by the caller after releasing it
+    def _putToMemory(self, key, table, stored_at):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= previous[2]
+        size = _tableBytes(table)
+        self._memory[key] = (stored_at, table, size)
+        self._memory_bytes += size
+        evicted = []
+        while len(self._memory) > self.max_entries or (self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1):
+            evicted_key, evicted_entry = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_entry[2]
+            self._spilling[evicted_key] = evicted_entry
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    def _spillToDisk(self, evicted):
+        if not evicted:
+            return
+        for key, entry in evicted:
+            self._writeToDisk(key, entry[1], entry[0])
+            with self._lock:
+                if self._spilling.get(key) is entry:
+                    del self._spilling[key]
+        self._evictFromDisk()
+
+    def _writeToDisk(self, key, table, stored_at):
+        if time.time() - stored_at > self.ttl_seconds + self.stale_seconds:
+            return
+        path = self._diskPath(key)
+        temporary_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            file, temporary_path = tempfile.mkstemp(dir=self.cache_dir, prefix=key, suffix=Temporary_Suffix)
+            os.close(file)
+            table.write(temporary_path, format="fits", overwrite=True)
+            # keep the time when the result was received, TTL is counted from it
+            os.utime(temporary_path, (stored_at, stored_at))
+            os.replace(temporary_path, path)
+        except Exception:
+            # not every table can be written to FITS, such result is just not kept on disk
+            if temporary_path is not None:
+                self._removeFile(temporary_path)
+
+    # table no older than max_age read from its file and the time when it was stored
+    def _readFromDisk(self, key, max_age):
+        path = self._diskPath(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return None, None
+        if age > self.ttl_seconds + self.stale_seconds:
+            self._removeFile(path)
+            return None, None
+        if age > max_age:
+            return None, None
+        # astropy is imported by the first read from disk, the cache itself is created before any table exists
+        from astropy.table import Table
+        try:
+            return Table.read(path, format="fits"), time.time() - age
+        except Exception:
+            return None, None
+
+    # remove files too old to be served stale and then the oldest files until the cache fits into max_disk_bytes
+    def _evictFromDisk(self):
+        now = time.time()
+        files = []
+        for path, size, mtime in self._diskFiles():
+            if now - mtime > self.ttl_seconds + self.stale_seconds:
+                self._removeFile(path)
+            else:
+                files.append((mtime, path, size))
+
+        disk_bytes = sum(size for mtime, path, size in files)
+        for mtime, path, size in sorted(files):
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            self._removeFile(path)
+            disk_bytes -= size
+
+    def _diskFiles(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        files = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".fits"):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                files.append((path, os.path.getsize(path), os.path.getmtime(path)))
+            except OSError:
+                pass
+        return files
+
+    def _diskPath(self, key):
+        return os.path.join(self.cache_dir, key + ".fits")
+
+    @staticmethod
+    def _removeFile(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# approximate size of the table in memory, object columns are counted by their references only
+def _tableBytes(table):
+    return sum(column.nbytes for column in table.itercols())
+
+
+# Process-wide cache shared by all catalogs
+Query_Cache = QueryCache()
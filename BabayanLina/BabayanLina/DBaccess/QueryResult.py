@@ -0,0 +1,67 @@
+import numpy as np
+
+# rows are converted to Python values in blocks of this size, so a large result is never held as Python lists at once
+Row_Block_Size = 10000
+
+
+# Result of a catalog query, wraps astropy table without copying it
+# Rows are produced lazily on iteration, null values (masked or NaN) are found per column with numpy masks only
+# when the result is serialized
+class QueryResult:
+    def __init__(self, table):
+        self._table = table
+
+    @property
+    def Table(self):
+        return self._table
+
+    @property
+    def Columns(self):
+        return self._table.colnames
+
+    def __len__(self):
+        return len(self._table)
+
+    # column as astropy column, no data is copied
+    def __getitem__(self, column_name):
+        return self._table[column_name]
+
+    # iterate rows as dictionaries {column: value}, one row at a time
+    def __iter__(self):
+        columns = self.Columns
+        for row in self._table:
+            yield dict(zip(columns, row))
+
+    # plain numpy data of the column and the mask of null values (masked or NaN)
+    def ColumnValues(self, column_name):
+        column = self._table[column_name]
+        values = np.ma.getdata(column)
+        nulls = np.ma.getmaskarray(column)
+        if values.dtype.kind == "f":
+            nulls = nulls | np.isnan(values)
+        elif values.dtype.kind == "S":
+            values = np.char.decode(values, "utf-8")
+        if nulls.ndim > 1:
+            # a multidimensional value is null only if all its elements are null
+            nulls = nulls.reshape(len(nulls), -1).all(axis=1)
+        return np.asarray(values), nulls
+
+    # column values as Python lists, null values are None since JSON does not recognize NaN
+    def ColumnarData(self):
+        return {column_name: _pythonValues(*self.ColumnValues(column_name)) for column_name in self.Columns}
+
+    # rows as tuples of JSON-ready values in the order of Columns, converted block by block
+    def RowValues(self):
+        columns = [self.ColumnValues(column_name) for column_name in self.Columns]
+        for start in range(0, len(self), Row_Block_Size):
+            stop = start + Row_Block_Size
+            yield from zip(*(_pythonValues(values[start:stop], nulls[start:stop]) for values, nulls in columns))
+
+
+# values as a Python list with None at null positions
+# only null positions are visited in Python, everything else is converted by numpy
+def _pythonValues(values, nulls):
+    values = values.tolist()
+    for index in np.flatnonzero(nulls):
+        values[index] = None
+    return values
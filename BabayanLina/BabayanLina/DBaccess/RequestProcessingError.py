@@ -12,4 +12,17 @@ class CrossMatchRequestProcessingError(Exception):
         self.query = query
         self.catalog_to_match = catalog_to_match
         self.crossmatch_query = crossmatch_query
-        self.status = status
\ No newline at end of file
+        self.status = status
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, status: str, message: str, retry_after: float):
+        super().__init__(message)
+        self.status = status
+        # seconds after which the request may be admitted
+        self.retry_after = retry_after
+
+class UpstreamUnavailableError(RequestProcessingError):
+    def __init__(self, catalog: str, query: str, status: str, message: str, retry_after: float):
+        super().__init__(catalog, query, status, message)
+        # seconds after which the catalog is requested again
+        self.retry_after = retry_after
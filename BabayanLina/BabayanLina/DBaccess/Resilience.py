@@ -0,0 +1,399 @@
+import asyncio
+import contextvars
+import math
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .RequestProcessingError import UpstreamUnavailableError
+from .AdmissionControl import Admission_Control
+
+# catalogs requested by the API, their state is shown even before the first request
+Upstream_Catalogs = ("gaia", "simbad")
+
+# latencies and outcomes of the requests to a catalog are kept for this time, but no more than latency_window_size
+latency_window_seconds = 300
+latency_window_size = 200
+
+# a sync request not answered within the p95 latency of its catalog is sent again (hedged), the first answer is taken
+# the catalog needs hedge_min_samples latencies in the window before requests are hedged, the delay is clamped
+hedge_min_samples = 20
+hedge_min_delay = 0.5
+hedge_max_delay = 30
+# at most this share of the requests in the window are hedged, so a slow catalog doesn't get twice the requests
+hedge_budget = 0.1
+# sync requests not answered in this time fail, the HTTP transport alone waits up to its read timeout on every retry
+call_timeout_seconds = 180
+
+# the circuit breaker of a catalog opens when this share of the requests in the window failed, requests fail fast
+# while it is open, then one probe request is let through (half open) and its outcome closes or opens the breaker again
+breaker_min_requests = 10
+breaker_error_rate = 0.5
+breaker_open_seconds = 30
+
+State_Closed = "closed"
+State_Half_Open = "half_open"
+State_Open = "open"
+States = [State_Closed, State_Half_Open, State_Open]
+
+Status_Upstream_Unavailable = "Catalog unavailable"
+Status_Upstream_Timeout = "Catalog request timed out"
+
+_http_error = re.compile(r"HTTP error (\d{3})")
+
+
+# errors of the query itself (HTTP 4xx responses other than 429) don't mean the catalog is failing
+def IsUpstreamFailure(error):
+    match = _http_error.search(str(error))
+    if match is None:
+        return True
+    code = int(match.group(1))
+    return code >= 500 or code == 429
+
+
+# Latencies, outcomes and circuit breaker state of the requests to one catalog
+class UpstreamHealth:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.state = State_Closed
+        # breaker opened over the admin endpoint stays open until it is closed there
+        self.forced = False
+        self.opened_at = 0.0
+        self.probing = False
+        self.outcomes = deque(maxlen=latency_window_size)  # (time, seconds or None, failed)
+        self.hedge_times = deque()
+        self.counters = {"requests": 0, "failures": 0, "timeouts": 0, "hedges": 0, "hedge_wins": 0,
+                         "rejected": 0, "stale_served": 0, "opened": 0}
+
+    # outcomes of the last latency_window_seconds
+    def Recent(self, now):
+        while self.outcomes and now - self.outcomes[0][0] > latency_window_seconds:
+            self.outcomes.popleft()
+        while self.hedge_times and now - self.hedge_times[0] > latency_window_seconds:
+            self.hedge_times.popleft()
+        return list(self.outcomes)
+
+    def Latencies(self, now):
+        return sorted(seconds for at, seconds, failed in self.Recent(now) if seconds is not None and not failed)
+
+    def ErrorRate(self, now):
+        recent = self.Recent(now)
+        return sum(failed for at, seconds, failed in recent) / len(recent) if recent else 0.0
+
+
+# Resilience of the requests to the catalogs: rolling latency percentiles, hedged sync requests and a circuit breaker
+# per catalog. Sync requests run in threads of the executor, so a second request can be sent while the first one is
+# still waiting, and the caller stops waiting at call_timeout_seconds. Requests abandoned by the caller (the slower
+# hedge, timed out requests) finish in their thread, their result is dropped. Background jobs and SIMBAD shard jobs
+# are not hedged and have no timeout, only their failures are counted, their latency is not a sync latency.
+# Every request sent holds its own Admission_Control slot of the catalog until it finishes, abandoned ones too, so
+# hedges and timed out requests never take the catalog above its limit; a hedge is sent only if a slot is free.
+class Resilience:
+    def __init__(self, catalogs=Upstream_Catalogs, max_workers=64):
+        self.call_timeout_seconds = call_timeout_seconds
+        self._lock = threading.Lock()
+        self._health = {catalog: UpstreamHealth(catalog) for catalog in catalogs}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stellaris-upstream")
+
+    # result of request() sent to the catalog, request must raise on failure
+    # raises UpstreamUnavailableError without calling request() while the breaker of the catalog is open
+    # the request waits for a slot of the catalog, big requests (background jobs) may not take the reserved slots
+    def Call(self, catalog, query, request, hedge=True, big=False):
+        health, probe, delay = self._admit(catalog, query, hedge)
+        self._acquire(health, probe, lambda: Admission_Control.AcquireUpstream(catalog, big))
+        if not hedge:
+            try:
+                return self._callInline(health, probe, request)
+            finally:
+                Admission_Control.ReleaseUpstream(catalog)
+
+        started = time.monotonic()
+        deadline = started + self.call_timeout_seconds
+        hedge_at = started + delay if delay is not None else None
+        attempts = {self._submit(catalog, request): started}
+        error = None
+        try:
+            while attempts:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, pending = wait(attempts, timeout=max(0.0, wake_at - time.monotonic()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    attempt_started = attempts.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self._record(health, probe, False, time.monotonic() - attempt_started, hedge_won=attempt_started > started)
+                    return result
+                now = time.monotonic()
+                if attempts and now >= deadline:
+                    raise self._timeout(health, probe, query)
+                if attempts and hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self._takeHedge(health):
+                        attempts[self._submit(catalog, request)] = now
+        except BaseException:
+            if probe and health.probing:
+                self._record(health, probe, True)
+            raise
+        self._record(health, probe, IsUpstreamFailure(error))
+        raise error
+
+    # asyncio version of Call, request() returns a new coroutine every call, the slower hedge is cancelled
+    async def CallAsync(self, catalog, query, request, hedge=True, big=False):
+        health, probe, delay = self._admit(catalog, query, hedge)
+        try:
+            await Admission_Control.AcquireUpstreamAsync(catalog, big)
+        except BaseException:
+            self._cancelProbe(health, probe)
+            raise
+        started = time.monotonic()
+        deadline = started + self.call_timeout_seconds if hedge else None
+        hedge_at = started + delay if delay is not None else None
+        attempts = {self._startAsync(catalog, request): started}
+        error = None
+        try:
+            while attempts:
+                wake_at = min(at for at in (deadline, hedge_at) if at is not None) if deadline is not None else None
+                timeout = max(0.0, wake_at - time.monotonic()) if wake_at is not None else None
+                done, pending = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt_started = attempts.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    seconds = time.monotonic() - attempt_started if hedge else None
+                    self._record(health, probe, False, seconds, hedge_won=attempt_started > started)
+                    return task.result()
+                now = time.monotonic()
+                if attempts and deadline is not None and now >= deadline:
+                    raise self._timeout(health, probe, query)
+                if attempts and hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self._takeHedge(health):
+                        attempts[self._startAsync(catalog, request)] = now
+        except BaseException:
+            if probe and health.probing:
+                self._record(health, probe, True)
+            raise
+        finally:
+            for task in attempts:
+                task.cancel()
+        self._record(health, probe, IsUpstreamFailure(error))
+        raise error
+
+    # count a request answered from stale cache entries because the catalog failed
+    def RecordStale(self, catalog):
+        with self._lock:
+            self._healthOf(catalog).counters["stale_served"] += 1
+
+    # force the breaker of the catalog open (kept open until closed again) or closed (its window is cleared)
+    def SetState(self, catalog, state):
+        if catalog not in self._health:
+            raise ValueError(f"Unknown catalog: {catalog}. Catalogs: {', '.join(self._health)}")
+        if state not in (State_Open, State_Closed):
+            raise ValueError(f"Invalid breaker state: {state}. The state may be set to {State_Open} or {State_Closed}")
+        with self._lock:
+            health = self._health[catalog]
+            if state == State_Open:
+                self._open(health, time.monotonic())
+                health.forced = True
+            else:
+                health.state = State_Closed
+                health.forced = False
+                health.probing = False
+                health.outcomes.clear()
+
+    # state of the catalog shown by the admin endpoint
+    def StatusOf(self, catalog):
+        status = self.Status.get(catalog)
+        if status is None:
+            raise ValueError(f"Unknown catalog: {catalog}. Catalogs: {', '.join(self.Status)}")
+        return status
+
+    # state of every catalog shown by the admin endpoint
+    @property
+    def Status(self):
+        now = time.monotonic()
+        with self._lock:
+            status = {}
+            for catalog, health in self._health.items():
+                latencies = health.Latencies(now)
+                delay = self._hedgeDelay(latencies)
+                status[catalog] = {
+                    "state": self._state(health, now),
+                    "forced": health.forced,
+                    "seconds_until_probe": max(0.0, health.opened_at + breaker_open_seconds - now)
+                    if health.state == State_Open and not health.forced else None,
+                    "window_requests": len(health.outcomes),
+                    "error_rate": health.ErrorRate(now),
+                    "p50_seconds": _percentile(latencies, 0.5),
+                    "p95_seconds": _percentile(latencies, 0.95),
+                    "p99_seconds": _percentile(latencies, 0.99),
+                    "hedge_delay_seconds": delay,
+                    **health.counters,
+                }
+            return status
+
+    # flat statistics for /metrics, the state is 0 closed, 1 half open, 2 open
+    @property
+    def Stats(self):
+        stats = {}
+        for catalog, status in self.Status.items():
+            stats[f"{catalog}_state"] = States.index(status["state"])
+            for name in ("error_rate", "p50_seconds", "p95_seconds"):
+                stats[f"{catalog}_{name}"] = status[name] or 0.0
+            for name in ("requests", "failures", "timeouts", "hedges", "hedge_wins", "rejected", "stale_served", "opened"):
+                stats[f"{catalog}_{name}"] = status[name]
+        return stats
+
+    # health of the catalog, whether the request is the probe of a half open breaker, and the hedge delay or None
+    def _admit(self, catalog, query, hedge):
+        now = time.monotonic()
+        with self._lock:
+            health = self._healthOf(catalog)
+            health.state = self._state(health, now)
+            if health.state == State_Open or (health.state == State_Half_Open and health.probing):
+                health.counters["rejected"] += 1
+                retry_after = health.opened_at + breaker_open_seconds - now if health.state == State_Open and not health.forced else breaker_open_seconds
+                raise UpstreamUnavailableError(catalog, query, Status_Upstream_Unavailable,
+                                               f"Requests to {catalog} are failing, the catalog is not requested for {max(1, round(retry_after))} seconds",
+                                               max(1.0, retry_after))
+            health.counters["requests"] += 1
+            probe = health.state == State_Half_Open
+            if probe:
+                health.probing = True
+            delay = self._hedgeDelay(health.Latencies(now)) if hedge and not probe else None
+            return health, probe, delay
+
+    # slot of the first request, a request rejected by admission control is not the probe of a half open breaker
+    def _acquire(self, health, probe, acquire):
+        try:
+            acquire()
+        except BaseException:
+            self._cancelProbe(health, probe)
+            raise
+
+    def _cancelProbe(self, health, probe):
+        if probe:
+            with self._lock:
+                health.probing = False
+
+    # request sent in a thread of the executor in the context of the caller, so its stages are added to the timings of
+    # the request; the slot taken for it is released when it finishes, even if the caller stopped waiting
+    def _submit(self, catalog, request):
+        context = contextvars.copy_context()
+
+        def attempt():
+            try:
+                return context.run(request)
+            finally:
+                Admission_Control.ReleaseUpstream(catalog)
+        try:
+            return self._executor.submit(attempt)
+        except BaseException:
+            Admission_Control.ReleaseUpstream(catalog)
+            raise
+
+    # asyncio version of _submit, a cancelled request releases its slot when the cancellation reaches it
+    def _startAsync(self, catalog, request):
+        async def attempt():
+            try:
+                return await request()
+            finally:
+                Admission_Control.ReleaseUpstream(catalog)
+        return asyncio.ensure_future(attempt())
+
+    def _callInline(self, health, probe, request):
+        try:
+            result = request()
+        except Exception as e:
+            self._record(health, probe, IsUpstreamFailure(e))
+            raise
+        except BaseException:
+            if probe:
+                self._record(health, probe, True)
+            raise
+        self._record(health, probe, False)
+        return result
+
+    # a hedge within the budget of the catalog and with a free slot of the catalog, the slot is taken for it
+    def _takeHedge(self, health):
+        now = time.monotonic()
+        with self._lock:
+            if len(health.hedge_times) + 1 > max(1.0, hedge_budget * len(health.Recent(now))):
+                return False
+            if not Admission_Control.TryUpstream(health.catalog):
+                return False
+            health.hedge_times.append(now)
+            health.counters["hedges"] += 1
+            return True
+
+    def _timeout(self, health, probe, query):
+        with self._lock:
+            health.counters["timeouts"] += 1
+        self._record(health, probe, True)
+        return UpstreamUnavailableError(health.catalog, query, Status_Upstream_Timeout,
+                                        f"{health.catalog} did not answer in {self.call_timeout_seconds} seconds", breaker_open_seconds)
+
+    # outcome of a request, seconds is its latency or None if it is not a sync latency
+    def _record(self, health, probe, failed, seconds=None, hedge_won=False):
+        now = time.monotonic()
+        with self._lock:
+            health.outcomes.append((now, seconds, failed))
+            if failed:
+                health.counters["failures"] += 1
+            if hedge_won:
+                health.counters["hedge_wins"] += 1
+            if probe:
+                health.probing = False
+                if health.state != State_Half_Open:
+                    return
+                if failed:
+                    self._open(health, now)
+                else:
+                    health.state = State_Closed
+                    health.outcomes.clear()
+            elif failed and health.state == State_Closed:
+                recent = health.Recent(now)
+                if len(recent) >= breaker_min_requests and health.ErrorRate(now) >= breaker_error_rate:
+                    self._open(health, now)
+
+    # the lock must be held by the caller of the methods below
+    def _healthOf(self, catalog):
+        health = self._health.get(catalog)
+        if health is None:
+            health = self._health[catalog] = UpstreamHealth(catalog)
+        return health
+
+    # open breaker is half open when breaker_open_seconds passed, unless it was opened over the admin endpoint
+    @staticmethod
+    def _state(health, now):
+        if health.state == State_Open and not health.forced and now - health.opened_at >= breaker_open_seconds:
+            return State_Half_Open
+        return health.state
+
+    @staticmethod
+    def _open(health, now):
+        health.state = State_Open
+        health.opened_at = now
+        health.counters["opened"] += 1
+
+    @staticmethod
+    def _hedgeDelay(latencies):
+        if len(latencies) < hedge_min_samples:
+            return None
+        return min(hedge_max_delay, max(hedge_min_delay, _percentile(latencies, 0.95)))
+
+
+# nearest rank percentile of sorted values, None if there are no values
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+# Process-wide resilience layer shared by all catalogs
+Upstream_Resilience = Resilience()
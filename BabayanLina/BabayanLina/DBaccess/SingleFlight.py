@@ -0,0 +1,128 @@
+import asyncio
+import threading
+
+
+# One in-flight request shared by the leader, which executes it, and followers, which wait for its result
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+# Coalescing of identical concurrent requests: the first caller with a key executes the function, callers with the
+# same key arriving while it runs wait and get the same result. If the leader fails, all its followers get its error.
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._leaders_count = 0
+        self._followers_count = 0
+        self._failed_count = 0
+
+    def Do(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self._leaders_count += 1
+            else:
+                flight.followers += 1
+                self._followers_count += 1
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except BaseException as e:
+            # followers get any error of the leader, they must not take the missing result for a success
+            flight.error = e
+            with self._lock:
+                self._failed_count += 1
+            raise
+        finally:
+            # new callers start a new request from now on, the waiting followers are released
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    @property
+    def Stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "followers_waiting": sum(flight.followers for flight in self._flights.values()),
+                "leaders_total": self._leaders_count,
+                "followers_total": self._followers_count,
+                "failed_total": self._failed_count,
+            }
+
+
+# One in-flight coroutine of AsyncSingleFlight and the number of callers awaiting it
+class _AsyncFlight:
+    def __init__(self, task):
+        self.task = task
+        self.followers = 0
+        self.waiters = 1
+
+
+# SingleFlight for asyncio tasks of one event loop: the leader's coroutine runs as a separate task and every caller,
+# the leader too, awaits it. A caller which is cancelled (its client disconnected) stops waiting, the request goes on
+# for the others; when the last caller is cancelled, the task is cancelled too, so its catalog jobs are aborted.
+class AsyncSingleFlight:
+    def __init__(self):
+        self._flights = {}  # key -> _AsyncFlight
+        self._leaders_count = 0
+        self._followers_count = 0
+        self._failed_count = 0
+
+    async def Do(self, key, coroutine_function):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _AsyncFlight(asyncio.ensure_future(coroutine_function()))
+            self._leaders_count += 1
+            flight.task.add_done_callback(lambda done: self._finish(key, flight))
+        else:
+            flight.followers += 1
+            flight.waiters += 1
+            self._followers_count += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # nobody waits for the result, new callers start a new request
+                self._finish(key, flight)
+                flight.task.cancel()
+            raise
+
+    def _finish(self, key, flight):
+        # new callers start a new request from now on
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+            if flight.task.cancelled() or not flight.task.done() or flight.task.exception() is not None:
+                self._failed_count += 1
+
+    @property
+    def Stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "followers_waiting": sum(flight.followers for flight in self._flights.values()),
+            "leaders_total": self._leaders_count,
+            "followers_total": self._followers_count,
+            "failed_total": self._failed_count,
+        }
+
+
+# Process-wide coalescing of catalog requests and cross matches
+Single_Flight = SingleFlight()
+# the same for requests of the asyncio serving mode
+Async_Single_Flight = AsyncSingleFlight()
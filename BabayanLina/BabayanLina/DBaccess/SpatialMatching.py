@@ -0,0 +1,150 @@
+import numpy as np
+
+# Number of source rows matched at once, it bounds the memory used by candidate pairs
+Block_Size = 65536
+
+
+# Spatial index of target positions for vectorized cross matching within a fixed radius
+# Targets are split into declination zones of the radius height and sorted by RA inside every zone, so candidates of
+# a source are in its own and two neighbour zones inside RA window widened by 1/cos(dec). Candidates are checked with
+# exact angular distance computed from unit vectors.
+class SpatialIndex:
+    # ra, dec and radius are in degrees
+    def __init__(self, ra, dec, radius):
+        ra = np.asarray(ra, dtype=np.float64) % 360.0
+        dec = np.asarray(dec, dtype=np.float64)
+        self.radius = float(radius)
+        self._zone_height = self.radius
+
+        # rows with undefined position can't be matched
+        target_index = np.nonzero(np.isfinite(ra) & np.isfinite(dec))[0]
+        zones = self._zone(dec[target_index])
+        order = np.lexsort((ra[target_index], zones))
+
+        self._target_index = target_index[order]
+        self._ra = ra[self._target_index]
+        self._vectors = _unitVectors(self._ra, dec[self._target_index])
+        self._zone_ids, self._zone_starts, zone_counts = np.unique(zones[order], return_index=True, return_counts=True)
+        self._zone_ends = self._zone_starts + zone_counts
+
+    # return all targets within the radius: source index, target index and separation in degrees,
+    # pairs are ordered by source index and then by separation
+    def MatchWithinRadius(self, ra, dec, block_size=Block_Size):
+        ra = np.asarray(ra, dtype=np.float64) % 360.0
+        dec = np.asarray(dec, dtype=np.float64)
+        valid_index = np.nonzero(np.isfinite(ra) & np.isfinite(dec))[0]
+
+        source_parts, target_parts, separation_parts = [], [], []
+        for block_start in range(0, len(valid_index), block_size):
+            source_index = valid_index[block_start:block_start + block_size]
+            source, target, separation = self._matchBlock(source_index, ra[source_index], dec[source_index])
+            source_parts.append(source)
+            target_parts.append(target)
+            separation_parts.append(separation)
+
+        if not source_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        source = np.concatenate(source_parts)
+        target = np.concatenate(target_parts)
+        separation = np.concatenate(separation_parts)
+        order = np.lexsort((separation, source))
+        return source[order], target[order], separation[order]
+
+    # return the nearest target within the radius for every source: target index (-1 if there is no match)
+    # and separation in degrees (NaN if there is no match)
+    def MatchNearest(self, ra, dec, block_size=Block_Size):
+        source_count = len(ra)
+        target_index = np.full(source_count, -1, dtype=np.int64)
+        separation = np.full(source_count, np.nan, dtype=np.float64)
+
+        source, target, pair_separation = self.MatchWithinRadius(ra, dec, block_size)
+        if len(source) > 0:
+            # pairs are ordered by source and separation, so the first pair of every source is the nearest one
+            first = np.ones(len(source), dtype=bool)
+            first[1:] = source[1:] != source[:-1]
+            target_index[source[first]] = target[first]
+            separation[source[first]] = pair_separation[first]
+        return target_index, separation
+
+    def _zone(self, dec):
+        return np.floor((dec + 90.0) / self._zone_height).astype(np.int64)
+
+    def _matchBlock(self, source_index, ra, dec):
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        if len(self._target_index) == 0 or len(source_index) == 0:
+            return empty
+
+        # half width of RA window, it covers the whole circle near the poles
+        max_abs_dec = np.minimum(np.abs(dec) + self.radius, 90.0)
+        sin_radius = np.sin(np.radians(self.radius))
+        cos_dec = np.cos(np.radians(max_abs_dec))
+        full_circle = cos_dec <= sin_radius
+        delta_ra = np.degrees(np.arcsin(np.clip(sin_radius / np.where(full_circle, 1.0, cos_dec), 0.0, 1.0)))
+        ra_low = np.where(full_circle, 0.0, ra - delta_ra)
+        ra_high = np.where(full_circle, 360.0, ra + delta_ra)
+
+        # RA window crossing 0/360 is split into the main part and the wrapped part
+        windows = [
+            (np.maximum(ra_low, 0.0), np.minimum(ra_high, 360.0)),
+            (np.where(ra_low < 0.0, ra_low + 360.0, 360.0), np.full(len(ra), 360.0)),
+            (np.zeros(len(ra)), np.where(ra_high > 360.0, ra_high - 360.0, -1.0)),
+        ]
+
+        source_zones = self._zone(dec)
+        pair_sources, pair_positions = [], []
+        for zone_offset in (-1, 0, 1):
+            zone_starts, zone_ends = self._zoneRange(source_zones + zone_offset)
+            for window_low, window_high in windows:
+                starts = _bisect(self._ra, zone_starts, zone_ends, window_low, right=False)
+                ends = _bisect(self._ra, zone_starts, zone_ends, window_high, right=True)
+                counts = np.maximum(ends - starts, 0)
+                total = counts.sum()
+                if total == 0:
+                    continue
+                # expand [start, end) ranges into candidate pairs
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                pair_sources.append(np.repeat(np.arange(len(source_index)), counts))
+                pair_positions.append(np.repeat(starts, counts) + offsets)
+
+        if not pair_sources:
+            return empty
+        pair_sources = np.concatenate(pair_sources)
+        pair_positions = np.concatenate(pair_positions)
+
+        # exact separation from chord length between unit vectors
+        source_vectors = _unitVectors(ra, dec)
+        chord = np.linalg.norm(source_vectors[pair_sources] - self._vectors[pair_positions], axis=1)
+        separation = np.degrees(2.0 * np.arcsin(np.minimum(chord / 2.0, 1.0)))
+        within = separation <= self.radius
+        return source_index[pair_sources[within]], self._target_index[pair_positions[within]], separation[within]
+
+    # [start, end) range of sorted targets for every zone, empty range for zones without targets
+    def _zoneRange(self, zones):
+        position = np.searchsorted(self._zone_ids, zones)
+        position = np.minimum(position, len(self._zone_ids) - 1)
+        exists = self._zone_ids[position] == zones
+        return np.where(exists, self._zone_starts[position], 0), np.where(exists, self._zone_ends[position], 0)
+
+
+def _unitVectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+# vectorized binary search of x in sorted_values[start:end] for every (start, end, x)
+# returns the first position with value >= x, or with value > x if right is True
+def _bisect(sorted_values, starts, ends, x, right):
+    low = starts.copy()
+    high = ends.copy()
+    last = len(sorted_values) - 1
+    while True:
+        active = low < high
+        if not active.any():
+            return low
+        middle = (low + high) // 2
+        values = sorted_values[np.minimum(middle, last)]
+        go_right = active & ((values <= x) if right else (values < x))
+        low = np.where(go_right, middle + 1, low)
+        high = np.where(active & ~go_right, middle, high)
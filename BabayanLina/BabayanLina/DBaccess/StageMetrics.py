@@ -0,0 +1,196 @@
+import bisect
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+
+# Prometheus histogram buckets: stage duration in seconds, rows and bytes produced by a stage
+Seconds_Buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+Rows_Buckets = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+Bytes_Buckets = (1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000)
+
+# stages of the request being processed in the current thread (or asyncio task), None outside of requests
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+# Prometheus histogram with labels, thread safe
+class Histogram:
+    def __init__(self, name, description, buckets, label_names):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def Observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            # counts are stored per bucket and accumulated when rendered
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    # lines of Prometheus text exposition format
+    def Render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in series_items:
+            label_text = ",".join(f'{name}="{_escapeLabel(value)}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {series[-1]}")
+        return lines
+
+
+# Stages of one request: total duration, number of calls, rows and bytes of every stage in the order they started
+class RequestTimings:
+    def __init__(self):
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def Add(self, stage, seconds, rows=None, size=None):
+        with self._lock:
+            totals = self._stages.setdefault(stage, {"seconds": 0.0, "calls": 0, "rows": None, "bytes": None})
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+            if rows is not None:
+                totals["rows"] = (totals["rows"] or 0) + rows
+            if size is not None:
+                totals["bytes"] = (totals["bytes"] or 0) + size
+
+    @property
+    def Stages(self):
+        with self._lock:
+            return OrderedDict((stage, dict(totals)) for stage, totals in self._stages.items())
+
+    # value of Server-Timing header: stage;dur=milliseconds;desc="rows, bytes, calls"
+    # stages running concurrently (SIMBAD shards) are summed, so their duration may exceed the request duration
+    def ServerTiming(self, total_seconds=None):
+        entries = []
+        for stage, totals in self.Stages.items():
+            details = []
+            if totals["rows"] is not None:
+                details.append(f"{totals['rows']} rows")
+            if totals["bytes"] is not None:
+                details.append(f"{totals['bytes']} bytes")
+            if totals["calls"] > 1:
+                details.append(f"{totals['calls']} calls")
+            entry = f"{stage};dur={totals['seconds'] * 1000:.1f}"
+            if details:
+                entry += f';desc="{", ".join(details)}"'
+            entries.append(entry)
+        if total_seconds is not None:
+            entries.append(f"total;dur={total_seconds * 1000:.1f}")
+        return ", ".join(entries)
+
+
+# Timer of one stage, rows and bytes are set inside the with block when they are known
+#   with Stage_Metrics.Stage("votable_parse") as stage:
+#       table = ...
+#       stage.Rows = len(table)
+class StageTimer:
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self.Name = name
+        self.Rows = None
+        self.Bytes = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.Record(self.Name, time.perf_counter() - self._start, self.Rows, self.Bytes)
+        return False
+
+
+# Process-wide stage metrics: histograms for /metrics and timings of the current request for Server-Timing header
+class StageMetrics:
+    def __init__(self):
+        self._stage_seconds = Histogram("stellaris_stage_seconds", "Duration of request processing stages",
+                                        Seconds_Buckets, ("stage",))
+        self._stage_rows = Histogram("stellaris_stage_rows", "Rows produced by request processing stages",
+                                     Rows_Buckets, ("stage",))
+        self._stage_bytes = Histogram("stellaris_stage_bytes", "Bytes received or produced by request processing stages",
+                                      Bytes_Buckets, ("stage",))
+        self._request_seconds = Histogram("stellaris_request_seconds", "Duration of API requests until the response starts",
+                                          Seconds_Buckets, ("endpoint", "status"))
+
+    def Stage(self, name):
+        return StageTimer(self, name)
+
+    def Record(self, stage, seconds, rows=None, size=None):
+        self._stage_seconds.Observe((stage,), seconds)
+        if rows is not None:
+            self._stage_rows.Observe((stage,), rows)
+        if size is not None:
+            self._stage_bytes.Observe((stage,), size)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.Add(stage, seconds, rows, size)
+
+    # time spent producing items of a response body generator, the time the server spends sending them is excluded
+    def TimedIterator(self, stage, iterable):
+        seconds = 0.0
+        size = 0
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds += time.perf_counter() - start
+                break
+            seconds += time.perf_counter() - start
+            size += len(item)
+            yield item
+        self.Record(stage, seconds, None, size)
+
+    # start collecting stages of a new request in the current context
+    def StartRequest(self):
+        timings = RequestTimings()
+        _request_timings.set(timings)
+        return timings
+
+    @property
+    def CurrentRequest(self):
+        return _request_timings.get()
+
+    def ObserveRequest(self, endpoint, status, seconds):
+        self._request_seconds.Observe((endpoint, str(status)), seconds)
+
+    # all histograms in Prometheus text exposition format
+    def Render(self):
+        lines = []
+        for histogram in (self._request_seconds, self._stage_seconds, self._stage_rows, self._stage_bytes):
+            lines.extend(histogram.Render())
+        return "\n".join(lines) + "\n"
+
+
+# numeric values of a stats dictionary as Prometheus gauges prefix_key
+def RenderGauges(prefix, stats, description):
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = f"{prefix}_{key}"
+            lines.extend([f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide metrics shared by catalogs, cross matching and API
+Stage_Metrics = StageMetrics()
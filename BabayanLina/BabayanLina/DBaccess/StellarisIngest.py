@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+import sys
+
+from astropy.table import Table
+
+# Add the root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DBaccess.DBAccessGaia import DBAccessGaia
+from DBaccess.DBAccessSimbad import DBAccessSimbad
+from DBaccess.StellarisStore import StellarisStore, Store_Dir
+
+Source_Catalogs = {"gaia": DBAccessGaia(), "simbad": DBAccessSimbad()}
+
+
+# Ingest catalog extracts into the local catalog served as db_name "stellaris"
+#   python DBaccess/StellarisIngest.py --db gaia --query-params '{"object_types": "Star", "min_parallax": 5, "limit": 1000000}'
+#   python DBaccess/StellarisIngest.py --file extract.vot --catalog gaia --object-type Star
+# Extracts are requested with the same query parameters as /processQuery. Files are any table astropy reads (VOTable,
+# FITS, ...) with the source id in the first column and columns named as Category (RA, Dec, Parallax, ...).
+def main():
+    parser = argparse.ArgumentParser(description="Ingest Gaia or SIMBAD extracts into the local Stellaris catalog")
+    parser.add_argument("--db", choices=sorted(Source_Catalogs), help="catalog to request the extract from")
+    parser.add_argument("--query-params", help="query parameters of the extract as JSON, limit is required")
+    parser.add_argument("--file", help="extract file to ingest instead of requesting a catalog")
+    parser.add_argument("--catalog", help="source catalog of the file (gaia, simbad, ...)")
+    parser.add_argument("--epoch", help="epoch of positions in the file, J2015.5 for example")
+    parser.add_argument("--object-type", default="", help="object type of the file rows: Star, Galaxy or Quasar")
+    parser.add_argument("--store", default=Store_Dir, help=f"directory of the local catalog, {Store_Dir} by default")
+    args = parser.parse_args()
+
+    store = StellarisStore(args.store)
+    if args.file:
+        if not args.catalog:
+            parser.error("--catalog is required with --file")
+        table = Table.read(args.file)
+        stats = store.Ingest(table, args.catalog, args.object_type, args.epoch)
+    elif args.db and args.query_params:
+        query_params_json = json.loads(args.query_params)
+        db_access = Source_Catalogs[args.db]
+        catalog, query, result = db_access.QueryCatalog(query_params_json, query_params_json.get("limit"), None)
+        print(f"{len(result)} rows from {catalog}: {query}")
+        stats = store.Ingest(result.Table, catalog, query_params_json.get("object_types", ""), db_access.Epoch)
+    else:
+        parser.error("either --db with --query-params or --file is required")
+
+    print(f"ingested {stats['rows_ingested']} rows ({stats['rows_replaced']} replaced), {stats['rows']} rows in {args.store}")
+
+
+if __name__ == '__main__':
+    main()
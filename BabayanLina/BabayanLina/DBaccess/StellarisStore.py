@@ -0,0 +1,466 @@
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from .DBAccessEnums import Category, ObjectTypes
+from .ConeTileCache import AngToPixNest, ConePixels, AngularDistance, PixelSize, Max_Order
+from .EpochPropagation import PropagatePositions, EpochToJulianYear
+from .CrossMatching import ColumnFloatValues
+
+# Default location of the local catalog, STELLARIS_STORE_DIR overrides it
+Store_Dir = os.environ.get("STELLARIS_STORE_DIR") or os.path.join(os.path.expanduser("~"), ".stellaris", "catalog")
+
+# rows are ordered by HEALPix index of this order (nested scheme, about 0.014 degrees), as Gaia orders source_id
+Index_Order = Max_Order
+# positions of ingested rows are propagated to this epoch
+Store_Epoch = "J2015.5"
+
+# rows are filtered in blocks of this size, a query with limit stops at the first blocks which fill it
+Query_Block_Size = 65536
+# cones of this radius (degrees) or larger cover the whole sky
+Full_Sky_Radius = 180.0
+# versions kept by ingestion, the current one and the ones before it: a process which read CURRENT just before an
+# ingest still opens the version it read
+Kept_Versions = 2
+# directories of versions are named by uuid4().hex, other directories in the store directory are not touched
+Version_Name = re.compile(r"[0-9a-f]{32}")
+
+Column_Id = "stellaris_id"
+Column_Healpix = "healpix"
+Column_Object_Type = "ObjectType"
+Column_Source_Catalog = "SourceCatalog"
+Column_Source_Id = "SourceId"
+
+# value columns of the store, one per Category; missing values are NaN
+Value_Categories = [category for category in Category if category != Category.ObjectsInCircle]
+# columns with sorted indexes, range filters on them read only the rows inside the range
+Indexed_Categories = [Category.Parallax, Category.ProperMotion, Category.GMagnitude, Category.BPMagnitude,
+                      Category.RPMagnitude, Category.RadialVelocity, Category.Mass, Category.Radius,
+                      Category.Luminosity, Category.Temperature, Category.Gravity]
+# units of the stored values, ingested columns with other units are converted
+Category_Units = {
+    Category.RA: u.deg, Category.Dec: u.deg,
+    Category.PMRA: u.mas / u.yr, Category.PMDec: u.mas / u.yr, Category.ProperMotion: u.mas / u.yr,
+    Category.Parallax: u.mas, Category.RadialVelocity: u.km / u.s,
+}
+# object types are stored as small integer codes, the code column has a sorted index too
+Object_Type_Codes = {object_type.value: code for code, object_type in
+                     enumerate([ObjectTypes.Undefined, ObjectTypes.Star, ObjectTypes.Galaxy, ObjectTypes.Quasar])}
+
+
+# Local columnar catalog of Gaia, SIMBAD (or other) extracts
+# Every column is a numpy .npy file which is memory-mapped, so only the pages a query touches are read and the store
+# can be bigger than the memory. Rows are sorted by HEALPix index: a cone search reads the row ranges of the pixels
+# covering the cone. Sorted indexes (row numbers ordered by value) of the magnitude, parallax and astrophysical
+# parameter columns turn their range filters into binary searches. A query starts from the filter selecting the fewest
+# rows and checks the other filters on those rows only.
+# Ingestion writes a new version of the store next to the current one and then switches CURRENT to it, so queries
+# running meanwhile keep reading the previous version: a version maps all its files when it is opened, so it is read
+# even after a later ingest removed its directory. Ingestion holds a lock file, so one process ingests at a time.
+class StellarisStore:
+    def __init__(self, directory=Store_Dir):
+        self.directory = directory
+        self._snapshot = None
+        self._current_stat = None
+        self._lock = threading.Lock()
+
+    # Add rows of the table to the store, rows of the same source objects (source catalog and id) are replaced
+    # The first column of the table is the source id, RA and Dec are required, other columns named as Category are
+    # stored if they are present. Positions are propagated from epoch to Store_Epoch when the table has proper motions.
+    def Ingest(self, table, source_catalog, object_type="", epoch=None):
+        object_type = ObjectTypeName(object_type) if object_type else ObjectTypes.Undefined.value
+        if len(table) == 0:
+            return {"rows_ingested": 0, "rows_replaced": 0, "rows": self.Stats["rows"]}
+        new_columns = _ingestedColumns(table, source_catalog, object_type, epoch)
+
+        with self._lock, _ingestLock(self.directory):
+            snapshot = self._getSnapshot()
+            old_rows = snapshot.Rows if snapshot is not None else 0
+            next_id = snapshot.Manifest["next_id"] if snapshot is not None else 0
+
+            # the same source rows keep their stellaris_id, their old rows are dropped
+            keep_old = np.ones(old_rows, dtype=bool)
+            new_ids = np.empty(len(new_columns[Column_Source_Id]), dtype=np.int64)
+            found = np.zeros(len(new_ids), dtype=bool)
+            if old_rows > 0:
+                same_catalog = np.flatnonzero(snapshot.Column(Column_Source_Catalog) == new_columns[Column_Source_Catalog][0])
+                if len(same_catalog) > 0:
+                    old_keys = np.asarray(snapshot.Column(Column_Source_Id)[same_catalog])
+                    order = np.argsort(old_keys, kind="stable")
+                    sorted_keys = old_keys[order]
+                    position = np.minimum(np.searchsorted(sorted_keys, new_columns[Column_Source_Id]), len(sorted_keys) - 1)
+                    found = sorted_keys[position] == new_columns[Column_Source_Id]
+                    old_rows_found = same_catalog[order[position[found]]]
+                    new_ids[found] = np.asarray(snapshot.Column(Column_Id)[old_rows_found])
+                    keep_old[old_rows_found] = False
+            new_ids[~found] = next_id + np.arange(np.count_nonzero(~found))
+            new_columns[Column_Id] = new_ids
+            next_id += int(np.count_nonzero(~found))
+
+            version = uuid.uuid4().hex
+            version_dir = os.path.join(self.directory, version)
+            os.makedirs(os.path.join(version_dir, "index"))
+            try:
+                healpix = self._combined(snapshot, Column_Healpix, keep_old, new_columns)
+                order = np.argsort(healpix, kind="stable")
+                rows = len(order)
+                np.save(os.path.join(version_dir, f"{Column_Healpix}.npy"), healpix[order])
+                del healpix
+
+                for name in _storedColumns():
+                    if name == Column_Healpix:
+                        continue
+                    values = self._combined(snapshot, name, keep_old, new_columns)[order]
+                    np.save(os.path.join(version_dir, f"{name}.npy"), values)
+                    if name in _indexedColumns():
+                        _saveIndex(version_dir, name, values)
+
+                manifest = {"rows": rows, "next_id": next_id, "epoch": Store_Epoch, "index_order": Index_Order,
+                            "columns": _storedColumns(), "indexes": _indexedColumns()}
+                with open(os.path.join(version_dir, "manifest.json"), "w") as file:
+                    json.dump(manifest, file, indent=2)
+            except BaseException:
+                shutil.rmtree(version_dir, ignore_errors=True)
+                raise
+
+            current_path = os.path.join(self.directory, "CURRENT")
+            with open(current_path + ".tmp", "w") as file:
+                file.write(version)
+            os.replace(current_path + ".tmp", current_path)
+            self._snapshot = None
+            self._removeStaleVersions(version)
+
+        return {"rows_ingested": len(new_ids), "rows_replaced": int(np.count_nonzero(found)), "rows": rows}
+
+    # Rows matching the filters as astropy table, at most limit rows in the order of the store (by HEALPix index)
+    # ranges maps column name to (low, high) with None for an open end, cone is (ra, dec, radius) in degrees or None,
+    # object_type is ObjectTypes value or None
+    def Query(self, ranges=None, cone=None, object_type=None, limit=None):
+        snapshot = self._getSnapshot()
+        if snapshot is None or snapshot.Rows == 0:
+            return _emptyTable()
+
+        filters = [(name, low, high) for name, (low, high) in (ranges or {}).items() if low is not None or high is not None]
+        if object_type:
+            code = Object_Type_Codes[ObjectTypeName(object_type)]
+            filters.append((Column_Object_Type, code, code))
+
+        # the filter selecting the fewest rows drives the query, the others are checked on its rows
+        driver_count, driver_blocks, driver = snapshot.Rows, lambda: _rangeBlocks([(0, snapshot.Rows)]), None
+        if cone is not None and cone[2] < Full_Sky_Radius:
+            row_ranges = snapshot.ConeRowRanges(*cone)
+            count = sum(end - start for start, end in row_ranges)
+            if count < driver_count:
+                driver_count, driver_blocks, driver = count, lambda: _rangeBlocks(row_ranges), "cone"
+        for name, low, high in filters:
+            if name not in snapshot.Indexes:
+                continue
+            start, end = snapshot.IndexRange(name, low, high)
+            if end - start < driver_count:
+                driver_count, driver_blocks, driver = end - start, (lambda name=name, start=start, end=end: _indexBlocks(snapshot, name, start, end)), name
+
+        selected = []
+        selected_count = 0
+        for block in driver_blocks():
+            mask = np.ones(len(block), dtype=bool)
+            for name, low, high in filters:
+                if name == driver:
+                    continue
+                values = snapshot.Column(name)[block]
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            # pixels cover the cone with a margin, so rows of the driving cone are checked by distance too
+            if cone is not None and cone[2] < Full_Sky_Radius:
+                ra, dec, radius = cone
+                candidates = block[mask]
+                mask[mask] = AngularDistance(ra, dec, snapshot.Column(Category.RA.name)[candidates],
+                                             snapshot.Column(Category.Dec.name)[candidates]) <= radius
+            rows = block[mask]
+            selected.append(rows)
+            selected_count += len(rows)
+            if limit and selected_count >= limit:
+                break
+
+        row_index = np.sort(np.concatenate(selected)) if selected else np.empty(0, dtype=np.int64)
+        if limit:
+            row_index = row_index[:limit]
+        return snapshot.Table(row_index)
+
+    # Rows of the store which can be within radius of the positions (ra, dec arrays in degrees): rows of HEALPix pixels
+    # around every position, the caller matches them exactly
+    def RowsNear(self, ra, dec, radius):
+        snapshot = self._getSnapshot()
+        if snapshot is None or snapshot.Rows == 0:
+            return _emptyTable()
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        valid = np.isfinite(ra) & np.isfinite(dec)
+        ra, dec = ra[valid], dec[valid]
+
+        # pixels several times bigger than the radius: the circle around a position touches the pixel of the position and
+        # the pixels of the points at the radius in 8 directions
+        order = _pixelOrder(radius * 4)
+        points_ra, points_dec = [ra], [dec]
+        cos_dec = np.maximum(np.cos(np.radians(dec)), 1e-6)
+        for angle in np.radians(np.arange(0, 360, 45)):
+            points_ra.append(ra + radius * math.cos(angle) / cos_dec)
+            points_dec.append(np.clip(dec + radius * math.sin(angle), -90.0, 90.0))
+        pixels = np.unique(AngToPixNest(order, np.concatenate(points_ra), np.concatenate(points_dec)))
+        row_ranges = snapshot.PixelRowRanges(order, pixels)
+        row_index = np.concatenate([np.arange(start, end) for start, end in row_ranges]) if row_ranges else np.empty(0, dtype=np.int64)
+        return snapshot.Table(row_index)
+
+    @property
+    def Stats(self):
+        snapshot = self._getSnapshot()
+        if snapshot is None:
+            return {"rows": 0, "bytes": 0}
+        return {"rows": snapshot.Rows, "bytes": snapshot.Bytes}
+
+    # remove the whole store
+    def Clear(self):
+        with self._lock:
+            self._snapshot = None
+            self._current_stat = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    # version of the store named in CURRENT, opened again when another process has ingested since it was opened
+    def _getSnapshot(self):
+        current_path = os.path.join(self.directory, "CURRENT")
+        try:
+            stat = os.stat(current_path)
+        except FileNotFoundError:
+            return None
+        current_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        snapshot = self._snapshot
+        if snapshot is None or current_stat != self._current_stat:
+            with open(current_path) as file:
+                snapshot = _StoreSnapshot(os.path.join(self.directory, file.read().strip()))
+            self._snapshot = snapshot
+            self._current_stat = current_stat
+        return snapshot
+
+    # values of the column for the kept old rows followed by the new rows
+    @staticmethod
+    def _combined(snapshot, name, keep_old, new_columns):
+        new_values = new_columns[name]
+        if snapshot is None or not keep_old.any():
+            return np.asarray(new_values)
+        return np.concatenate([np.asarray(snapshot.Column(name))[keep_old], new_values])
+
+    # versions replaced by ingestion except the Kept_Versions newest ones; files still mapped by another process
+    # (on Windows) are removed next time
+    def _removeStaleVersions(self, current_version):
+        versions = [entry for entry in os.scandir(self.directory)
+                    if entry.is_dir() and Version_Name.fullmatch(entry.name) and entry.name != current_version]
+        versions.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for entry in versions[Kept_Versions - 1:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# One version of the store: memory-mapped columns and indexes
+# Every file is mapped when the version is opened: a mapping stays valid after the file is removed, so queries holding
+# the version finish after ingestion removed it
+class _StoreSnapshot:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as file:
+            self.Manifest = json.load(file)
+        self.Rows = self.Manifest["rows"]
+        self.Indexes = set(self.Manifest["indexes"])
+        self._columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                         for name in self.Manifest["columns"]}
+        self._indexes = {name: (np.load(os.path.join(directory, "index", f"{name}.rows.npy"), mmap_mode="r"),
+                                np.load(os.path.join(directory, "index", f"{name}.values.npy"), mmap_mode="r"))
+                         for name in self.Manifest["indexes"]}
+
+    def Column(self, name):
+        return self._columns[name]
+
+    # (row numbers ordered by value, sorted values) of the indexed column
+    def Index(self, name):
+        return self._indexes[name]
+
+    # [start, end) positions in the index of the values between low and high
+    def IndexRange(self, name, low, high):
+        row_numbers, values = self.Index(name)
+        start = np.searchsorted(values, low, side="left") if low is not None else 0
+        end = np.searchsorted(values, high, side="right") if high is not None else len(values)
+        return int(start), int(max(start, end))
+
+    # row ranges of the HEALPix pixels covering the cone
+    def ConeRowRanges(self, ra, dec, radius):
+        order = _pixelOrder(radius / 2)
+        return self.PixelRowRanges(order, np.asarray(ConePixels(ra, dec, radius, order), dtype=np.int64))
+
+    # row ranges [start, end) of the pixels of the order, neighbour pixels are joined into one range
+    def PixelRowRanges(self, order, pixels):
+        if len(pixels) == 0:
+            return []
+        shift = 2 * (Index_Order - order)
+        pixels = np.unique(pixels)
+        # consecutive pixels form one range of finer pixels
+        breaks = np.flatnonzero(np.diff(pixels) != 1) + 1
+        first = pixels[np.concatenate([[0], breaks])]
+        last = pixels[np.concatenate([breaks - 1, [len(pixels) - 1]])]
+        healpix = self.Column(Column_Healpix)
+        starts = np.searchsorted(healpix, first << shift, side="left")
+        ends = np.searchsorted(healpix, (last + 1) << shift, side="left")
+        return [(int(start), int(end)) for start, end in zip(starts, ends) if end > start]
+
+    # rows as astropy table in the column layout of query results
+    def Table(self, row_index):
+        columns = {Column_Id: np.asarray(self.Column(Column_Id)[row_index]),
+                   Column_Source_Catalog: np.char.decode(np.asarray(self.Column(Column_Source_Catalog)[row_index]), "utf-8"),
+                   Column_Source_Id: np.char.decode(np.asarray(self.Column(Column_Source_Id)[row_index]), "utf-8"),
+                   Column_Object_Type: _objectTypeNames(np.asarray(self.Column(Column_Object_Type)[row_index]))}
+        for category in Value_Categories:
+            columns[category.name] = np.asarray(self.Column(category.name)[row_index])
+        table = Table(columns)
+        for category, unit in Category_Units.items():
+            table[category.name].unit = unit
+        return table
+
+    @property
+    def Bytes(self):
+        size = 0
+        for root, directories, files in os.walk(self.directory):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        return size
+
+
+# exclusive lock of the store directory held while a process ingests, other processes wait for it
+@contextmanager
+def _ingestLock(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "INGEST.lock"), "a+b") as file:
+        if os.name == "nt":
+            import msvcrt
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+# ObjectTypes value of the object type name in any case
+def ObjectTypeName(object_type):
+    for value in Object_Type_Codes:
+        if value and value.lower() == str(object_type).lower():
+            return value
+    raise ValueError(f"Invalid object_types={object_type} is specified.")
+
+
+def _storedColumns():
+    return ([Column_Id, Column_Healpix, Column_Source_Catalog, Column_Source_Id, Column_Object_Type] +
+            [category.name for category in Value_Categories])
+
+
+def _indexedColumns():
+    return [category.name for category in Indexed_Categories] + [Column_Object_Type]
+
+
+# columns of the ingested table in the layout of the store, the source ids are unique
+def _ingestedColumns(table, source_catalog, object_type, epoch):
+    if Category.RA.name not in table.colnames or Category.Dec.name not in table.colnames:
+        raise ValueError(f"Ingested table must have {Category.RA.name} and {Category.Dec.name} columns")
+    source_ids = np.char.encode(np.asarray(np.ma.filled(table[table.colnames[0]])).astype(str), "utf-8")
+    unique_ids, first = np.unique(source_ids, return_index=True)
+    rows = np.sort(first)
+    table = table[rows]
+    source_ids = source_ids[rows]
+
+    columns = {}
+    for category in Value_Categories:
+        if category.name in table.colnames:
+            unit = Category_Units.get(category)
+            columns[category.name] = (ColumnFloatValues(table[category.name], unit) if unit is not None else
+                                      np.ma.filled(np.ma.asarray(table[category.name], dtype=np.float64), np.nan))
+        else:
+            columns[category.name] = np.full(len(table), np.nan)
+
+    if epoch and EpochToJulianYear(epoch) != EpochToJulianYear(Store_Epoch) and Category.PMRA.name in table.colnames and Category.PMDec.name in table.colnames:
+        columns[Category.RA.name], columns[Category.Dec.name] = PropagatePositions(
+            columns[Category.RA.name], columns[Category.Dec.name], columns[Category.PMRA.name], columns[Category.PMDec.name],
+            epoch, Store_Epoch, columns[Category.Parallax.name], columns[Category.RadialVelocity.name])
+
+    columns[Column_Healpix] = AngToPixNest(Index_Order, columns[Category.RA.name], columns[Category.Dec.name])
+    columns[Column_Source_Catalog] = np.full(len(table), source_catalog.encode("utf-8"))
+    columns[Column_Source_Id] = source_ids
+    columns[Column_Object_Type] = np.full(len(table), Object_Type_Codes[object_type], dtype=np.uint8)
+    return columns
+
+
+# sorted index of the column: row numbers ordered by value and the sorted values, rows with NaN are not indexed
+def _saveIndex(version_dir, name, values):
+    row_dtype = np.int32 if len(values) < 2 ** 31 else np.int64
+    order = np.argsort(values, kind="stable")
+    if values.dtype.kind == "f":
+        order = order[:len(order) - np.count_nonzero(np.isnan(values))]
+    np.save(os.path.join(version_dir, "index", f"{name}.rows.npy"), order.astype(row_dtype))
+    np.save(os.path.join(version_dir, "index", f"{name}.values.npy"), values[order])
+
+
+# blocks of row numbers of the row ranges
+def _rangeBlocks(row_ranges):
+    for start, end in row_ranges:
+        for block_start in range(start, end, Query_Block_Size):
+            yield np.arange(block_start, min(block_start + Query_Block_Size, end), dtype=np.int64)
+
+
+# blocks of row numbers of the index positions [start, end), every block in the order of the rows
+def _indexBlocks(snapshot, name, start, end):
+    row_numbers, values = snapshot.Index(name)
+    for block_start in range(start, end, Query_Block_Size):
+        yield np.sort(np.asarray(row_numbers[block_start:min(block_start + Query_Block_Size, end)], dtype=np.int64))
+
+
+# the finest order not finer than Index_Order whose pixels are at least the given size
+def _pixelOrder(pixel_size):
+    if pixel_size <= 0:
+        return Index_Order
+    order = math.floor(math.log2(PixelSize(0) / pixel_size))
+    return min(max(order, 0), Index_Order)
+
+
+def _objectTypeNames(codes):
+    names = np.array(list(Object_Type_Codes), dtype=object)
+    return names[codes].astype(str)
+
+
+def _emptyTable():
+    columns = {Column_Id: np.empty(0, dtype=np.int64), Column_Source_Catalog: np.empty(0, dtype=str),
+               Column_Source_Id: np.empty(0, dtype=str), Column_Object_Type: np.empty(0, dtype=str)}
+    for category in Value_Categories:
+        columns[category.name] = np.empty(0, dtype=np.float64)
+    return Table(columns)
+
+
+# Process-wide local catalog
+Stellaris_Store = StellarisStore()
@@ -0,0 +1,347 @@
+import binascii
+import math
+import queue
+import threading
+import xml.etree.ElementTree as ElementTree
+from io import BytesIO
+
+import numpy as np
+import astropy.units as u
+from astropy.io.votable import parse
+from astropy.table import Table, Column, MaskedColumn
+
+# size of HTTP body chunks read from the socket
+Read_Chunk_Size = 1024 * 1024
+# chunks read ahead of the decoder, it bounds memory used by the download running ahead
+Prefetch_Chunks = 4
+# rows preallocated when the number of rows is not known, arrays grow twice when they are full
+Initial_Capacity = 65536
+# preallocation by expected number of rows (query TOP) is limited, a small result of a big TOP doesn't waste memory
+Max_Preallocated_Rows = 2000000
+
+# VOTable datatype -> numpy type of its binary serialization (big-endian) and size in bytes
+Binary_Types = {
+    "boolean": ("S1", 1),
+    "unsignedByte": ("u1", 1),
+    "short": (">i2", 2),
+    "int": (">i4", 4),
+    "long": (">i8", 8),
+    "char": ("S1", 1),
+    "float": (">f4", 4),
+    "double": (">f8", 8),
+}
+
+_Whitespace = b" \t\r\n"
+
+
+# Read binary or binary2 VOTable from a streamed HTTP response into astropy table, return the table and body size
+# The body is read by a background thread while rows are decoded, so decoding overlaps the download. Base64 STREAM is
+# decoded chunk by chunk and complete rows are copied straight into column arrays, preallocated for expected_rows
+# (the TOP of the query) when it is known. Neither the whole body nor a VOTable tree is kept in memory.
+# Documents which can't be decoded incrementally (TABLEDATA, variable length or unsupported fields, empty results)
+# are parsed by astropy from the body read so far and the rest of the stream.
+def ReadVOTableStream(response, expected_rows=None, chunk_size=Read_Chunk_Size):
+    chunks = _PrefetchedChunks(response, chunk_size)
+    reader = _StreamReader(expected_rows)
+    try:
+        table = reader.Read(chunks)
+    finally:
+        chunks.close()
+    return table, reader.BytesRead
+
+
+# Decode VOTable document received in memory the same way as a streamed one, return the table
+# The asyncio serving mode downloads the body without blocking the event loop and decodes it in a worker process
+def ReadVOTableBytes(body, expected_rows=None, chunk_size=Read_Chunk_Size):
+    chunks = (body[start:start + chunk_size] for start in range(0, len(body), chunk_size))
+    return _StreamReader(expected_rows).Read(chunks)
+
+
+class _StreamReader:
+    def __init__(self, expected_rows):
+        self.BytesRead = 0
+        self._expected_rows = expected_rows
+
+    def Read(self, chunks):
+        header = bytearray()
+        for chunk in chunks:
+            self.BytesRead += len(chunk)
+            header += chunk
+            stream_start = header.find(b"<STREAM")
+            if stream_start >= 0:
+                tag_end = header.find(b">", stream_start)
+                if tag_end >= 0:
+                    break
+        else:
+            # the document has no binary stream
+            return _parseWhole(bytes(header), iter(()))
+
+        fields, binary2, inline = _parseHeader(bytes(header[:tag_end + 1]))
+        decoder = _RowDecoder.Create(fields, binary2, self._expected_rows) if inline else None
+        if decoder is None:
+            return _parseWhole(bytes(header), self._counted(chunks))
+
+        text = bytes(header[tag_end + 1:])
+        del header
+        base64_tail = b""
+        finished = False
+        while True:
+            stream_end = text.find(b"<")
+            if stream_end >= 0:
+                text = text[:stream_end]
+                finished = True
+            text = base64_tail + text.translate(None, _Whitespace)
+            complete = len(text) - len(text) % 4
+            base64_tail = text[complete:]
+            if complete:
+                decoder.Feed(binascii.a2b_base64(text[:complete]))
+            if finished:
+                break
+            text = next(chunks, None)
+            if text is None:
+                raise ValueError("VOTable stream is truncated")
+            self.BytesRead += len(text)
+        # closing tags are read to the end, so the connection goes back to the pool
+        for chunk in chunks:
+            self.BytesRead += len(chunk)
+        return decoder.Finish()
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.BytesRead += len(chunk)
+            yield chunk
+
+
+# FIELD descriptions from the document header up to STREAM start tag, binary2 flag, True if the stream is inline base64
+def _parseHeader(header):
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    fields = []
+    binary2 = False
+    inline = False
+    field = None
+    try:
+        parser.feed(header)
+        for event, element in parser.read_events():
+            tag = element.tag.rsplit("}", 1)[-1]
+            if event == "start" and tag == "FIELD":
+                field = dict(element.attrib)
+                fields.append(field)
+            elif event == "start" and tag == "VALUES" and field is not None:
+                field["null"] = element.attrib.get("null")
+            elif event == "end" and tag == "DESCRIPTION" and field is not None:
+                field["description"] = (element.text or "").strip()
+            elif event == "end" and tag == "FIELD":
+                field = None
+            elif event == "start" and tag == "BINARY2":
+                binary2 = True
+            elif event == "start" and tag == "STREAM":
+                inline = element.attrib.get("encoding") == "base64" and "href" not in element.attrib
+    except ElementTree.ParseError:
+        return [], False, False
+    return fields, binary2, inline
+
+
+# whole document parsed by astropy: the body read so far and the rest of the stream
+def _parseWhole(head, rest):
+    body = BytesIO()
+    body.write(head)
+    for chunk in rest:
+        body.write(chunk)
+    body.seek(0)
+    return parse(body).get_first_table().to_table()
+
+
+# Decoder of fixed size rows into column arrays
+class _RowDecoder:
+    def __init__(self, fields, names, dtypes, binary2, capacity):
+        self._fields = fields
+        self._names = names
+        self._binary2 = binary2
+        self._null_bytes = math.ceil(len(fields) / 8) if binary2 else 0
+        row_fields = [(f"f{index}", dtype) for index, dtype in enumerate(dtypes)]
+        if binary2:
+            row_fields.insert(0, ("nulls", "u1", (self._null_bytes,)))
+        self._row_dtype = np.dtype(row_fields)
+        self._pending = bytearray()
+        self._rows = 0
+        self._columns = [np.empty((capacity,) + np.dtype(dtype).shape, dtype=np.dtype(dtype).base.newbyteorder("=")) for dtype in dtypes]
+        self._nulls = np.zeros((capacity, len(fields)), dtype=bool) if binary2 else None
+
+    # decoder for the fields or None if some field has variable size or unsupported datatype
+    @classmethod
+    def Create(cls, fields, binary2, expected_rows):
+        if not fields:
+            return None
+        dtypes = []
+        for field in fields:
+            dtype = _fieldDtype(field)
+            if dtype is None:
+                return None
+            dtypes.append(dtype)
+        names = _uniqueNames([field.get("ID") or field.get("name") or f"col{index}" for index, field in enumerate(fields)])
+        capacity = min(expected_rows, Max_Preallocated_Rows) if expected_rows else Initial_Capacity
+        return cls(fields, names, dtypes, binary2, max(capacity, 1))
+
+    def Feed(self, data):
+        self._pending += data
+        row_size = self._row_dtype.itemsize
+        count = len(self._pending) // row_size
+        if count == 0:
+            return
+        rows = np.frombuffer(self._pending, dtype=self._row_dtype, count=count)
+        self._ensureCapacity(self._rows + count)
+        target = slice(self._rows, self._rows + count)
+        for index, column in enumerate(self._columns):
+            column[target] = rows[f"f{index}"]
+        if self._binary2:
+            self._nulls[target] = np.unpackbits(rows["nulls"], axis=1)[:, :len(self._fields)].astype(bool)
+        self._rows += count
+        del rows
+        del self._pending[:count * row_size]
+
+    def Finish(self):
+        if self._pending:
+            raise ValueError(f"VOTable stream ends inside a row ({len(self._pending)} bytes left)")
+        columns = []
+        for index, (field, name, data) in enumerate(zip(self._fields, self._names, self._columns)):
+            data = data[:self._rows]
+            # big preallocation of an unexpectedly small result is released
+            if len(self._columns[index]) > 2 * self._rows:
+                data = data.copy()
+            mask = self._nulls[:self._rows, index] if self._binary2 else None
+            data, mask = _convertField(field, data, mask)
+            columns.append(_makeColumn(field, name, data, mask))
+        return Table(columns, copy=False)
+
+    def _ensureCapacity(self, rows):
+        capacity = len(self._columns[0])
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        self._columns = [_grow(column, capacity) for column in self._columns]
+        if self._binary2:
+            self._nulls = _grow(self._nulls, capacity)
+
+
+def _grow(array, capacity):
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    if array.dtype == bool:
+        grown[len(array):] = False
+    return grown
+
+
+# numpy dtype of a fixed size field or None
+def _fieldDtype(field):
+    datatype = field.get("datatype")
+    if datatype not in Binary_Types:
+        return None
+    base, size = Binary_Types[datatype]
+    arraysize = field.get("arraysize")
+    if not arraysize:
+        return base
+    if "*" in arraysize:
+        return None
+    shape = tuple(int(dimension) for dimension in arraysize.split("x"))
+    if datatype == "char":
+        # char arrays are strings, only one dimensional ones are supported
+        return f"S{shape[0]}" if len(shape) == 1 else None
+    if datatype == "boolean":
+        return None
+    return np.dtype((base, shape[::-1]))
+
+
+# values of the column the way astropy returns them, mask of null values
+def _convertField(field, data, mask):
+    datatype = field.get("datatype")
+    if datatype == "boolean":
+        flags = np.char.upper(data)
+        values = (flags == b"T") | (flags == b"1")
+        undefined = ~values & (flags != b"F") & (flags != b"0")
+        return values, undefined if mask is None else (mask | undefined)
+    if field.get("null") is not None and datatype in ("unsignedByte", "short", "int", "long"):
+        null_mask = data == int(field["null"])
+        if data.ndim > 1:
+            null_mask = null_mask.reshape(len(data), -1).all(axis=1)
+        mask = null_mask if mask is None else (mask | null_mask)
+    if datatype in ("float", "double"):
+        if mask is not None:
+            # binary2 null flag of floating point values is NaN too
+            data[mask] = np.nan
+        # NaN is the null value of floating point fields, astropy masks it in both serializations
+        nan_mask = np.isnan(data)
+        if data.ndim > 1:
+            nan_mask = nan_mask.reshape(len(data), -1).all(axis=1)
+        mask = nan_mask if mask is None else (mask | nan_mask)
+    return data, mask
+
+
+def _makeColumn(field, name, data, mask):
+    attributes = {"name": name, "description": field.get("description")}
+    if field.get("unit"):
+        attributes["unit"] = u.Unit(field["unit"], format="vounit", parse_strict="silent")
+    if mask is not None and mask.any():
+        if data.ndim > 1:
+            mask = np.broadcast_to(mask.reshape((len(mask),) + (1,) * (data.ndim - 1)), data.shape)
+        return MaskedColumn(data, mask=mask, copy=False, **attributes)
+    return Column(data, copy=False, **attributes)
+
+
+def _uniqueNames(names):
+    seen = {}
+    unique = []
+    for name in names:
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        unique.append(name)
+    return unique
+
+
+# Iterator over response body chunks read by a background thread, so the socket is read while chunks are decoded
+class _PrefetchedChunks:
+    def __init__(self, response, chunk_size):
+        self._response = response
+        self._queue = queue.Queue(maxsize=Prefetch_Chunks)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read, args=(chunk_size,), name="votable-prefetch", daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is None:
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    # stop reading, the rest of the body is discarded with the connection
+    def close(self):
+        self._stopped.set()
+        self._response.close()
+        self._thread.join()
+
+    def _read(self, chunk_size):
+        try:
+            for chunk in self._response.iter_content(chunk_size=chunk_size):
+                if chunk and not self._put(chunk):
+                    return
+            self._put(None)
+        except BaseException as e:
+            if not self._stopped.is_set():
+                self._put(e)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
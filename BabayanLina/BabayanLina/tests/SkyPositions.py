@@ -0,0 +1,31 @@
+import numpy as np
+
+
+# n positions in degrees distributed uniformly inside the cap of radius (degrees) around (ra, dec)
+def CapPositions(rng, ra, dec, radius, n):
+    cos_theta = rng.uniform(np.cos(np.radians(radius)), 1.0, n)
+    sin_theta = np.sqrt(1.0 - cos_theta ** 2)
+    phi = rng.uniform(0.0, 2 * np.pi, n)
+
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    center = np.array([np.cos(dec0) * np.cos(ra0), np.cos(dec0) * np.sin(ra0), np.sin(dec0)])
+    east = np.array([-np.sin(ra0), np.cos(ra0), 0.0])
+    north = np.array([-np.sin(dec0) * np.cos(ra0), -np.sin(dec0) * np.sin(ra0), np.cos(dec0)])
+    vectors = (cos_theta[:, None] * center + (sin_theta * np.cos(phi))[:, None] * east +
+               (sin_theta * np.sin(phi))[:, None] * north)
+    return (np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])) % 360.0,
+            np.degrees(np.arcsin(np.clip(vectors[:, 2], -1.0, 1.0))))
+
+
+# angular distances in degrees between every position of the first arrays and every position of the second ones,
+# computed from the chord between unit vectors, which is exact for small angles
+def BruteForceSeparations(ra1, dec1, ra2, dec2):
+    vectors1 = _unitVectors(ra1, dec1)
+    vectors2 = _unitVectors(ra2, dec2)
+    chord = np.linalg.norm(vectors1[:, None, :] - vectors2[None, :, :], axis=2)
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0.0, 1.0)))
+
+
+def _unitVectors(ra, dec):
+    ra, dec = np.radians(np.asarray(ra, dtype=np.float64)), np.radians(np.asarray(dec, dtype=np.float64))
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=1)
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import API.StellarisAPI as StellarisAPI
+from DBaccess.AdmissionControl import AdmissionControl, reserved_slots
+from DBaccess.CostEstimator import QueryCost, Basis_Defaults
+from DBaccess.JobManager import QueryJob
+from DBaccess.RequestProcessingError import AdmissionRejectedError
+
+Estimated_Rows = 600
+
+
+def test_client_concurrency_limit():
+    admission = AdmissionControl(max_concurrent=2)
+    with admission.Client("a"), admission.Client("a"):
+        with pytest.raises(AdmissionRejectedError):
+            with admission.Client("a"):
+                pass
+        # other clients have their own limit
+        with admission.Client("b"):
+            pass
+    with admission.Client("a"):
+        pass
+    assert admission.Stats["client_rejections"] == 1
+
+
+def test_rows_quota_is_refilled_over_time():
+    admission = AdmissionControl(rows_per_minute=1000)
+    admission.Charge("a", 600)
+    with pytest.raises(AdmissionRejectedError) as rejected:
+        admission.Charge("a", 600)
+    assert 11 < rejected.value.retry_after <= 12
+    # a request bigger than the whole quota is admitted when the bucket is full
+    admission.Charge("b", 5000)
+    with pytest.raises(AdmissionRejectedError):
+        admission.Charge("b", 1)
+
+
+def test_big_requests_leave_reserved_slots():
+    admission = AdmissionControl(upstream_limits={"gaia": 4})
+    for _ in range(4 - reserved_slots):
+        assert admission.TryUpstream("gaia")
+    assert not admission.TryUpstream("gaia")
+    # small requests may take the reserved slots
+    for _ in range(reserved_slots):
+        admission.AcquireUpstream("gaia")
+    assert admission.Stats["gaia_in_use"] == 4
+    for _ in range(4):
+        admission.ReleaseUpstream("gaia")
+    assert admission.Stats["gaia_in_use"] == 0
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(StellarisAPI, "Admission_Control", AdmissionControl(max_concurrent=1, rows_per_minute=1000))
+    monkeypatch.setattr(StellarisAPI.Cost_Estimator, "Estimate",
+                        lambda db_access, query_params_json, limit: QueryCost(db_access.Catalog, Estimated_Rows, limit, Basis_Defaults))
+    # jobs are accepted but not run, the catalogs are not requested
+    monkeypatch.setattr(StellarisAPI.Job_Manager, "Submit", lambda job_type, description, job_function: QueryJob(job_type, description))
+    return StellarisAPI.app.test_client()
+
+
+def _post(client, path, **request):
+    response = client.post(path, data=json.dumps(dict(request, query_params=json.dumps({"limit": 1000}))))
+    return response.status_code
+
+
+def test_jobs_are_charged_to_the_client_quota(client):
+    assert _post(client, "/jobs", job_type="processQuery", db_name="gaia") == 202
+    assert _post(client, "/jobs", job_type="processQuery", db_name="gaia") == 429
+    # the jobs of other clients are admitted
+    response = client.post("/jobs", data=json.dumps({"job_type": "processQuery", "db_name": "gaia", "query_params": json.dumps({"limit": 1000})}),
+                           environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert response.status_code == 202
+
+
+def test_federated_queries_are_charged_to_the_client_quota(client):
+    StellarisAPI.Admission_Control.Charge("127.0.0.1", 500)
+    assert _post(client, "/federatedQuery", db_names=["gaia", "simbad"]) == 429
+
+
+def test_aggregates_count_as_requests_of_the_client(client):
+    with StellarisAPI.Admission_Control.Client("127.0.0.1"):
+        assert _post(client, "/aggregate", db_name="gaia") == 429
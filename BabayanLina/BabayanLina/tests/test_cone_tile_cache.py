@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+import DBaccess.ConeTileCache as ConeTileCache
+import DBaccess.DBAccessGaia as DBAccessGaia
+from Benchmarks.TapStandIn import TapStandIn
+from DBaccess.QueryCache import QueryCache
+from SkyPositions import CapPositions, BruteForceSeparations
+
+Rows = 20000
+Field = (120.0, -30.0)
+# rows this close to the cone radius are skipped, rounding may put them on either side
+Radius_Tolerance = 1e-9
+
+
+# Gaia-like sources in a dense field, source ids hold HEALPix index of the source like in Gaia
+@pytest.fixture(scope="module")
+def stand_in():
+    rng = np.random.default_rng(1)
+    ra, dec = CapPositions(rng, *Field, 3.0, Rows)
+    source_id = (ConeTileCache.AngToPixNest(12, ra, dec) << ConeTileCache.Source_Id_Healpix_Shift) + rng.integers(0, 1 << 20, Rows)
+    fixture = Table({"gaia_id": source_id, "RA": ra, "Dec": dec, "GMagnitude": rng.uniform(3.0, 21.0, Rows)})
+    fixture.sort("gaia_id")
+    with TapStandIn(fixture=fixture) as stand_in:
+        yield stand_in
+
+
+# Gaia backend requesting the stand-in, with the number of queries it answered
+@pytest.fixture
+def gaia(stand_in, monkeypatch):
+    monkeypatch.setattr(DBAccessGaia, "Gaia_Url", stand_in.ServiceUrl("gaia") + "/sync")
+    queries = []
+    answer = stand_in.Answer
+    monkeypatch.setattr(stand_in, "Answer", lambda query, *args, **kwargs: queries.append(query) or answer(query, *args, **kwargs))
+    return DBAccessGaia.DBAccessGaia(), queries
+
+
+@pytest.fixture
+def tile_cache(tmp_path):
+    return ConeTileCache.ConeTileCache(QueryCache(cache_dir=str(tmp_path)))
+
+
+def _queryCone(tile_cache, db_access, ra, dec, radius):
+    params = {"object_types": "Star", "objectsincircle": {"ra": ra, "dec": dec, "radius": radius}}
+    return tile_cache.QueryCone(db_access, params, None, db_access._constructADQLQuery(params, None, None))
+
+
+def _expectedIds(fixture, ra, dec, radius):
+    distance = BruteForceSeparations([ra], [dec], np.asarray(fixture["RA"]), np.asarray(fixture["Dec"]))[0]
+    inside = set(np.asarray(fixture["gaia_id"])[distance <= radius].tolist())
+    borderline = set(np.asarray(fixture["gaia_id"])[np.abs(distance - radius) <= Radius_Tolerance].tolist())
+    return inside, borderline
+
+
+@pytest.mark.parametrize("ra, dec, radius", [(Field[0], Field[1], 0.5), (Field[0] + 1.0, Field[1] - 1.0, 0.8), (Field[0], Field[1], 0.15)])
+def test_cone_from_tiles_matches_brute_force(stand_in, gaia, tile_cache, ra, dec, radius):
+    db_access, queries = gaia
+    table = _queryCone(tile_cache, db_access, ra, dec, radius)
+    inside, borderline = _expectedIds(stand_in.Fixture, ra, dec, radius)
+    found = set(np.asarray(table["gaia_id"]).tolist())
+    assert len(inside) > 10
+    assert found - borderline == inside - borderline
+    assert list(table["gaia_id"]) == sorted(table["gaia_id"])
+
+    # the same cone is answered from the cached tiles
+    requests = len(queries)
+    again = _queryCone(tile_cache, db_access, ra, dec, radius)
+    assert len(queries) == requests
+    assert list(again["gaia_id"]) == list(table["gaia_id"])
+
+
+def test_cone_inside_cached_cone_is_answered_from_tiles(gaia, tile_cache):
+    db_access, queries = gaia
+    _queryCone(tile_cache, db_access, Field[0], Field[1], 0.8)
+    requests = len(queries)
+    assert _queryCone(tile_cache, db_access, Field[0] + 0.1, Field[1], 0.3) is not None
+    assert len(queries) == requests
+
+
+def test_too_dense_tiles_are_not_fetched_again(gaia, tile_cache, monkeypatch):
+    db_access, queries = gaia
+    monkeypatch.setattr(ConeTileCache, "Max_Tile_Rows", 100)
+    assert _queryCone(tile_cache, db_access, Field[0], Field[1], 0.5) is None
+    assert len(queries) == 1
+    # the cone is requested as usual by the caller, the tiles are not requested again
+    assert _queryCone(tile_cache, db_access, Field[0], Field[1], 0.5) is None
+    assert _queryCone(tile_cache, db_access, Field[0] + 0.01, Field[1], 0.48) is None
+    assert len(queries) == 1
+
+
+def test_concurrent_cones_missing_the_same_tiles_fetch_them_once(stand_in, gaia, tile_cache, monkeypatch):
+    db_access, queries = gaia
+    monkeypatch.setattr(stand_in, "Latency", 0.3)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tables = list(executor.map(lambda _: _queryCone(tile_cache, db_access, Field[0], Field[1], 0.5), range(8)))
+    assert len(queries) == 1
+    assert all(list(table["gaia_id"]) == list(tables[0]["gaia_id"]) for table in tables)
@@ -0,0 +1,132 @@
+import json
+
+import numpy as np
+import pytest
+import pyvo
+from astropy.table import Table, MaskedColumn
+
+import API.StellarisAPI as StellarisAPI
+import DBaccess.CrossMatching as CrossMatchingModule
+import DBaccess.DBAccessGaia as DBAccessGaia
+import DBaccess.DBAccessSimbad as DBAccessSimbad
+import DBaccess.DBAccessStellaris as DBAccessStellaris
+from Benchmarks.TapStandIn import TapStandIn
+from DBaccess.CrossMatching import CrossMatching, ReduceMatches, Match_Best, Match_All, match_radius
+from DBaccess.HttpTransport import Http_Transport
+from DBaccess.MatchStore import MatchStore
+from DBaccess.StellarisStore import StellarisStore, Column_Id
+from SkyPositions import CapPositions, BruteForceSeparations
+
+Rows = 300
+# pairs this close to the radius are skipped, rounding may put them on either side
+Radius_Tolerance = 1e-9
+
+
+# local catalog of stars without motion in a field dense enough for several stars within match_radius of each other
+@pytest.fixture(scope="module")
+def local_catalog(tmp_path_factory):
+    rng = np.random.default_rng(1)
+    ra, dec = CapPositions(rng, 10.0, 20.0, 0.05, Rows)
+    catalog = Table({"source_id": np.arange(Rows) + 10 ** 9, "RA": ra, "Dec": dec, "GMagnitude": rng.uniform(5.0, 20.0, Rows),
+                     "PMRA": np.zeros(Rows), "PMDec": np.zeros(Rows)})
+    store = StellarisStore(str(tmp_path_factory.mktemp("store")))
+    store.Ingest(catalog, "gaia", "Star")
+    return store
+
+
+@pytest.fixture
+def stellaris(local_catalog, monkeypatch):
+    monkeypatch.setattr(DBAccessStellaris, "Stellaris_Store", local_catalog)
+    return DBAccessStellaris.DBAccessStellaris()
+
+
+def _crossMatch(stellaris, match_policy):
+    catalog_source, query, catalog_to_match, crossmatch_query, result = CrossMatching().CrossMatching(
+        stellaris, stellaris, {"limit": Rows}, Rows, None, match_policy=match_policy)
+    assert crossmatch_query.startswith("Local cross match")
+    return result.Table
+
+
+def test_best_match_with_local_catalog_finds_every_source_itself(stellaris):
+    table = _crossMatch(stellaris, Match_Best)
+    assert len(table) == Rows
+    np.testing.assert_array_equal(table[Column_Id], table["matched_" + Column_Id])
+    np.testing.assert_allclose(table["separation"], 0.0, atol=1e-10)
+
+
+def test_all_matches_with_local_catalog_are_brute_force_pairs(stellaris):
+    table = _crossMatch(stellaris, Match_All)
+    # every source has a row per match, its position is taken from its first row
+    ids, rows = np.unique(np.asarray(table[Column_Id]), return_index=True)
+    ra, dec = np.asarray(table["RA"])[rows], np.asarray(table["Dec"])[rows]
+    distances = BruteForceSeparations(ra, dec, ra, dec)
+    expected = {(ids[i], ids[j]) for i, j in zip(*np.nonzero(distances <= match_radius))}
+    borderline = {(ids[i], ids[j]) for i, j in zip(*np.nonzero(np.abs(distances - match_radius) <= Radius_Tolerance))}
+    found = set(zip(np.asarray(table[Column_Id]).tolist(), np.asarray(table["matched_" + Column_Id]).tolist()))
+    assert len(ids) == Rows
+    assert len(expected) > Rows
+    assert found - borderline == expected - borderline
+
+
+def test_cross_matching_request_with_local_catalog(stellaris):
+    response = StellarisAPI.app.test_client().post("/crossMatching", data=json.dumps({
+        "db_name_src": "stellaris", "db_name_to_match": "stellaris", "query_params": json.dumps({"limit": 10})}))
+    assert response.status_code == 200
+    body = json.loads(response.get_data())
+    assert body["crossmatch_query"].startswith("Local cross match with stellaris")
+    assert len(body["data"]) == 10
+
+
+def test_cross_matching_request_with_remote_catalog_other_than_simbad_is_rejected():
+    response = StellarisAPI.app.test_client().post("/crossMatching", data=json.dumps({
+        "db_name_src": "stellaris", "db_name_to_match": "gaia", "query_params": json.dumps({"limit": 10})}))
+    assert response.status_code == 400
+
+
+# SIMBAD rows: main identifiers, common names with their prefix (masked when the object has none) and separations
+def test_reduce_matches_keeps_one_row_per_object_with_its_common_name():
+    table = Table({"simbad_id": ["* alf Lyr", "* alf Lyr", "HD 1", "* alf Lyr", "X"],
+                   "simbad_name": MaskedColumn(["NAME Wega", "NAME Vega", "", "NAME Vega", "NAME "], mask=[False, False, True, False, False]),
+                   "separation": [0.0002, 0.0002, 0.0001, 0.0005, 0.0003],
+                   "gaia_id": [1, 1, 1, 2, 3]})
+    every = ReduceMatches(table, "gaia_id", Match_All)
+    assert list(zip(every["gaia_id"], every["simbad_id"], every["simbad_name"])) == [
+        (1, "* alf Lyr", "Vega"), (1, "HD 1", "HD 1"), (2, "* alf Lyr", "Vega"), (3, "X", "X")]
+    best = ReduceMatches(table, "gaia_id", Match_Best)
+    assert list(zip(best["gaia_id"], best["simbad_id"])) == [(1, "HD 1"), (2, "* alf Lyr"), (3, "X")]
+
+
+# Gaia and SIMBAD served by the stand-in, cross matches are not taken from the match store of earlier runs
+@pytest.fixture
+def remote_catalogs(monkeypatch, tmp_path):
+    with TapStandIn(rows=5000) as stand_in:
+        monkeypatch.setattr(DBAccessGaia, "Gaia_Url", stand_in.ServiceUrl("gaia") + "/sync")
+        monkeypatch.setattr(DBAccessGaia, "Gaia_Async_Url", stand_in.ServiceUrl("gaia") + "/async")
+        monkeypatch.setattr(CrossMatchingModule, "simbad_tap", pyvo.dal.tap.TAPService(stand_in.ServiceUrl("simbad"), session=Http_Transport.Session))
+        monkeypatch.setattr(CrossMatchingModule, "Match_Store", MatchStore(str(tmp_path / "matches.sqlite3")))
+        # every cross match answer of SIMBAD
+        answers = []
+        def crossMatch(query, uploads, cross_match=stand_in._crossMatch):
+            answers.append(cross_match(query, uploads))
+            return answers[-1]
+        monkeypatch.setattr(stand_in, "_crossMatch", crossMatch)
+        yield DBAccessGaia.DBAccessGaia(), DBAccessSimbad.DBAccessSimbad(), answers
+
+
+def test_remote_best_match_transfers_one_row_per_source(remote_catalogs, monkeypatch):
+    gaia, simbad, answers = remote_catalogs
+    params = {"object_types": "Star", "limit": 500}
+    results = {}
+    for remote in (True, False):
+        monkeypatch.setattr(CrossMatchingModule, "remote_best_match", remote)
+        answers.clear()
+        catalog_source, query, catalog_to_match, crossmatch_query, result = CrossMatching().CrossMatching(gaia, simbad, params, 500, None, match_policy=Match_Best)
+        assert ("GROUP BY" in crossmatch_query) == remote
+        results[remote] = (sum(len(answer) for answer in answers), result.Table)
+
+    remote_rows, remote_table = results[True]
+    local_rows, local_table = results[False]
+    matched = int(np.sum(~np.ma.getmaskarray(remote_table["simbad_id"])))
+    assert remote_rows == matched < local_rows
+    for column in ("gaia_id", "simbad_id", "simbad_name", "separation"):
+        assert list(remote_table[column]) == list(local_table[column])
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import SkyCoord, Distance
+from astropy.time import Time
+
+from DBaccess.EpochPropagation import PropagatePositions, EpochToJulianYear, Au_Per_Year_In_Km_Per_S
+
+Rows = 20000
+
+# without radial motion the linear model and astropy give the same direction up to rounding
+Max_Separation_Without_Radial_Velocity_Mas = 0.001
+# ERFA starpm used by astropy also corrects for light time, the linear model does not; the difference grows with the
+# square of the time and stays below this limit for stars moving up to 500 km/s within the epochs below
+Max_Separation_Mas = 1.0
+Max_Tangential_Velocity = 500.0
+Max_Radial_Velocity = 500.0
+
+# Gaia DR3, Gaia DR2, J2000 and Hipparcos epochs and a future epoch
+Epoch_Pairs = [("J2016.0", "J2000.0"), ("J2000.0", "J2016.0"), ("J2015.5", "J1991.25"), ("J2016.0", "J2030.0"),
+               ("J2016.0", "J2015.5")]
+
+
+def _astropyPositions(ra, dec, pmra, pmdec, parallax, radial_velocity, epoch, new_epoch):
+    coordinates = SkyCoord(ra=ra * u.deg, dec=dec * u.deg, pm_ra_cosdec=pmra * u.mas / u.yr, pm_dec=pmdec * u.mas / u.yr,
+                           distance=Distance(parallax=parallax * u.mas), radial_velocity=radial_velocity * u.km / u.s,
+                           obstime=Time(EpochToJulianYear(epoch), format="jyear", scale="tdb"))
+    propagated = coordinates.apply_space_motion(new_obstime=Time(EpochToJulianYear(new_epoch), format="jyear", scale="tdb"))
+    return propagated.ra.deg, propagated.dec.deg
+
+
+def _maxSeparationMas(ra1, dec1, ra2, dec2):
+    return SkyCoord(ra1 * u.deg, dec1 * u.deg).separation(SkyCoord(ra2 * u.deg, dec2 * u.deg)).to_value(u.mas).max()
+
+
+# positions all over the sky, parallaxes from 0.1 to 100 mas and motions up to the given velocities in km/s
+def _stars(seed, tangential_velocity, radial_velocity):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, Rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, Rows)))
+    parallax = 10 ** rng.uniform(-1.0, 2.0, Rows)
+    proper_motion = rng.uniform(0.0, tangential_velocity, Rows) * parallax / Au_Per_Year_In_Km_Per_S
+    angle = rng.uniform(0.0, 2 * np.pi, Rows)
+    return (ra, dec, proper_motion * np.cos(angle), proper_motion * np.sin(angle), parallax,
+            rng.uniform(-radial_velocity, radial_velocity, Rows))
+
+
+@pytest.mark.parametrize("epoch, new_epoch", Epoch_Pairs)
+def test_matches_astropy_space_motion(epoch, new_epoch):
+    ra, dec, pmra, pmdec, parallax, radial_velocity = _stars(1, Max_Tangential_Velocity, Max_Radial_Velocity)
+    new_ra, new_dec = PropagatePositions(ra, dec, pmra, pmdec, epoch, new_epoch, parallax, radial_velocity)
+    expected_ra, expected_dec = _astropyPositions(ra, dec, pmra, pmdec, parallax, radial_velocity, epoch, new_epoch)
+    assert _maxSeparationMas(new_ra, new_dec, expected_ra, expected_dec) < Max_Separation_Mas
+
+
+# proper motions up to 10 arcsec/yr (nearby stars) over a century
+@pytest.mark.parametrize("years", [-100.0, -16.0, 16.0, 100.0])
+def test_matches_astropy_without_radial_velocity(years):
+    rng = np.random.default_rng(2)
+    ra = rng.uniform(0.0, 360.0, Rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, Rows)))
+    pmra, pmdec = rng.uniform(-7000.0, 7000.0, (2, Rows))
+    parallax = rng.uniform(100.0, 1000.0, Rows)
+    new_ra, new_dec = PropagatePositions(ra, dec, pmra, pmdec, 2016.0, 2016.0 + years)
+    expected_ra, expected_dec = _astropyPositions(ra, dec, pmra, pmdec, parallax, np.zeros(Rows), 2016.0, 2016.0 + years)
+    assert _maxSeparationMas(new_ra, new_dec, expected_ra, expected_dec) < Max_Separation_Without_Radial_Velocity_Mas
+
+
+def test_undefined_motion_keeps_position():
+    ra = np.array([10.0, 20.0, 30.0])
+    dec = np.array([-80.0, 0.0, 89.9])
+    pmra = np.ma.MaskedArray([np.nan, 5.0, 0.0], mask=[False, True, False])
+    pmdec = np.array([np.nan, np.nan, 0.0])
+    new_ra, new_dec = PropagatePositions(ra, dec, pmra, pmdec, "J2016.0", "J2000.0", [np.nan, 10.0, 1.0], [30.0, np.nan, np.nan])
+    np.testing.assert_allclose(new_ra, ra, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(new_dec, dec, rtol=0, atol=1e-12)
+
+
+def test_blocks_give_the_same_positions():
+    ra, dec, pmra, pmdec, parallax, radial_velocity = _stars(3, Max_Tangential_Velocity, Max_Radial_Velocity)
+    whole = PropagatePositions(ra, dec, pmra, pmdec, "J2016.0", "J2000.0", parallax, radial_velocity, block_size=Rows)
+    blocks = PropagatePositions(ra, dec, pmra, pmdec, "J2016.0", "J2000.0", parallax, radial_velocity, block_size=777)
+    np.testing.assert_array_equal(whole[0], blocks[0])
+    np.testing.assert_array_equal(whole[1], blocks[1])
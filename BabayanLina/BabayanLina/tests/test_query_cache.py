@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.table import Table
+
+from DBaccess.QueryCache import QueryCache, Temporary_Suffix
+
+Query = "SELECT TOP 10 gs.source_id AS gaia_id\n FROM gaiadr3.gaia_source AS gs"
+
+
+def _table(seed, rows=100):
+    rng = np.random.default_rng(seed)
+    return Table({"gaia_id": rng.integers(0, 10 ** 12, rows), "RA": rng.uniform(0.0, 360.0, rows)})
+
+
+def _assertSameTable(table, expected):
+    assert table.colnames == expected.colnames
+    for name in expected.colnames:
+        np.testing.assert_array_equal(table[name], expected[name])
+
+
+def test_queries_differing_in_whitespace_share_the_result(tmp_path):
+    cache = QueryCache(cache_dir=str(tmp_path))
+    table = _table(1)
+    cache.Put("gaia", Query, table)
+    _assertSameTable(cache.Get("gaia", "  SELECT TOP 10   gs.source_id AS gaia_id FROM gaiadr3.gaia_source AS gs "), table)
+    assert cache.Get("simbad", Query) is None
+    assert cache.Stats["memory_hits"] == 1 and cache.Stats["misses"] == 1
+
+
+def test_columns_added_by_the_caller_are_not_cached(tmp_path):
+    cache = QueryCache(cache_dir=str(tmp_path))
+    table = _table(1)
+    cache.Put("gaia", Query, table)
+    table["adjusted_ra"] = table["RA"]
+    cache.Get("gaia", Query)["adjusted_dec"] = table["RA"]
+    assert cache.Get("gaia", Query).colnames == ["gaia_id", "RA"]
+
+
+def test_results_evicted_from_memory_are_read_from_disk(tmp_path):
+    cache = QueryCache(max_entries=2, cache_dir=str(tmp_path))
+    tables = [_table(seed) for seed in range(4)]
+    for seed, table in enumerate(tables):
+        cache.Put("gaia", f"{Query} WHERE gs.random_index = {seed}", table)
+    assert cache.Stats["memory_entries"] == 2
+    assert cache.Stats["disk_entries"] == 2
+
+    # the newest results are in memory, the oldest ones are read back from disk
+    for seed in reversed(range(len(tables))):
+        _assertSameTable(cache.Get("gaia", f"{Query} WHERE gs.random_index = {seed}"), tables[seed])
+    assert cache.Stats["memory_hits"] == 2 and cache.Stats["disk_hits"] == 2
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(Temporary_Suffix)]
+
+
+def test_memory_is_bounded_by_bytes(tmp_path):
+    table_bytes = sum(column.nbytes for column in _table(0).itercols())
+    cache = QueryCache(cache_dir=str(tmp_path), max_memory_bytes=3 * table_bytes)
+    for seed in range(10):
+        cache.Put("gaia", f"{Query} WHERE gs.random_index = {seed}", _table(seed))
+    assert cache.Stats["memory_bytes"] <= 3 * table_bytes
+    assert cache.Stats["memory_entries"] == 3
+    _assertSameTable(cache.Get("gaia", f"{Query} WHERE gs.random_index = 0"), _table(0))
+
+
+def test_disk_is_bounded_by_bytes(tmp_path):
+    cache = QueryCache(max_entries=1, cache_dir=str(tmp_path), max_disk_bytes=20000)
+    for seed in range(20):
+        cache.Put("gaia", f"{Query} WHERE gs.random_index = {seed}", _table(seed))
+    assert 0 < cache.Stats["disk_bytes"] <= 20000
+
+
+def test_expired_results_are_served_only_as_stale(tmp_path):
+    cache = QueryCache(max_entries=1, cache_dir=str(tmp_path), ttl_seconds=-1, stale_seconds=3600)
+    cache.Put("gaia", Query, _table(1))
+    cache.Put("gaia", Query + " WHERE 1=1", _table(2))
+    for query, seed in [(Query, 1), (Query + " WHERE 1=1", 2)]:
+        assert cache.Get("gaia", query) is None
+        _assertSameTable(cache.GetStale("gaia", query), _table(seed))
+    assert cache.Stats["stale_hits"] == 2
+
+
+def test_concurrent_puts_and_gets_return_complete_results(tmp_path):
+    cache = QueryCache(max_entries=3, cache_dir=str(tmp_path))
+    tables = [_table(seed, rows=2000) for seed in range(8)]
+
+    def putAndGet(step):
+        seed = step % len(tables)
+        query = f"{Query} WHERE gs.random_index = {seed}"
+        if step % 3 == 0:
+            cache.Put("gaia", query, tables[seed])
+        table = cache.Get("gaia", query)
+        if table is not None:
+            _assertSameTable(table, tables[seed])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(putAndGet, range(400)))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(Temporary_Suffix)]
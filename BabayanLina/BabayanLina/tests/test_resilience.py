@@ -0,0 +1,219 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import DBaccess.Resilience as ResilienceModule
+from DBaccess.AdmissionControl import AdmissionControl, reserved_slots
+from DBaccess.RequestProcessingError import RequestProcessingError, UpstreamUnavailableError
+from DBaccess.Resilience import Resilience, State_Closed, State_Half_Open, State_Open
+
+Query = "SELECT TOP 10 * FROM gaiadr3.gaia_source"
+Open_Seconds = 0.2
+
+
+# resilience layer with its own slots of the catalogs and short breaker and hedge delays
+@pytest.fixture
+def resilience(monkeypatch):
+    monkeypatch.setattr(ResilienceModule, "Admission_Control", AdmissionControl(upstream_limits={"gaia": 8}))
+    monkeypatch.setattr(ResilienceModule, "breaker_open_seconds", Open_Seconds)
+    monkeypatch.setattr(ResilienceModule, "hedge_min_delay", 0.02)
+    return Resilience()
+
+
+def _inUse():
+    return ResilienceModule.Admission_Control.Stats.get("gaia_in_use", 0)
+
+
+def _waitReleased():
+    deadline = time.monotonic() + 5
+    while _inUse() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return _inUse()
+
+
+def _fail(message="HTTP error 503"):
+    def request():
+        raise RequestProcessingError("gaia", Query, "Error", message)
+    return request
+
+
+def _failures(resilience, count, message="HTTP error 503"):
+    for _ in range(count):
+        with pytest.raises(RequestProcessingError):
+            resilience.Call("gaia", Query, _fail(message), hedge=False)
+
+
+def _state(resilience):
+    return resilience.StatusOf("gaia")["state"]
+
+
+def test_breaker_opens_when_requests_fail(resilience):
+    _failures(resilience, ResilienceModule.breaker_min_requests - 1)
+    assert _state(resilience) == State_Closed
+    _failures(resilience, 1)
+    assert _state(resilience) == State_Open
+
+    # requests fail fast while the breaker is open, the catalog is not requested
+    calls = []
+    with pytest.raises(UpstreamUnavailableError) as rejected:
+        resilience.Call("gaia", Query, lambda: calls.append(1), hedge=False)
+    assert not calls
+    assert 0 < rejected.value.retry_after <= Open_Seconds + 1
+    assert resilience.StatusOf("gaia")["rejected"] == 1
+
+
+def test_errors_of_the_query_do_not_open_the_breaker(resilience):
+    _failures(resilience, 2 * ResilienceModule.breaker_min_requests, message="HTTP error 400")
+    assert _state(resilience) == State_Closed
+    assert resilience.StatusOf("gaia")["failures"] == 0
+
+
+def test_successful_probe_closes_the_breaker(resilience):
+    _failures(resilience, ResilienceModule.breaker_min_requests)
+    time.sleep(Open_Seconds)
+    assert _state(resilience) == State_Half_Open
+
+    # one probe is let through, other requests are rejected while it runs
+    probing, release = threading.Event(), threading.Event()
+    def probe():
+        probing.set()
+        release.wait(5)
+        return "rows"
+    thread = threading.Thread(target=lambda: resilience.Call("gaia", Query, probe, hedge=False))
+    thread.start()
+    probing.wait(5)
+    with pytest.raises(UpstreamUnavailableError):
+        resilience.Call("gaia", Query, lambda: "rows", hedge=False)
+    release.set()
+    thread.join()
+
+    assert _state(resilience) == State_Closed
+    assert resilience.StatusOf("gaia")["window_requests"] == 0
+    assert resilience.Call("gaia", Query, lambda: "rows", hedge=False) == "rows"
+
+
+def test_failed_probe_opens_the_breaker_again(resilience):
+    _failures(resilience, ResilienceModule.breaker_min_requests)
+    time.sleep(Open_Seconds)
+    _failures(resilience, 1)
+    assert _state(resilience) == State_Open
+    assert resilience.StatusOf("gaia")["opened"] == 2
+    with pytest.raises(UpstreamUnavailableError):
+        resilience.Call("gaia", Query, lambda: "rows", hedge=False)
+
+
+def test_probe_rejected_by_admission_control_does_not_block_the_breaker(resilience, monkeypatch):
+    _failures(resilience, ResilienceModule.breaker_min_requests)
+    time.sleep(Open_Seconds)
+    def rejected(catalog, big=False):
+        raise UpstreamUnavailableError(catalog, Query, "Busy", "No free slot", 1.0)
+    with monkeypatch.context() as patch:
+        patch.setattr(ResilienceModule.Admission_Control, "AcquireUpstream", rejected)
+        with pytest.raises(UpstreamUnavailableError):
+            resilience.Call("gaia", Query, lambda: "rows", hedge=False)
+    # the next request is the probe
+    assert resilience.Call("gaia", Query, lambda: "rows", hedge=False) == "rows"
+    assert _state(resilience) == State_Closed
+
+
+def test_forced_open_breaker_stays_open(resilience):
+    resilience.SetState("gaia", State_Open)
+    time.sleep(Open_Seconds)
+    assert _state(resilience) == State_Open
+    resilience.SetState("gaia", State_Closed)
+    assert resilience.Call("gaia", Query, lambda: "rows", hedge=False) == "rows"
+
+
+# latencies of fast requests, so slower ones are hedged
+def _warmUp(resilience):
+    for _ in range(ResilienceModule.hedge_min_samples):
+        resilience.Call("gaia", Query, lambda: "rows")
+    assert resilience.StatusOf("gaia")["hedge_delay_seconds"] == ResilienceModule.hedge_min_delay
+
+
+# request of which the first attempt is slow and the others are fast
+def _slowFirst(seconds=0.3):
+    attempts = []
+    lock = threading.Lock()
+    def request():
+        with lock:
+            attempts.append(1)
+            first = len(attempts) == 1
+        time.sleep(seconds if first else 0.0)
+        return "first" if first else "hedge"
+    return request, attempts
+
+
+def test_slow_request_is_hedged_and_the_abandoned_attempt_releases_its_slot(resilience):
+    _warmUp(resilience)
+    request, attempts = _slowFirst()
+    assert resilience.Call("gaia", Query, request) == "hedge"
+    assert len(attempts) == 2
+    # the abandoned first attempt still holds its slot until it finishes
+    assert _inUse() == 1
+    assert _waitReleased() == 0
+    status = resilience.StatusOf("gaia")
+    assert status["hedges"] == 1 and status["hedge_wins"] == 1
+
+
+def test_hedges_are_limited_by_the_budget(resilience):
+    _warmUp(resilience)
+    requests = 6
+    sent = 0
+    for _ in range(requests):
+        request, attempts = _slowFirst(seconds=0.1)
+        resilience.Call("gaia", Query, request)
+        sent += len(attempts)
+    # hedge_budget of the requests in the window are hedged, at least one
+    window = ResilienceModule.hedge_min_samples + requests
+    hedges = max(1, int(ResilienceModule.hedge_budget * window))
+    assert resilience.StatusOf("gaia")["hedges"] == hedges < requests
+    assert sent == requests + hedges
+    assert _waitReleased() == 0
+
+
+def test_hedge_is_not_sent_without_a_free_slot(resilience, monkeypatch):
+    monkeypatch.setattr(ResilienceModule, "Admission_Control", AdmissionControl(upstream_limits={"gaia": reserved_slots + 1}))
+    _warmUp(resilience)
+    request, attempts = _slowFirst(seconds=0.1)
+    assert resilience.Call("gaia", Query, request) == "first"
+    assert len(attempts) == 1
+    assert resilience.StatusOf("gaia")["hedges"] == 0
+    assert _inUse() == 0
+
+
+def test_timed_out_request_releases_its_slot_when_it_finishes(resilience):
+    resilience.call_timeout_seconds = 0.1
+    with pytest.raises(UpstreamUnavailableError):
+        resilience.Call("gaia", Query, lambda: time.sleep(0.3))
+    assert resilience.StatusOf("gaia")["timeouts"] == 1
+    assert _inUse() == 1
+    assert _waitReleased() == 0
+
+
+def test_async_hedge_cancels_the_slower_attempt_and_releases_its_slot(resilience):
+    _warmUp(resilience)
+    cancelled = []
+
+    def request():
+        async def attempt(first):
+            try:
+                await asyncio.sleep(0.3 if first else 0.0)
+            except asyncio.CancelledError:
+                cancelled.append(first)
+                raise
+            return "first" if first else "hedge"
+        request.calls += 1
+        return attempt(request.calls == 1)
+    request.calls = 0
+
+    async def run():
+        result = await resilience.CallAsync("gaia", Query, request)
+        # the cancellation reaches the abandoned attempt at the next step of the loop
+        await asyncio.sleep(0.01)
+        return result
+    assert asyncio.run(run()) == "hedge"
+    assert cancelled == [True]
+    assert _inUse() == 0
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from astropy.table import Table
+
+from DBaccess.CrossMatching import _ownResult
+from DBaccess.QueryResult import QueryResult
+from DBaccess.SingleFlight import SingleFlight, AsyncSingleFlight
+
+Callers = 6
+
+
+# function blocking until released, with the number of its calls
+class _Blocked:
+    def __init__(self, result=None, error=None):
+        self.release = threading.Event()
+        self.calls = 0
+        self.result = result
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _whenWaiting(flights, followers, release):
+    # the leader is released when all the other callers wait for its result
+    def waitFollowers():
+        while flights.Stats["followers_waiting"] < followers:
+            threading.Event().wait(0.005)
+        release.set()
+    threading.Thread(target=waitFollowers, daemon=True).start()
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    function = _Blocked(result=Table({"gaia_id": [1, 2]}))
+    _whenWaiting(flights, Callers - 1, function.release)
+    with ThreadPoolExecutor(max_workers=Callers) as executor:
+        results = list(executor.map(lambda _: flights.Do("query", function), range(Callers)))
+    assert function.calls == 1
+    assert all(result is results[0] for result in results)
+    assert flights.Stats == {"in_flight": 0, "followers_waiting": 0, "leaders_total": 1, "followers_total": Callers - 1, "failed_total": 0}
+
+    # a later caller starts a new call
+    flights.Do("query", function)
+    assert function.calls == 2
+
+
+def test_different_keys_are_not_coalesced():
+    flights = SingleFlight()
+    assert [flights.Do(key, lambda key=key: key) for key in ("gaia", "simbad")] == ["gaia", "simbad"]
+    assert flights.Stats["leaders_total"] == 2
+
+
+@pytest.mark.parametrize("error", [ValueError("bad query"), KeyboardInterrupt()])
+def test_error_of_the_leader_is_raised_to_followers(error):
+    flights = SingleFlight()
+    function = _Blocked(error=error)
+    _whenWaiting(flights, Callers - 1, function.release)
+
+    def call(_):
+        try:
+            return flights.Do("query", function)
+        except BaseException as e:
+            return e
+    with ThreadPoolExecutor(max_workers=Callers) as executor:
+        errors = list(executor.map(call, range(Callers)))
+    assert all(e is error for e in errors)
+    assert function.calls == 1
+    assert flights.Stats["failed_total"] == 1 and flights.Stats["in_flight"] == 0
+
+
+def test_async_callers_share_one_call():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def request():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return Table({"gaia_id": [1, 2]})
+
+    async def run():
+        return await asyncio.gather(*[flights.Do("query", request) for _ in range(Callers)])
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flights.Stats["in_flight"] == 0 and flights.Stats["followers_total"] == Callers - 1
+
+
+def test_async_request_goes_on_until_its_last_caller_is_cancelled():
+    flights = AsyncSingleFlight()
+    started = []
+
+    async def request():
+        started.append(asyncio.current_task())
+        await asyncio.sleep(5)
+
+    async def run():
+        callers = [asyncio.ensure_future(flights.Do("query", request)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        task = started[0]
+        # the other caller still waits, the request is not cancelled
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        assert flights.Stats["in_flight"] == 1
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return task
+    task = asyncio.run(run())
+    assert task.cancelled()
+    assert flights.Stats["in_flight"] == 0 and flights.Stats["failed_total"] == 1
+
+
+def test_async_error_of_the_request_is_raised_to_every_caller():
+    flights = AsyncSingleFlight()
+
+    async def request():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad query")
+
+    async def run():
+        return await asyncio.gather(*[flights.Do("query", request) for _ in range(3)], return_exceptions=True)
+    errors = asyncio.run(run())
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert flights.Stats["failed_total"] == 1
+
+
+def test_coalesced_cross_match_callers_get_their_own_table():
+    shared = ("gaia", "query", "simbad", "crossmatch query", QueryResult(Table({"gaia_id": [1, 2], "simbad_id": ["a", "b"]})))
+    first, second = _ownResult(shared)[-1].Table, _ownResult(shared)[-1].Table
+    first["adjusted_ra"] = [0.0, 1.0]
+    assert first is not second
+    assert second.colnames == ["gaia_id", "simbad_id"]
+    assert shared[-1].Table.colnames == ["gaia_id", "simbad_id"]
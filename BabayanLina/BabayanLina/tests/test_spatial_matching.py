@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from DBaccess.SpatialMatching import SpatialIndex
+from SkyPositions import CapPositions, BruteForceSeparations
+
+Radius = 0.01
+# pairs this close to the radius are skipped, rounding may put them on either side
+Radius_Tolerance = 1e-9
+
+# sky patches around the RA wrap, the north pole, the south pole and an ordinary field
+Patches = [(0.0, 0.0), (180.0, 89.9), (300.0, -89.95), (45.0, -60.0)]
+
+
+def _positions(seed, n):
+    rng = np.random.default_rng(seed)
+    ra, dec = zip(*(CapPositions(rng, patch_ra, patch_dec, 0.2, n) for patch_ra, patch_dec in Patches))
+    return np.concatenate(ra), np.concatenate(dec)
+
+
+@pytest.fixture(scope="module")
+def positions():
+    target_ra, target_dec = _positions(1, 800)
+    source_ra, source_dec = _positions(2, 500)
+    # a few sources at the very positions of targets, undefined positions are never matched
+    source_ra[:20], source_dec[:20] = target_ra[:20], target_dec[:20]
+    source_ra[20], source_dec[21] = np.nan, np.nan
+    target_ra[30] = np.nan
+    return source_ra, source_dec, target_ra, target_dec
+
+
+def test_match_within_radius_finds_brute_force_pairs(positions):
+    source_ra, source_dec, target_ra, target_dec = positions
+    source, target, separation = SpatialIndex(target_ra, target_dec, Radius).MatchWithinRadius(source_ra, source_dec, block_size=97)
+
+    distances = BruteForceSeparations(source_ra, source_dec, target_ra, target_dec)
+    expected = set(zip(*np.nonzero(distances <= Radius)))
+    found = set(zip(source.tolist(), target.tolist()))
+    borderline = set(zip(*np.nonzero(np.abs(distances - Radius) <= Radius_Tolerance)))
+    assert len(expected) > len(source_ra)
+    assert found - borderline == expected - borderline
+    np.testing.assert_allclose(separation, distances[source, target], rtol=0, atol=1e-10)
+
+    # pairs are ordered by source and then by separation
+    order = np.lexsort((separation, source))
+    np.testing.assert_array_equal(order, np.arange(len(source)))
+
+
+def test_match_nearest_finds_brute_force_nearest(positions):
+    source_ra, source_dec, target_ra, target_dec = positions
+    target_index, separation = SpatialIndex(target_ra, target_dec, Radius).MatchNearest(source_ra, source_dec)
+
+    distances = BruteForceSeparations(source_ra, source_dec, target_ra, target_dec)
+    distances[np.isnan(distances)] = np.inf
+    nearest = np.argmin(distances, axis=1)
+    nearest_distance = distances[np.arange(len(source_ra)), nearest]
+    matched = nearest_distance <= Radius
+    clear = np.abs(nearest_distance - Radius) > Radius_Tolerance
+
+    np.testing.assert_array_equal(target_index[matched & clear], nearest[matched & clear])
+    np.testing.assert_array_equal(target_index[~matched & clear], -1)
+    np.testing.assert_allclose(separation[matched & clear], nearest_distance[matched & clear], rtol=0, atol=1e-10)
+    assert np.isnan(separation[~matched & clear]).all()
+    np.testing.assert_array_equal(target_index[:20], np.arange(20))
+    assert target_index[20] == -1 and target_index[21] == -1
+
+
+def test_empty_targets_match_nothing():
+    target_index, separation = SpatialIndex([], [], Radius).MatchNearest([1.0, 2.0], [3.0, 4.0])
+    np.testing.assert_array_equal(target_index, [-1, -1])
+    assert np.isnan(separation).all()
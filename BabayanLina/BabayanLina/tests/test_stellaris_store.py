@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from DBaccess.StellarisStore import StellarisStore, Column_Source_Id, Column_Id
+from SkyPositions import CapPositions, BruteForceSeparations
+
+Rows = 20000
+# distances this close to the cone radius are skipped, rounding may put them on either side
+Radius_Tolerance = 1e-9
+
+
+def _catalog(seed, rows):
+    rng = np.random.default_rng(seed)
+    # most rows all over the sky and dense fields around the RA wrap and the poles
+    ra, dec = rng.uniform(0.0, 360.0, rows // 2), np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, rows // 2)))
+    fields = [CapPositions(rng, field_ra, field_dec, 2.0, rows // 6) for field_ra, field_dec in [(0.0, 10.0), (90.0, 89.0), (200.0, -89.5)]]
+    ra = np.concatenate([ra] + [field[0] for field in fields])
+    dec = np.concatenate([dec] + [field[1] for field in fields])
+    rows = len(ra)
+    g_magnitude = rng.uniform(3.0, 21.0, rows)
+    parallax = rng.uniform(-1.0, 50.0, rows)
+    parallax[rng.random(rows) < 0.1] = np.nan
+    return Table({"source_id": rng.choice(10 ** 12, rows, replace=False),
+                  "RA": ra, "Dec": dec, "GMagnitude": g_magnitude, "BPMagnitude": g_magnitude + 0.5,
+                  "Parallax": parallax, "PMRA": rng.normal(0.0, 20.0, rows), "PMDec": rng.normal(0.0, 20.0, rows)})
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    catalog = _catalog(1, Rows)
+    store = StellarisStore(str(tmp_path_factory.mktemp("store")))
+    store.Ingest(catalog[:Rows // 2], "gaia", "Star")
+    store.Ingest(catalog[Rows // 2:], "gaia", "Galaxy")
+    return store, catalog
+
+
+def _sourceIds(table):
+    return set(np.asarray(table[Column_Source_Id]).tolist())
+
+
+def _expectedIds(catalog, mask):
+    return set(np.asarray(catalog["source_id"][mask]).astype(str).tolist())
+
+
+def _coneMask(catalog, ra, dec, radius):
+    distance = BruteForceSeparations([ra], [dec], np.asarray(catalog["RA"]), np.asarray(catalog["Dec"]))[0]
+    return distance <= radius, np.abs(distance - radius) <= Radius_Tolerance
+
+
+@pytest.mark.parametrize("ra, dec, radius", [(0.0, 10.0, 1.0), (359.5, 10.5, 0.3), (90.0, 90.0, 1.5), (10.0, -89.5, 2.0),
+                                             (123.0, 45.0, 5.0), (250.0, -20.0, 0.05), (0.0, 0.0, 180.0)])
+def test_cone_query_matches_brute_force(store, ra, dec, radius):
+    store, catalog = store
+    inside, borderline = _coneMask(catalog, ra, dec, radius)
+    found = _sourceIds(store.Query(cone=(ra, dec, radius)))
+    assert found - _expectedIds(catalog, borderline) == _expectedIds(catalog, inside & ~borderline)
+
+
+@pytest.mark.parametrize("ranges", [{"GMagnitude": (10.0, 10.5)}, {"GMagnitude": (None, 4.0)}, {"Parallax": (45.0, None)},
+                                    {"Parallax": (0.0, 1.0), "BPMagnitude": (15.0, 16.0)}, {"PMRA": (60.0, None)},
+                                    {"GMagnitude": (30.0, None)}])
+def test_range_query_matches_brute_force(store, ranges):
+    store, catalog = store
+    mask = np.ones(len(catalog), dtype=bool)
+    for name, (low, high) in ranges.items():
+        values = np.asarray(catalog[name])
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+    assert _sourceIds(store.Query(ranges=ranges)) == _expectedIds(catalog, mask)
+
+
+def test_cone_range_and_object_type_query_matches_brute_force(store):
+    store, catalog = store
+    inside, borderline = _coneMask(catalog, 0.0, 10.0, 1.5)
+    mask = inside & ~borderline & (np.asarray(catalog["GMagnitude"]) <= 12.0)
+    galaxy = np.arange(len(catalog)) >= Rows // 2
+    table = store.Query(ranges={"GMagnitude": (None, 12.0)}, cone=(0.0, 10.0, 1.5), object_type="galaxy")
+    assert _sourceIds(table) - _expectedIds(catalog, borderline) == _expectedIds(catalog, mask & galaxy)
+    assert set(table["ObjectType"]) <= {"Galaxy"}
+
+
+def test_limit_returns_rows_of_the_full_result(store):
+    store, catalog = store
+    everything = _sourceIds(store.Query(ranges={"GMagnitude": (None, 15.0)}))
+    limited = store.Query(ranges={"GMagnitude": (None, 15.0)}, limit=100)
+    assert len(limited) == 100
+    assert _sourceIds(limited) <= everything
+
+
+def test_ingest_again_keeps_ids_and_replaces_rows(tmp_path):
+    catalog = _catalog(2, 2000)
+    store = StellarisStore(str(tmp_path))
+    store.Ingest(catalog, "gaia", "Star")
+    ids = dict(zip(store.Query()[Column_Source_Id], store.Query()[Column_Id]))
+
+    changed = catalog[:100].copy()
+    changed["GMagnitude"] = 2.0
+    result = store.Ingest(changed, "gaia", "Star")
+    assert result == {"rows_ingested": 100, "rows_replaced": 100, "rows": len(catalog)}
+
+    table = store.Query()
+    assert dict(zip(table[Column_Source_Id], table[Column_Id])) == ids
+    assert _sourceIds(store.Query(ranges={"GMagnitude": (None, 2.5)})) == _expectedIds(catalog, np.arange(len(catalog)) < 100)